@@ -1,15 +1,20 @@
 import argparse
-import queue
 import sys
 import json
 import sounddevice as sd
-import socket
 from vosk import Model, KaldiRecognizer
 
-# Создаем очередь для обмена данными между потоками
-q = queue.Queue()
+from audio_dsp import CaptureRingBuffer, OVERFLOW_DROP_OLDEST, PolyphaseResampler, VoiceActivityDetector, downmix_to_mono
+from result_transport import ResultSender
+
+# Кольцевой буфер для обмена данными между потоками (создается в run_recognition)
+capture_buffer = None
+CAPTURE_BUFFER_MS = 5000 # Больше этой задержки звук не копится
+CAPTURE_OVERFLOW_POLICY = OVERFLOW_DROP_OLDEST
+result_sender = None # Постоянное соединение до прокси-сервера (создается в run_recognition)
 RESULTS_SEND_HOST = "127.0.0.1"
 RESULTS_SEND_PORT = 9991 # Порт, куда отправляются результаты распознавания
+VOSK_MODEL_SAMPLE_RATE = 16000 # Частота, на которой тренирована Vosk модель
 
 def list_audio_devices():
     """Выводит список доступных аудиоустройств."""
@@ -55,8 +60,12 @@ def callback(indata, frames, time, status):
     """
     if status:
         print(status, file=sys.stderr)
-    # Помещаем блок аудиоданных в очередь
-    q.put(bytes(indata))
+    # Копируем блок аудиоданных в заранее выделенный кольцевой буфер
+    capture_buffer.write(indata)
+
+def send_result(text):
+    """Ставит распознанную фразу в очередь отправки прокси-серверу."""
+    result_sender.send({"event": "recognition_partial", "text": text})
 
 def main():
     # --- 1. Обработка аргументов командной строки ---
@@ -73,6 +82,14 @@ def main():
         "-m", "--model", type=str, default="model",
         help="Путь к папке с моделью Vosk"
     )
+    parser.add_argument(
+        "--model-rate", type=int, default=VOSK_MODEL_SAMPLE_RATE,
+        help="Частота дискретизации модели; звук устройства ресемплируется к ней"
+    )
+    parser.add_argument(
+        "--no-vad", action="store_true",
+        help="Не отсекать тишину детектором речи (декодировать каждый блок)"
+    )
     args = parser.parse_args()
 
     # --- 2. Выбор аудиоустройства ---
@@ -96,6 +113,15 @@ def main():
         print("Скачать модели можно здесь: https://alphacephei.com/vosk/models")
         sys.exit(1)
 
+    run_recognition(model, device_index, model_rate=args.model_rate, use_vad=not args.no_vad)
+
+def run_recognition(model, device_index, model_rate=VOSK_MODEL_SAMPLE_RATE, use_vad=True):
+    """
+    Непрерывно распознает звук с устройства `device_index` уже загруженной моделью.
+    Вынесено из main(), чтобы супервизор мог вызывать цикл в дочерних процессах
+    без повторной загрузки модели.
+    """
+    global capture_buffer, result_sender
     # Получаем частоту дискретизации из информации об устройстве
     try:
         device_info = sd.query_devices(device_index, 'input')
@@ -103,45 +129,73 @@ def main():
         print(samplerate)
     except Exception as e:
         print(f"Не удалось получить частоту дискретизации для устройства, используем частоту модели. Ошибка: {e}")
-        samplerate = int(model.samplerate)
+        samplerate = model_rate
 
+    # Ресемплируем один раз перед распознавателем, чтобы Kaldi не делал этого на каждом блоке
+    resampler = PolyphaseResampler(samplerate, model_rate)
+    if not resampler.passthrough:
+        print(f"Ресемплинг {samplerate} Hz -> {model_rate} Hz")
+    vad = VoiceActivityDetector(model_rate) if use_vad else None
+    capture_buffer = CaptureRingBuffer(samplerate, capacity_ms=CAPTURE_BUFFER_MS, policy=CAPTURE_OVERFLOW_POLICY)
+    # Поток отправки создается здесь, а не при импорте: в рабочих процессах
+    # супервизора он должен появиться уже после fork()
+    result_sender = ResultSender(RESULTS_SEND_HOST, RESULTS_SEND_PORT)
+    result_sender.start()
+    reported_overruns = 0
 
     # --- 4. Основной цикл распознавания ---
     print("\nНачинаем распознавание. Говорите в микрофон.")
     print("Для остановки нажмите Ctrl+C.")
     
     try:
-        # Создаем распознаватель
-        recognizer = KaldiRecognizer(model, samplerate)
+        # Создаем распознаватель на частоте модели
+        recognizer = KaldiRecognizer(model, model_rate)
         
         # Открываем аудиопоток с выбранного устройства
         with sd.InputStream(samplerate=samplerate, device=device_index,
                             channels=1, dtype='int16', callback=callback):
             while True:
-                # Получаем данные из очереди
-                data = q.get()
-                
-                # Подаем данные в распознаватель
-                if recognizer.AcceptWaveform(data):
-                    # Если распознаватель вернул True, значит, он считает фразу законченной
-                    result = json.loads(recognizer.Result())
+                # Забираем все накопленные данные и приводим к частоте модели
+                data = capture_buffer.read()
+                if capture_buffer.overruns != reported_overruns:
+                    reported_overruns = capture_buffer.overruns
+                    print(f"[CAPTURE] Распознавание не успевает: переполнений {reported_overruns}, потеряно {capture_buffer.dropped_frames / samplerate:.1f} с аудио, задержка {capture_buffer.lag_ms:.0f} мс", file=sys.stderr)
+                data = resampler.process(downmix_to_mono(data))
+
+                # Блоки тишины отбрасываются VAD и не декодируются
+                if vad is not None:
+                    blocks, vad_event = vad.process(data)
+                else:
+                    blocks, vad_event = [data], None
+
+                for block in blocks:
+                    # Подаем данные в распознаватель
+                    # Частичные результаты здесь никому не отправляются, поэтому
+                    # PartialResult() не запрашиваем - только законченные фразы
+                    if recognizer.AcceptWaveform(block.tobytes()):
+                        # Если распознаватель вернул True, значит, он считает фразу законченной
+                        result = json.loads(recognizer.Result())
+                        if result['text']:
+                            print(f"Распознано: {result['text']}")
+                            send_result(result['text'])
+
+                # VAD зафиксировал конец речи: завершаем фразу и сбрасываем распознаватель
+                if vad_event == 'end':
+                    result = json.loads(recognizer.FinalResult())
                     if result['text']:
                         print(f"Распознано: {result['text']}")
-                        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                            sock.settimeout(1) # Таймаут на подключение/отправку
-                            sock.connect((RESULTS_SEND_HOST, RESULTS_SEND_PORT))
-                            message = json.dumps({"event": "recognition_partial", "text": result['text']}) + '\n'
-                            sock.send(message.encode('utf-8'))
-                else:
-                    # Иначе это частичный результат (в процессе речи)
-                    partial_result = json.loads(recognizer.PartialResult())
-                    # Выводим частичный результат на той же строке
-                    # print(f"  ... {partial_result['partial']}", end='\r')
+                        send_result(result['text'])
+                    recognizer.Reset()
+                    print(f"[VAD] Пропущено тишины: {vad.skipped_fraction:.1%} аудио")
 
     except KeyboardInterrupt:
         print("\nРаспознавание остановлено.")
+        if vad is not None:
+            print(f"[VAD] Итого пропущено тишины: {vad.skipped_fraction:.1%} аудио")
     except Exception as e:
         print(f"Произошла ошибка: {type(e).__name__}: {e}")
+    finally:
+        result_sender.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
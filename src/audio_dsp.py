@@ -0,0 +1,766 @@
+# audio_dsp.py
+"""
+Векторизованные (NumPy) примитивы обработки звука, общие для клиентов
+распознавания Vosk, прокси-сервера и sip-session3 (модуль копируется в
+пакет sipclient).
+"""
+import math
+import threading
+
+import numpy as np
+
+# Политики переполнения кольцевого буфера захвата
+OVERFLOW_DROP_OLDEST = "drop_oldest" # Затираем самые старые кадры, задержка не больше емкости
+OVERFLOW_SKIP_TO_LIVE = "skip_to_live" # Выбрасываем весь накопленный хвост и продолжаем с живого звука
+
+
+def as_int16_array(data) -> np.ndarray:
+    """Приводит bytes/буфер/массив к массиву int16 без лишнего копирования."""
+    if isinstance(data, np.ndarray):
+        return data if data.dtype == np.int16 else data.astype(np.int16)
+    return np.frombuffer(data, dtype=np.int16)
+
+
+def downmix_to_mono(block: np.ndarray, channel: int = None) -> np.ndarray:
+    """
+    Сводит блок (frames, channels) к моно.
+    Если указан `channel`, берется только этот канал, иначе каналы усредняются.
+    """
+    if block.ndim == 1:
+        return block
+    if channel is not None:
+        return block[:, channel]
+    if block.shape[1] == 1:
+        return block[:, 0]
+    mixed = block.mean(axis=1, dtype=np.float32)
+    return np.clip(np.rint(mixed), -32768, 32767).astype(np.int16)
+
+
+# Границы сегментов G.711 (как в g711.c Sun): µ-law по 14-битному, A-law по 13-битному отсчету
+_ULAW_SEG_END = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+_ALAW_SEG_END = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+
+
+def _g711_tables():
+    """
+    Таблицы кодирования на все 65536 значений int16 (индекс - отсчет как uint16)
+    и декодирования на все 256 кодов. Кодирование кадра - одна выборка по индексу.
+    """
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)
+
+    value = pcm >> 2
+    mask = np.where(value < 0, 0x7F, 0xFF)
+    value = np.minimum(np.abs(value), 8159) + 0x21
+    seg = np.searchsorted(_ULAW_SEG_END, value)
+    code = (seg << 4) | ((value >> (seg + 1)) & 0x0F)
+    ulaw_encode = (np.where(seg >= 8, 0x7F, code) ^ mask).astype(np.uint8)
+
+    value = pcm >> 3
+    mask = np.where(value >= 0, 0xD5, 0x55)
+    value = np.where(value >= 0, value, -value - 1)
+    seg = np.searchsorted(_ALAW_SEG_END, value)
+    code = (seg << 4) | ((value >> np.maximum(seg, 1)) & 0x0F)
+    alaw_encode = (np.where(seg >= 8, 0x7F, code) ^ mask).astype(np.uint8)
+
+    code = ~np.arange(256) & 0xFF
+    value = (((code & 0x0F) << 3) + 0x84) << ((code & 0x70) >> 4)
+    ulaw_decode = np.where(code & 0x80, 0x84 - value, value - 0x84).astype(np.int16)
+
+    code = np.arange(256) ^ 0x55
+    seg = (code & 0x70) >> 4
+    value = (code & 0x0F) << 4
+    value = np.where(seg == 0, value + 8, (value + 0x108) << np.maximum(seg - 1, 0))
+    alaw_decode = np.where(code & 0x80, value, -value).astype(np.int16)
+    return ulaw_encode, ulaw_decode, alaw_encode, alaw_decode
+
+
+_ULAW_ENCODE, _ULAW_DECODE, _ALAW_ENCODE, _ALAW_DECODE = _g711_tables()
+
+
+def linear_to_ulaw(samples) -> np.ndarray:
+    """int16 -> коды G.711 µ-law (uint8), одна выборка по таблице."""
+    return _ULAW_ENCODE[as_int16_array(samples).view(np.uint16)]
+
+
+def ulaw_to_linear(codes) -> np.ndarray:
+    """Коды G.711 µ-law (bytes/uint8) -> int16."""
+    return _ULAW_DECODE[np.frombuffer(codes, dtype=np.uint8)]
+
+
+def linear_to_alaw(samples) -> np.ndarray:
+    """int16 -> коды G.711 A-law (uint8)."""
+    return _ALAW_ENCODE[as_int16_array(samples).view(np.uint16)]
+
+
+def alaw_to_linear(codes) -> np.ndarray:
+    """Коды G.711 A-law (bytes/uint8) -> int16."""
+    return _ALAW_DECODE[np.frombuffer(codes, dtype=np.uint8)]
+
+
+class PolyphaseResampler:
+    """
+    Потоковый полифазный ресемплер с рациональным коэффициентом L/M.
+
+    Прототип ФНЧ (оконный sinc с окном Кайзера) раскладывается на L фаз,
+    каждый выходной отсчет считается как скалярное произведение одной фазы
+    на K последних входных отсчетов. Состояние (хвост входа и текущая фаза)
+    сохраняется между блоками, поэтому поток режется на блоки без щелчков.
+    """
+
+    def __init__(self, input_rate: int, output_rate: int, zero_crossings: int = 16, rolloff: float = 0.9, kaiser_beta: float = 8.0):
+        self.input_rate = int(input_rate)
+        self.output_rate = int(output_rate)
+        g = math.gcd(self.input_rate, self.output_rate)
+        self.up = self.output_rate // g
+        self.down = self.input_rate // g
+        self.passthrough = self.up == self.down
+
+        if self.passthrough:
+            return
+
+        # Фильтр проектируется на "повышенной" частоте input_rate * L;
+        # его длина покрывает zero_crossings лепестков sinc с каждой стороны.
+        taps_per_phase = -(-2 * zero_crossings * max(self.up, self.down) // self.up)
+        self.taps_per_phase = taps_per_phase
+        num_taps = taps_per_phase * self.up
+        cutoff = 0.5 * rolloff / max(self.up, self.down)  # в долях частоты дискретизации
+        n = np.arange(num_taps) - (num_taps - 1) / 2.0
+        prototype = 2.0 * cutoff * np.sinc(2.0 * cutoff * n) * np.kaiser(num_taps, kaiser_beta)
+        prototype *= self.up / prototype.sum()
+        # phases[p, k] = h[p + k*L]
+        self._phases = prototype.reshape(taps_per_phase, self.up).T.astype(np.float32).copy()
+        self._taps = np.arange(taps_per_phase)
+        self.reset()
+
+    def reset(self):
+        """Сбрасывает внутреннее состояние (например, между звонками)."""
+        if self.passthrough:
+            return
+        self._history = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+        self._position = 0  # позиция следующего выходного отсчета в единицах 1/L входа
+
+    def process(self, samples) -> np.ndarray:
+        """Принимает моно int16 (массив или bytes) и возвращает ресемплированный int16."""
+        samples = as_int16_array(samples)
+        if self.passthrough or samples.size == 0:
+            return samples
+
+        up, down = self.up, self.down
+        buf = np.concatenate((self._history, samples.astype(np.float32)))
+        last = up * samples.size - 1
+        if last < self._position:
+            count = 0
+        else:
+            count = (last - self._position) // down + 1
+
+        if count:
+            positions = self._position + np.arange(count, dtype=np.int64) * down
+            phase = positions % up
+            base = positions // up + (self.taps_per_phase - 1)
+            window = buf[base[:, None] - self._taps[None, :]]
+            out = np.einsum('ij,ij->i', window, self._phases[phase])
+        else:
+            out = np.empty(0, dtype=np.float32)
+
+        self._position += count * down - up * samples.size
+        self._history = buf[-(self.taps_per_phase - 1):]
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16)
+
+
+class VoiceActivityDetector:
+    """
+    Легкий детектор речевой активности для отсечения тишины перед Vosk.
+
+    Каждый блок режется на кадры по `frame_ms`; для кадров векторно считаются
+    энергия (dBFS) и доля переходов через ноль. Кадр считается речевым, если
+    энергия выше адаптивного порога шума на `margin_db` и сигнал не похож
+    на широкополосный шум (высокий ZCR при небольшой энергии). После речи
+    детектор удерживает состояние еще `hangover_ms`, а блоки тишины перед
+    началом фразы (`preroll_ms`) отдает вместе с первым речевым блоком,
+    чтобы не срезать начало слова.
+    """
+
+    def __init__(self, sample_rate: int, frame_ms: int = 20, margin_db: float = 9.0, min_speech_db: float = -55.0,
+                 zcr_max: float = 0.35, hangover_ms: int = 500, preroll_ms: int = 300):
+        self.sample_rate = sample_rate
+        self.frame_len = max(1, sample_rate * frame_ms // 1000)
+        self.margin_db = margin_db
+        self.min_speech_db = min_speech_db
+        self.zcr_max = zcr_max
+        self.hangover_samples = sample_rate * hangover_ms // 1000
+        self.preroll_samples = sample_rate * preroll_ms // 1000
+        self.noise_floor_db = -60.0
+        self.in_speech = False
+        self._silence_run = 0
+        self._preroll = []
+        self._preroll_len = 0
+        self.total_samples = 0
+        self.decoded_samples = 0
+
+    @property
+    def skipped_fraction(self) -> float:
+        """Доля аудио, которая не была отдана распознавателю."""
+        if not self.total_samples:
+            return 0.0
+        return 1.0 - self.decoded_samples / self.total_samples
+
+    def _frame_features(self, samples: np.ndarray):
+        n = samples.size // self.frame_len
+        if n == 0:
+            frames = samples[None, :]
+        else:
+            frames = samples[:n * self.frame_len].reshape(n, self.frame_len)
+        x = frames.astype(np.float32)
+        energy_db = 10.0 * np.log10(np.mean(x * x, axis=1) / (32768.0 * 32768.0) + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / max(1, frames.shape[1] - 1)
+        return energy_db, zcr
+
+    def _is_voiced(self, samples: np.ndarray) -> bool:
+        energy_db, zcr = self._frame_features(samples)
+        threshold = max(self.noise_floor_db + self.margin_db, self.min_speech_db)
+        loud = energy_db > threshold
+        voiced = loud & ((zcr < self.zcr_max) | (energy_db > threshold + self.margin_db))
+
+        # Порог шума быстро опускается и медленно поднимается по неречевым кадрам
+        quiet = energy_db[~voiced]
+        if quiet.size:
+            level = float(quiet.mean())
+            alpha = 0.3 if level < self.noise_floor_db else 0.02
+            self.noise_floor_db += alpha * (level - self.noise_floor_db)
+        return bool(voiced.any())
+
+    def process(self, samples):
+        """
+        Принимает моно int16 блок и возвращает (blocks, event), где `blocks` -
+        список блоков, которые нужно подать в распознаватель (пустой для тишины),
+        а `event` - 'start', 'end' или None на границах речи.
+        """
+        samples = as_int16_array(samples)
+        self.total_samples += samples.size
+        voiced = self._is_voiced(samples) if samples.size else False
+
+        if self.in_speech:
+            self.decoded_samples += samples.size
+            if voiced:
+                self._silence_run = 0
+                return [samples], None
+            self._silence_run += samples.size
+            if self._silence_run >= self.hangover_samples:
+                self.in_speech = False
+                self._silence_run = 0
+                return [samples], 'end'
+            return [samples], None
+
+        if voiced:
+            blocks = self._preroll + [samples]
+            self.decoded_samples += self._preroll_len + samples.size
+            self._preroll = []
+            self._preroll_len = 0
+            self.in_speech = True
+            self._silence_run = 0
+            return blocks, 'start'
+
+        # Тишина: держим короткий хвост для preroll, остальное пропускаем
+        self._preroll.append(samples)
+        self._preroll_len += samples.size
+        while self._preroll and self._preroll_len - self._preroll[0].size >= self.preroll_samples:
+            self._preroll_len -= self._preroll.pop(0).size
+        return [], None
+
+
+# Частоты DTMF (ITU-T Q.23): строка клавиатуры - нижняя группа, столбец - верхняя
+DTMF_ROW_FREQS = (697.0, 770.0, 852.0, 941.0)
+DTMF_COL_FREQS = (1209.0, 1336.0, 1477.0, 1633.0)
+DTMF_KEYS = ("123A", "456B", "789C", "*0#D")
+DTMF_RATE = 8000 # Детектор работает на узкой полосе, вход приводится к ней
+DTMF_BLOCK = 102 # Отсчетов на блок Goertzel (12.75 мс): разрешение ~78 Гц, соседние частоты различимы
+
+
+class DtmfDetector:
+    """
+    Детектор тональных DTMF в звуке звонка на банке фильтров Goertzel.
+
+    Вход приводится к 8 кГц и режется на блоки по DTMF_BLOCK отсчетов. Для
+    всех блоков сразу мощность на восьми частотах DTMF считается одним
+    матричным умножением на заранее посчитанные cos/sin опорные сигналы -
+    это тот же результат, что дает рекурсия Goertzel на каждой частоте, но
+    без цикла по отсчетам в Python. Блок дает цифру, если:
+      - оба тона громче `min_level_dbfs`;
+      - в каждой группе тон сильнее остальных частот группы на `peak_ratio_db`;
+      - перекос уровней (twist) в пределах `max_twist_db` (верхняя группа
+        слабее) и `max_reverse_twist_db` (нижняя слабее);
+      - два тона несут не меньше `min_tone_fraction` энергии блока (речь
+        и музыка эту проверку не проходят).
+    Цифра выдается, когда одна и та же клавиша держится в нескольких блоках
+    подряд (по `min_tone_ms`; при 40 мс - два блока: тон 40 мс проходит
+    всегда, короче 15 мс - никогда). Та же клавиша снова выдается только
+    после паузы не короче `min_pause_ms`.
+    """
+
+    def __init__(self, sample_rate: int, min_tone_ms: int = 40, min_pause_ms: int = 40, min_level_dbfs: float = -36.0,
+                 peak_ratio_db: float = 8.0, max_twist_db: float = 8.0, max_reverse_twist_db: float = 4.0,
+                 min_tone_fraction: float = 0.5):
+        self.sample_rate = sample_rate
+        self._resampler = PolyphaseResampler(sample_rate, DTMF_RATE) if sample_rate != DTMF_RATE else None
+        t = np.arange(DTMF_BLOCK) / DTMF_RATE
+        freqs = np.array(DTMF_ROW_FREQS + DTMF_COL_FREQS)
+        phase = 2.0 * math.pi * freqs[None, :] * t[:, None]
+        self._basis = np.hstack([np.cos(phase), np.sin(phase)]).astype(np.float32) # (N, 16)
+        block_ms = DTMF_BLOCK * 1000.0 / DTMF_RATE
+        # Тон длиной min_tone_ms целиком накрывает не меньше (min_tone_ms / block_ms - 1) блоков
+        self.min_blocks = max(2, int(min_tone_ms / block_ms) - 1)
+        self.min_pause_blocks = max(1, int(min_pause_ms / block_ms) - 1)
+        # Амплитуда^2 синусоиды на уровне min_level_dbfs
+        self.min_power = (32768.0 * 10.0 ** (min_level_dbfs / 20.0)) ** 2
+        self.peak_ratio = 10.0 ** (peak_ratio_db / 10.0)
+        self.max_twist = 10.0 ** (max_twist_db / 10.0)
+        self.max_reverse_twist = 10.0 ** (max_reverse_twist_db / 10.0)
+        self.min_tone_fraction = min_tone_fraction
+        self._pending = np.empty(0, dtype=np.float32)
+        self._blocks = 0 # Номер следующего блока от начала потока
+        self._key = None # Клавиша в текущей серии блоков
+        self._run = 0 # Длина серии
+        self._reported = None # Выданная клавиша, которая еще звучит
+        self._gap = self.min_pause_blocks # Блоков без тона с момента последней выдачи
+
+    def _block_keys(self, blocks: np.ndarray) -> list:
+        """Клавиша (или None) для каждого блока (M, DTMF_BLOCK)."""
+        projection = blocks @ self._basis
+        # |X|^2 * 4 / N^2 - квадрат амплитуды синусоиды на частоте бина
+        power = (projection[:, :8] ** 2 + projection[:, 8:] ** 2) * (4.0 / (DTMF_BLOCK * DTMF_BLOCK))
+        rows, cols = power[:, :4], power[:, 4:]
+        row = rows.argmax(axis=1)
+        col = cols.argmax(axis=1)
+        index = np.arange(blocks.shape[0])
+        row_power = rows[index, row]
+        col_power = cols[index, col]
+        rows_sorted = np.sort(rows, axis=1)
+        cols_sorted = np.sort(cols, axis=1)
+        mean_square = np.mean(blocks * blocks, axis=1) + 1e-9
+        valid = ((row_power >= self.min_power) & (col_power >= self.min_power)
+                 & (row_power >= rows_sorted[:, -2] * self.peak_ratio) & (col_power >= cols_sorted[:, -2] * self.peak_ratio)
+                 & (row_power <= col_power * self.max_twist) & (col_power <= row_power * self.max_reverse_twist)
+                 & ((row_power + col_power) / 2.0 >= mean_square * self.min_tone_fraction))
+        return [DTMF_KEYS[r][c] if ok else None for r, c, ok in zip(row.tolist(), col.tolist(), valid.tolist())]
+
+    def process(self, samples) -> list:
+        """
+        Принимает моно int16 блок любой длины и возвращает список (digit, seconds),
+        где seconds - время начала тона от начала потока.
+        """
+        samples = as_int16_array(samples)
+        if self._resampler is not None:
+            samples = self._resampler.process(samples)
+        data = np.concatenate([self._pending, samples.astype(np.float32)]) if self._pending.size else samples.astype(np.float32)
+        count = data.size // DTMF_BLOCK
+        self._pending = data[count * DTMF_BLOCK:]
+        if not count:
+            return []
+
+        events = []
+        for key in self._block_keys(data[:count * DTMF_BLOCK].reshape(count, DTMF_BLOCK)):
+            if key is not None and key == self._key:
+                self._run += 1
+            else:
+                self._key = key
+                self._run = 1
+            if key is None:
+                self._gap += 1
+                if self._gap >= self.min_pause_blocks:
+                    self._reported = None
+            elif key != self._reported and self._run >= self.min_blocks and (self._reported is not None or self._gap >= self.min_pause_blocks):
+                start_block = self._blocks - self._run + 1
+                events.append((key, start_block * DTMF_BLOCK / DTMF_RATE))
+                self._reported = key
+                self._gap = 0
+            elif key == self._reported:
+                self._gap = 0
+            self._blocks += 1
+        return events
+
+
+# Тоны хода соединения: семейство -> частоты (Гц). Станционный тон - одиночный 400-450 Гц
+# (Европа, Россия, Великобритания) или пара 480+620 Гц (Северная Америка).
+PROGRESS_TONES = (
+    ("progress", (400.0, 425.0, 450.0)),
+    ("sit1", (913.8, 985.2)), # Три сегмента SIT (ITU-T Q.35 / Telcordia)
+    ("sit2", (1370.6, 1428.5)),
+    ("sit3", (1776.7,)),
+    ("cng", (1100.0,)), # Вызывающий факс: 0.5 с тон / 3 с пауза
+    ("ced", (2100.0,)), # Отвечающий факс/модем: непрерывный тон 2.6-4 с
+)
+PROGRESS_PAIR = (480.0, 620.0)
+PROGRESS_BLOCK = 160 # 20 мс на 8 кГц: шаг измерения каденции
+# Каденции (мс): занято - 0.35-0.5 с тон / пауза, перегрузка - 0.17-0.3 с
+BUSY_ON_MS = (310, 650)
+BUSY_OFF_MS = (290, 650)
+CONGESTION_ON_MS = (140, 310)
+CONGESTION_OFF_MS = (140, 400)
+SIT_SEGMENT_MS = (200, 450)
+CNG_ON_MS = (400, 700)
+CED_MIN_MS = 1500
+
+
+class CallProgressDetector:
+    """
+    Классификатор тонов хода соединения: занято, перегрузка (reorder), SIT,
+    факс CNG и CED.
+
+    Как и DtmfDetector, работает на 8 кГц и считает мощность на всех
+    частотах PROGRESS_TONES сразу для всех 20-мс блоков одним матричным
+    умножением. Блок получает метку семейства, если его тон громче
+    `min_level_dbfs` и несет не меньше `min_tone_fraction` энергии блока,
+    иначе - 'off'. Из серий одинаковых меток складываются сегменты, и по
+    последним сегментам распознаются каденции: два тона занятости или три
+    тона перегрузки с паузами, три сегмента SIT подряд, посылка CNG,
+    непрерывный CED. process() возвращает [(вид, секунды)], вид - 'busy',
+    'congestion', 'sit', 'fax-cng' или 'fax-ced'.
+    """
+
+    def __init__(self, sample_rate: int, min_level_dbfs: float = -40.0, min_tone_fraction: float = 0.6):
+        self.sample_rate = sample_rate
+        self._resampler = PolyphaseResampler(sample_rate, DTMF_RATE) if sample_rate != DTMF_RATE else None
+        freqs = [freq for _, family in PROGRESS_TONES for freq in family] + list(PROGRESS_PAIR)
+        t = np.arange(PROGRESS_BLOCK) / DTMF_RATE
+        phase = 2.0 * math.pi * np.array(freqs)[None, :] * t[:, None]
+        self._basis = np.hstack([np.cos(phase), np.sin(phase)]).astype(np.float32)
+        self._columns = []
+        column = 0
+        for name, family in PROGRESS_TONES:
+            self._columns.append((name, column, column + len(family)))
+            column += len(family)
+        self._pair_column = column
+        self._bins = len(freqs)
+        self.min_power = (32768.0 * 10.0 ** (min_level_dbfs / 20.0)) ** 2
+        self.min_tone_fraction = min_tone_fraction
+        self.block_ms = PROGRESS_BLOCK * 1000 // DTMF_RATE
+        self._pending = np.empty(0, dtype=np.float32)
+        self._blocks = 0
+        self._label = None # Метка текущей серии блоков
+        self._run = 0
+        self._segments = [] # Закрытые сегменты [(метка, мс)], последние несколько
+        self._reported = set() # Что уже выдано в текущей серии (для CED, пока тон продолжается)
+
+    def _block_labels(self, blocks: np.ndarray) -> list:
+        projection = blocks @ self._basis
+        power = (projection[:, :self._bins] ** 2 + projection[:, self._bins:] ** 2) * (4.0 / (PROGRESS_BLOCK * PROGRESS_BLOCK))
+        names = [name for name, _, _ in self._columns]
+        family_power = np.stack([power[:, start:end].max(axis=1) for _, start, end in self._columns], axis=1)
+        # Пара 480+620 Гц засчитывается станционному тону, только если слышны обе частоты
+        pair = power[:, self._pair_column:self._pair_column + 2]
+        pair_power = np.where(pair.min(axis=1) >= self.min_power, pair.sum(axis=1), 0.0)
+        family_power[:, 0] = np.maximum(family_power[:, 0], pair_power)
+        best = family_power.argmax(axis=1)
+        best_power = family_power[np.arange(blocks.shape[0]), best]
+        mean_square = np.mean(blocks * blocks, axis=1) + 1e-9
+        tonal = (best_power >= self.min_power) & (best_power / 2.0 >= mean_square * self.min_tone_fraction)
+        return [names[b] if ok else "off" for b, ok in zip(best.tolist(), tonal.tolist())]
+
+    def _close_run(self):
+        if self._label is None:
+            return
+        self._segments.append((self._label, self._run * self.block_ms))
+        del self._segments[:-8]
+        self._reported.clear()
+
+    def _cadence(self, on_ms, off_ms, cycles):
+        """Последние сегменты - `cycles` тонов 'progress' с паузами 'off' между ними."""
+        tail = self._segments[-(2 * cycles - 1):]
+        if len(tail) < 2 * cycles - 1:
+            return False
+        for index, (label, ms) in enumerate(tail):
+            expected, (low, high) = ("progress", on_ms) if index % 2 == 0 else ("off", off_ms)
+            if label != expected or not low <= ms <= high:
+                return False
+        return True
+
+    def _classify(self):
+        """Вид тона по сегментам и текущей серии или None."""
+        label, run_ms = self._label, self._run * self.block_ms
+        if label == "ced" and run_ms >= CED_MIN_MS:
+            return "fax-ced"
+        if label == "sit3" and run_ms >= SIT_SEGMENT_MS[0]:
+            # Короткие провалы на стыках сегментов не считаем
+            previous = [segment for segment in self._segments if not (segment[0] == "off" and segment[1] <= 2 * self.block_ms)][-2:]
+            if [name for name, _ in previous] == ["sit1", "sit2"] and all(SIT_SEGMENT_MS[0] <= ms <= SIT_SEGMENT_MS[1] for _, ms in previous):
+                return "sit"
+        if label != "off" or not self._segments:
+            return None
+        # Серия тишины только что началась: проверяем закрытый перед ней тон
+        last_label, last_ms = self._segments[-1]
+        if last_label == "cng" and CNG_ON_MS[0] <= last_ms <= CNG_ON_MS[1]:
+            return "fax-cng"
+        if last_label == "progress":
+            if self._cadence(CONGESTION_ON_MS, CONGESTION_OFF_MS, 3):
+                return "congestion"
+            if self._cadence(BUSY_ON_MS, BUSY_OFF_MS, 2):
+                return "busy"
+        return None
+
+    def process(self, samples) -> list:
+        """Принимает моно int16 блок любой длины; возвращает [(вид, секунды от начала потока)]."""
+        samples = as_int16_array(samples)
+        if self._resampler is not None:
+            samples = self._resampler.process(samples)
+        data = np.concatenate([self._pending, samples.astype(np.float32)]) if self._pending.size else samples.astype(np.float32)
+        count = data.size // PROGRESS_BLOCK
+        self._pending = data[count * PROGRESS_BLOCK:]
+        if not count:
+            return []
+
+        events = []
+        for label in self._block_labels(data[:count * PROGRESS_BLOCK].reshape(count, PROGRESS_BLOCK)):
+            self._blocks += 1
+            if label == self._label:
+                self._run += 1
+            else:
+                self._close_run()
+                self._label = label
+                self._run = 1
+            kind = self._classify()
+            if kind is not None and kind not in self._reported:
+                events.append((kind, self._blocks * self.block_ms / 1000.0))
+                self._reported.add(kind)
+                if kind != "fax-ced":
+                    self._segments.clear() # Следующая выдача - только по новой каденции
+        return events
+
+
+class AnsweringMachineDetector:
+    """
+    Определение автоответчика по первым секундам ответившего звонка (как
+    app_amd в Asterisk): человек говорит короткое "алло" и ждет, автоответчик
+    сразу произносит длинное приветствие.
+
+    Звук режется на кадры `frame_ms`; кадр речевой, если его энергия выше
+    адаптивного порога шума на `margin_db` (и не ниже `min_speech_db`), а
+    сам он не похож на широкополосный шум (ZCR, как в VoiceActivityDetector).
+    Речевые серии от `min_word_ms`, разделенные паузами от
+    `between_words_ms`, считаются словами. Решение ('human' или 'machine',
+    причина):
+      - тишина с ответа дольше `initial_silence_ms` - machine/initial-silence;
+      - речи с начала приветствия больше `greeting_ms` - machine/long-greeting;
+      - слов больше `max_words` - machine/max-words;
+      - после слов пауза `after_greeting_ms` - human/short-greeting;
+      - сигнал автоответчика (beep) раньше решения - machine/beep;
+      - за `total_ms` решения нет - human/timeout (лучше сказать человеку
+        полное сообщение, чем промолчать).
+    Кроме того, детектор ищет beep - чистый тон от `beep_min_ms` в полосе
+    300-3400 Гц: после решения machine это сигнал, что можно говорить. Если
+    beep не прозвучал за `beep_timeout_ms`, выдается ('beep', 'timeout').
+    process() возвращает [(вид, причина, секунды)], вид - 'human', 'machine'
+    или 'beep'.
+    """
+
+    def __init__(self, sample_rate: int, frame_ms: int = 20, margin_db: float = 12.0, min_speech_db: float = -45.0,
+                 zcr_max: float = 0.35, initial_silence_ms: int = 2500, greeting_ms: int = 1500, after_greeting_ms: int = 800,
+                 min_word_ms: int = 100, between_words_ms: int = 50, max_words: int = 3, total_ms: int = 5000,
+                 beep_min_ms: int = 100, beep_timeout_ms: int = 20000, beep_tone_fraction: float = 0.8):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_len = max(1, sample_rate * frame_ms // 1000)
+        self.margin_db = margin_db
+        self.min_speech_db = min_speech_db
+        self.zcr_max = zcr_max
+        self.initial_silence_ms = initial_silence_ms
+        self.greeting_ms = greeting_ms
+        self.after_greeting_ms = after_greeting_ms
+        self.min_word_ms = min_word_ms
+        self.between_words_ms = between_words_ms
+        self.max_words = max_words
+        self.total_ms = total_ms
+        self.beep_frames = max(2, beep_min_ms // frame_ms)
+        self.beep_timeout_ms = beep_timeout_ms
+        self.beep_tone_fraction = beep_tone_fraction
+        freqs = np.fft.rfftfreq(self.frame_len, 1.0 / sample_rate)
+        self._band = (freqs >= 300.0) & (freqs <= 3400.0)
+        self.noise_floor_db = -60.0
+        self.result = None # ('human'|'machine', причина), когда решение принято
+        self.beep = None # 'detected' или 'timeout'
+        self._pending = np.empty(0, dtype=np.int16)
+        self._elapsed_ms = 0
+        self._decided_ms = None
+        self._voice_ms = 0 # Текущая речевая серия
+        self._silence_ms = 0 # Текущая пауза
+        self._greeting_ms = 0 # Речь с первого слова
+        self._words = 0
+        self._in_word = False
+        self._beep_bin = None
+        self._beep_run = 0
+
+    @property
+    def done(self) -> bool:
+        return self.result is not None and self.beep is not None
+
+    def _frame_features(self, frames: np.ndarray):
+        x = frames.astype(np.float32)
+        energy_db = 10.0 * np.log10(np.mean(x * x, axis=1) / (32768.0 * 32768.0) + 1e-10)
+        spectrum = np.abs(np.fft.rfft(x, axis=1)) ** 2
+        spectrum[:, ~self._band] = 0.0
+        peak = spectrum.argmax(axis=1)
+        # Чистый тон: пик с соседними бинами несет почти всю энергию кадра
+        padded = np.pad(spectrum, ((0, 0), (1, 1)))
+        index = np.arange(frames.shape[0])
+        peak_power = padded[index, peak] + padded[index, peak + 1] + padded[index, peak + 2]
+        total = spectrum.sum(axis=1) + 1e-9
+        tonal = (peak_power >= total * self.beep_tone_fraction) & (energy_db > self.min_speech_db)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / max(1, frames.shape[1] - 1)
+        return energy_db, zcr, tonal, peak
+
+    def _decide(self, result, reason, events):
+        self.result = (result, reason)
+        self._decided_ms = self._elapsed_ms
+        events.append((result, reason, self._elapsed_ms / 1000.0))
+        if result == "human":
+            self.beep = "skipped" # Человеку beep не нужен, дальше не ищем
+
+    def _step(self, energy_db, zcr, tonal, peak, events):
+        self._elapsed_ms += self.frame_ms
+        threshold = max(self.noise_floor_db + self.margin_db, self.min_speech_db)
+        # Как в VoiceActivityDetector: широкополосный шум (высокий ZCR) речью не считается
+        voiced = energy_db > threshold and (zcr < self.zcr_max or energy_db > threshold + self.margin_db)
+        if not voiced:
+            alpha = 0.3 if energy_db < self.noise_floor_db else 0.02
+            self.noise_floor_db += alpha * (energy_db - self.noise_floor_db)
+
+        if self.beep is None:
+            if tonal and self._beep_bin is not None and abs(peak - self._beep_bin) <= 1:
+                self._beep_run += 1
+            else:
+                self._beep_bin = peak if tonal else None
+                self._beep_run = 1 if tonal else 0
+            if self._beep_run >= self.beep_frames:
+                if self.result is None:
+                    self._decide("machine", "beep", events)
+                self.beep = "detected"
+                events.append(("beep", "detected", self._elapsed_ms / 1000.0))
+                return
+            if self._decided_ms is not None and self._elapsed_ms - self._decided_ms >= self.beep_timeout_ms:
+                self.beep = "timeout"
+                events.append(("beep", "timeout", self._elapsed_ms / 1000.0))
+                return
+
+        if self.result is not None:
+            return
+        if voiced:
+            self._silence_ms = 0
+            self._voice_ms += self.frame_ms
+            if self._words:
+                self._greeting_ms += self.frame_ms
+            if not self._in_word and self._voice_ms >= self.min_word_ms:
+                self._in_word = True
+                self._words += 1
+                if self._words == 1:
+                    self._greeting_ms = self._voice_ms # Приветствие отсчитывается с начала первого слова
+                if self._words > self.max_words:
+                    return self._decide("machine", "max-words", events)
+            if self._greeting_ms >= self.greeting_ms:
+                return self._decide("machine", "long-greeting", events)
+        else:
+            self._silence_ms += self.frame_ms
+            if self._silence_ms >= self.between_words_ms:
+                self._in_word = False
+                self._voice_ms = 0
+            if not self._words and self._silence_ms >= self.initial_silence_ms:
+                return self._decide("machine", "initial-silence", events)
+            if self._words and self._silence_ms >= self.after_greeting_ms:
+                return self._decide("human", "short-greeting", events)
+        if self._elapsed_ms >= self.total_ms:
+            self._decide("human", "timeout", events)
+
+    def process(self, samples) -> list:
+        """Принимает моно int16 блок; возвращает [(вид, причина, секунды с ответа)]."""
+        if self.done:
+            return []
+        samples = as_int16_array(samples)
+        data = np.concatenate([self._pending, samples]) if self._pending.size else samples
+        count = data.size // self.frame_len
+        self._pending = data[count * self.frame_len:].copy()
+        if not count:
+            return []
+        features = self._frame_features(data[:count * self.frame_len].reshape(count, self.frame_len))
+        events = []
+        for frame_energy, frame_zcr, frame_tonal, frame_peak in zip(*(feature.tolist() for feature in features)):
+            self._step(frame_energy, frame_zcr, frame_tonal, frame_peak, events)
+            if self.done:
+                break
+        return events
+
+
+class CaptureRingBuffer:
+    """
+    Кольцевой буфер захвата фиксированной емкости, выделенный заранее.
+
+    Callback звукового устройства копирует блок прямо в массив буфера
+    (без bytes()/copy() и без роста памяти), потребитель забирает все
+    накопленные кадры одним read(). Если декодирование отстает и буфер
+    полон, срабатывает политика `policy` и растут счетчики переполнений.
+    """
+
+    def __init__(self, sample_rate: int, channels: int = 1, capacity_ms: int = 5000,
+                 policy: str = OVERFLOW_DROP_OLDEST, dtype=np.int16):
+        if policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_SKIP_TO_LIVE):
+            raise ValueError(f"Неизвестная политика переполнения: {policy}")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.capacity = max(1, sample_rate * capacity_ms // 1000)
+        self.policy = policy
+        self._buffer = np.zeros((self.capacity, channels), dtype=dtype)
+        self._read = 0 # Абсолютные номера кадров: позиция в массиве - номер % capacity
+        self._write = 0
+        self._cond = threading.Condition()
+        self.overruns = 0
+        self.dropped_frames = 0
+
+    @property
+    def lag_ms(self) -> float:
+        """Сколько звука (мс) накоплено и еще не забрано потребителем."""
+        return (self._write - self._read) * 1000.0 / self.sample_rate
+
+    def _copy_in(self, block, start):
+        first = min(block.shape[0], self.capacity - start)
+        self._buffer[start:start + first] = block[:first]
+        self._buffer[:block.shape[0] - first] = block[first:]
+
+    def write(self, block: np.ndarray):
+        """Вызывается из callback'а устройства: копирует блок (frames[, channels]) в буфер."""
+        block = block.reshape(block.shape[0], -1)
+        frames = block.shape[0]
+        with self._cond:
+            if frames > self.capacity:
+                self.dropped_frames += frames - self.capacity
+                block = block[-self.capacity:]
+                frames = self.capacity
+            free = self.capacity - (self._write - self._read)
+            if frames > free:
+                self.overruns += 1
+                if self.policy == OVERFLOW_SKIP_TO_LIVE:
+                    drop = self._write - self._read
+                else:
+                    drop = frames - free
+                self._read += drop
+                self.dropped_frames += drop
+            self._copy_in(block, self._write % self.capacity)
+            self._write += frames
+            self._cond.notify()
+
+    def read(self, timeout: float = None):
+        """
+        Забирает все накопленные кадры массивом (frames, channels).
+        Ждет данных не дольше `timeout`; если их нет - возвращает None.
+        """
+        with self._cond:
+            if self._write == self._read:
+                self._cond.wait(timeout)
+                if self._write == self._read:
+                    return None
+            frames = self._write - self._read
+            start = self._read % self.capacity
+            first = min(frames, self.capacity - start)
+            out = np.empty((frames, self.channels), dtype=self._buffer.dtype)
+            out[:first] = self._buffer[start:start + first]
+            out[first:] = self._buffer[:frames - first]
+            self._read += frames
+        return out
@@ -13,5 +13,5 @@ sleep 2
 pactl load-module module-null-sink sink_name=virtual_sorc sink_properties=device.description="Virtual_sorc"
 pactl set-default-source virtual_sorc.monitor
 # paplay '/app/song.wav' --device=virtual_sorc
-python3 websok.py & python3 _vosk_loop.py --model /app/vosk-model-ru-0.42 -d 1
+python3 websok.py & python3 recognition_supervisor.py --service --model /app/vosk-model-ru-0.42 --fallback-model /app/vosk-model-small-ru-0.22
 # sleep 10000
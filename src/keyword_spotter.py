@@ -0,0 +1,143 @@
+# keyword_spotter.py
+"""
+Поиск ключевых слов и тревожных фраз в потоке результатов распознавания.
+
+Все фразы собираются в автомат Ахо-Корасик, поэтому текст просматривается
+за один проход независимо от числа фраз. Частичный результат Vosk растет
+по мере речи: если новый partial продолжает уже просмотренный текст,
+автомат продолжает работу с сохраненного состояния и обрабатывает только
+добавленный хвост. Если распознаватель переписал начало фразы, текст
+просматривается заново, но уже найденные в этой фразе слова повторно
+не сообщаются.
+"""
+import re
+from collections import deque
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр, ё -> е, знаки препинания и повторные пробелы -> один пробел."""
+    text = _NON_WORD.sub(" ", text.lower().replace("ё", "е"))
+    return " ".join(text.split())
+
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик по набору фраз; совпадения только по границам слов."""
+
+    def __init__(self, keywords):
+        self.keywords = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for keyword in keywords:
+            normalized = normalize_text(keyword)
+            if normalized and normalized not in self.keywords:
+                self.keywords.append(normalized)
+                # Ведущий пробел привязывает начало фразы к началу слова
+                self._add(" " + normalized, normalized)
+        self._build()
+
+    def _add(self, pattern, keyword):
+        state = 0
+        for ch in pattern:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append(keyword)
+
+    def _build(self):
+        # Обход в ширину: ссылка неудачи узла - самый длинный собственный суффикс, который есть в боре
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, nxt in self._goto[state].items():
+                pending.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0) if state else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def scan(self, text, start=0, state=0):
+        """
+        Просматривает text[start:] с состояния `state`.
+        Возвращает (новое состояние, [(индекс конца совпадения, фраза), ...]).
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        matches = []
+        for i in range(start, len(text)):
+            ch = text[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                matches.extend((i, keyword) for keyword in out[state])
+        return state, matches
+
+
+class _StreamState:
+    def __init__(self):
+        self.text = ""
+        self.state = 0
+        self.reported = set()
+
+
+class KeywordSpotter:
+    """
+    Инкрементальный поиск фраз по потокам распознавания.
+
+    `update()` вызывается для каждого partial и final потока и возвращает
+    фразы, впервые встреченные в текущем высказывании. На final состояние
+    потока сбрасывается.
+    """
+
+    def __init__(self, keywords):
+        self.automaton = KeywordAutomaton(keywords)
+        self._streams = {}
+
+    @property
+    def keywords(self):
+        return list(self.automaton.keywords)
+
+    def _matches(self, stream, text):
+        if text.startswith(stream.text):
+            # Partial вырос: продолжаем с сохраненного состояния только по новому хвосту
+            start, state = len(stream.text), stream.state
+        else:
+            start, state = 0, 0
+        state, matches = self.automaton.scan(text, start, state)
+        stream.text, stream.state = text, state
+        found = []
+        for end, keyword in matches:
+            after = end + 1
+            if after < len(text) and text[after] != " ":
+                continue # Фраза - начало более длинного слова ("пожар" в "пожарный")
+            if keyword not in stream.reported:
+                stream.reported.add(keyword)
+                found.append(keyword)
+        return found
+
+    def update(self, stream_id, text, final=False):
+        """Возвращает список новых фраз в тексте потока `stream_id`."""
+        if not self.automaton.keywords:
+            return []
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            stream = self._streams[stream_id] = _StreamState()
+        found = self._matches(stream, " " + normalize_text(text)) if text else []
+        if final:
+            del self._streams[stream_id]
+        return found
+
+    def reset(self, stream_id=None):
+        """Забывает состояние потока (или всех потоков)."""
+        if stream_id is None:
+            self._streams.clear()
+        else:
+            self._streams.pop(stream_id, None)
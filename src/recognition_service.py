@@ -0,0 +1,473 @@
+# recognition_service.py
+"""
+Сервис распознавания: одна загруженная модель Vosk обслуживает много
+одновременных потоков (звонков), у каждого из которых свой KaldiRecognizer.
+
+Модель - самая тяжелая часть (гигабайты для vosk-model-ru-0.42) и
+загружается один раз; на каждый поток приходится только состояние
+декодера. Декодирование выполняется в пуле потоков размером с число ядер:
+vosk отпускает GIL внутри Kaldi, поэтому потоки реально работают параллельно.
+Блоки одного потока всегда обрабатываются по порядку и не более чем одним
+рабочим потоком одновременно.
+
+Если задана запасная (малая) модель, каждый поток измеряет свой
+real-time factor (время декодирования / длительность аудио) и задержку
+очереди. Когда декодирование перестает успевать за реальным временем,
+новые фразы потока переводятся на малую модель; при появлении запаса
+мощности - возвращаются на основную. Обе модели остаются загруженными,
+переключение происходит только на границе фразы, а каждый результат
+помечается именем модели, которая его выдала.
+
+Поток можно перевести на ограниченную грамматику (список ожидаемых фраз:
+"да", "нет", цифры...) и обратно без перезагрузки модели: создается
+новый KaldiRecognizer над уже загруженной моделью. Грамматику
+поддерживают только модели с динамическим графом, поэтому при наличии
+малой модели грамматические распознаватели строятся на ней.
+
+Частичные результаты запрашиваются у декодера не чаще `partial_rate` раз
+в секунду; повторы отбрасываются, а в событии передается только
+изменившийся хвост ("offset" - длина общего начала с прошлым partial,
+"delta" - новый текст после него). При нулевой частоте PartialResult()
+не вызывается вовсе.
+
+Для быстрой смены реплик поток может завершать фразу раньше эндпоинтера
+Kaldi: если partial не меняется `stable_ms` миллисекунд аудио, а энергия
+хвоста ниже `silence_db`, сразу отдается событие utterance_end, затем
+FinalResult() и сброс распознавателя.
+
+Очередь каждого потока ограничена `max_pending_ms` аудио. Если
+распознавание не успевает, лишний звук выбрасывается по политике
+переполнения (как в CaptureRingBuffer): drop_oldest - самые старые блоки,
+skip_to_live - весь накопленный хвост. Управляющие действия (грамматика,
+эндпоинтинг, закрытие) не выбрасываются никогда. Источник, который может
+подождать (прием потоков по TCP), вызывает feed() с `wait` и сначала
+ждет места в очереди, не читая сокет, - так задержка доходит до отправителя.
+"""
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from vosk import Model, KaldiRecognizer
+
+from audio_dsp import OVERFLOW_DROP_OLDEST, OVERFLOW_SKIP_TO_LIVE, PolyphaseResampler, VoiceActivityDetector, as_int16_array
+
+VOSK_MODEL_SAMPLE_RATE = 16000
+
+# Пороги переключения моделей (с гистерезисом)
+RTF_SWITCH_DOWN = 0.8 # RTF основной модели, выше которого переходим на малую
+LAG_SWITCH_DOWN = 1.5 # Задержка очереди (сек), выше которой переходим на малую
+RTF_SWITCH_UP = 0.5 # Прогнозируемый RTF основной модели, ниже которого возвращаемся
+LAG_SWITCH_UP = 0.3 # Задержка очереди (сек), ниже которой можно возвращаться
+METRICS_SMOOTHING = 0.2 # Коэффициент экспоненциального сглаживания RTF и задержки
+
+GRAMMAR_UNKNOWN = "[unk]" # Слово-заглушка для речи вне грамматики
+
+PARTIAL_RATE_DEFAULT = 5.0 # Частичных результатов в секунду на поток (0 - не запрашивать)
+
+PENDING_MAX_MS = 5000 # Больше этой задержки аудио в очереди потока не копится
+DRAIN_BATCH = 8 # Сколько элементов очереди поток обрабатывает, прежде чем уступить рабочий поток пула другим
+
+# Ранний эндпоинтинг (включается для потока через set_endpointing)
+ENDPOINT_STABLE_MS = 600 # Сколько мс аудио partial должен не меняться
+ENDPOINT_SILENCE_DB = -45.0 # Энергия хвоста (dBFS), ниже которой считаем, что говорящий замолчал
+ENDPOINT_TAIL_MS = 200 # По какому хвосту блока считается энергия
+ENDPOINT_POLL_INTERVAL = 0.1 # Как часто (сек) опрашивать partial для эндпоинтинга
+
+
+class RecognitionStream:
+    """Состояние распознавания одного потока: ресемплер, VAD и KaldiRecognizer."""
+
+    def __init__(self, service, stream_id, sample_rate, use_vad=True, tags=None):
+        self.service = service
+        self.stream_id = stream_id
+        self.sample_rate = sample_rate
+        self.tags = dict(tags or {})
+        self.resampler = PolyphaseResampler(sample_rate, service.model_rate)
+        self.vad = VoiceActivityDetector(service.model_rate) if use_vad else None
+        self.grammar = None
+        self.model_name = service.primary_model_name
+        self.recognizer = self._make_recognizer(self.model_name)
+        self.rtf = 0.0
+        self.queue_lag = 0.0
+        self.model_switches = 0
+        self.partials_sent = 0
+        self.endpointing = None # {"stable_ms": ..., "silence_db": ...} или None
+        self.early_endpoints = 0
+        self._partial = ""
+        self._partial_at = 0.0
+        self._audio_pos = 0.0 # Секунд аудио, отданных распознавателю
+        self._tail_db = 0.0
+        self._stable_text = ""
+        self._stable_since = 0.0
+        self._endpoint_polled_at = 0.0
+        self.closed = False
+        self.max_pending_samples = max(1, sample_rate * service.max_pending_ms // 1000)
+        self.overflows = 0
+        self.dropped_samples = 0
+        self._pending = deque()
+        self._pending_samples = 0
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._scheduled = False
+
+    def _make_recognizer(self, model_name):
+        model = self.service.models[model_name]
+        if self.grammar is None:
+            return KaldiRecognizer(model, self.service.model_rate)
+        return KaldiRecognizer(model, self.service.model_rate, json.dumps(self.grammar + [GRAMMAR_UNKNOWN], ensure_ascii=False))
+
+    def _strip_unknown(self, text):
+        if self.grammar is None:
+            return text
+        return " ".join(word for word in text.split() if word != GRAMMAR_UNKNOWN)
+
+    def _emit(self, event, text):
+        text = self._strip_unknown(text)
+        if not text:
+            return
+        result = {"event": event, "text": text, "stream": self.stream_id, "model": self.model_name}
+        result.update(self.tags)
+        self.service.on_result(result)
+
+    def _reset_utterance(self):
+        self._partial = ""
+        self._stable_text = ""
+        self._stable_since = self._audio_pos
+
+    def _emit_partial(self, text):
+        """Отдает partial, только если текст изменился (передается лишь новый хвост)."""
+        if not text or text == self._partial:
+            return
+        offset = len(os.path.commonprefix((self._partial, text)))
+        self._partial = text
+        self.partials_sent += 1
+        result = {"event": "recognition_partial", "offset": offset, "delta": text[offset:], "stream": self.stream_id, "model": self.model_name}
+        result.update(self.tags)
+        self.service.on_result(result)
+
+    def _check_endpoint(self, text):
+        """Завершает фразу досрочно, если partial устоялся, а хвост тихий. Возвращает True при завершении."""
+        if text != self._stable_text:
+            self._stable_text = text
+            self._stable_since = self._audio_pos
+            return False
+        if not text:
+            return False
+        if (self._audio_pos - self._stable_since) * 1000 < self.endpointing["stable_ms"] or self._tail_db > self.endpointing["silence_db"]:
+            return False
+        self.early_endpoints += 1
+        self._emit("utterance_end", text)
+        self._finalize("recognition_final")
+        return True
+
+    def _after_block(self):
+        """
+        После блока без законченной фразы опрашивает partial, если он нужен
+        подписчикам (не чаще partial_rate) или эндпоинтингу. Когда partial
+        не нужен никому, JSON декодера не запрашивается и не разбирается.
+        """
+        now = time.monotonic()
+        interval = self.service.partial_interval
+        want_emit = interval is not None and now - self._partial_at >= interval
+        want_endpoint = self.endpointing is not None and now - self._endpoint_polled_at >= ENDPOINT_POLL_INTERVAL
+        if not (want_emit or want_endpoint):
+            return
+        text = self._strip_unknown(json.loads(self.recognizer.PartialResult()).get('partial', ''))
+        if want_endpoint:
+            self._endpoint_polled_at = now
+            if self._check_endpoint(text):
+                return
+        if want_emit:
+            self._partial_at = now
+            self._emit_partial(text)
+
+    def _decode(self, samples):
+        samples = self.resampler.process(samples)
+        if self.vad is not None:
+            blocks, vad_event = self.vad.process(samples)
+        else:
+            blocks, vad_event = [samples], None
+
+        decoded_samples = 0
+        started = time.perf_counter()
+        for block in blocks:
+            decoded_samples += block.size
+            self._audio_pos += block.size / self.service.model_rate
+            if self.endpointing is not None and block.size:
+                tail = block[-self.service.model_rate * ENDPOINT_TAIL_MS // 1000:].astype(np.float32)
+                self._tail_db = 10.0 * math.log10(float(np.mean(tail * tail)) / (32768.0 * 32768.0) + 1e-10)
+            if self.recognizer.AcceptWaveform(block.tobytes()):
+                result = json.loads(self.recognizer.Result())
+                self._reset_utterance()
+                if result.get('text'):
+                    self._emit("recognition_final", result["text"])
+                # Фраза закончилась по эндпоинтеру Kaldi: следующая может пойти другой моделью
+                self._maybe_switch_model()
+            else:
+                self._after_block()
+        if decoded_samples:
+            rtf = (time.perf_counter() - started) / (decoded_samples / self.service.model_rate)
+            self.rtf += METRICS_SMOOTHING * (rtf - self.rtf)
+            self.service._observe_rtf(self.model_name, rtf)
+
+        # Конец речи по VAD: дожимаем фразу и сбрасываем декодер
+        if vad_event == 'end':
+            self._finalize("recognition_final")
+
+    def _finalize(self, event):
+        result = json.loads(self.recognizer.FinalResult())
+        if result.get('text'):
+            self._emit(event, result["text"])
+        self.recognizer.Reset()
+        self._reset_utterance()
+        self._maybe_switch_model()
+
+    def _maybe_switch_model(self):
+        """На границе фразы выбирает модель для следующей фразы по RTF и задержке очереди."""
+        service = self.service
+        if service.fallback_model_name is None or self.grammar is not None or self.closed:
+            return
+        target = self.model_name
+        if self.model_name == service.primary_model_name:
+            if self.rtf > RTF_SWITCH_DOWN or self.queue_lag > LAG_SWITCH_DOWN:
+                target = service.fallback_model_name
+        elif self.queue_lag < LAG_SWITCH_UP and service.projected_primary_rtf(self.rtf) < RTF_SWITCH_UP:
+            target = service.primary_model_name
+        if target == self.model_name:
+            return
+
+        print(f"[VOSK_SERVICE] Поток '{self.stream_id}': {self.model_name} -> {target} (RTF {self.rtf:.2f}, задержка {self.queue_lag:.2f} с)", file=sys.stderr)
+        self.recognizer = self._make_recognizer(target)
+        self.model_name = target
+        self.model_switches += 1
+        # Новая модель начинает с прогноза, а не с RTF предыдущей
+        self.rtf = service.model_rtf.get(target, 0.0)
+
+    def _apply_grammar(self, phrases):
+        """Переключает поток между грамматикой и открытым словарем на границе фразы."""
+        result = json.loads(self.recognizer.FinalResult())
+        self._reset_utterance()
+        if result.get('text'):
+            self._emit("recognition_final", result["text"])
+        self.grammar = phrases
+        if phrases is None:
+            target = self.service.primary_model_name
+        else:
+            target = self.service.fallback_model_name or self.service.primary_model_name
+        self.model_name = target
+        self.recognizer = self._make_recognizer(target)
+        mode = f"грамматика из {len(phrases)} фраз" if phrases is not None else "открытый словарь"
+        print(f"[VOSK_SERVICE] Поток '{self.stream_id}': {mode} (модель {target})", file=sys.stderr)
+
+    def _drain(self):
+        """
+        Выполняется в пуле: обрабатывает накопленные блоки по порядку. Поток,
+        чья очередь все время пополняется, после DRAIN_BATCH элементов встает
+        в конец очереди пула, чтобы не занимать рабочий поток бесконечно.
+        """
+        for _ in range(DRAIN_BATCH):
+            with self._lock:
+                if not self._pending:
+                    self._scheduled = False
+                    return
+                item, queued_at = self._pending.popleft()
+                if not callable(item):
+                    self._pending_samples -= item.size
+                    self._room.notify_all()
+            self.queue_lag += METRICS_SMOOTHING * (time.perf_counter() - queued_at - self.queue_lag)
+            try:
+                if callable(item):
+                    item() # Управляющие действия выполняются в порядке очереди потока
+                else:
+                    self._decode(item)
+            except Exception as e:
+                print(f"[VOSK_SERVICE_ERR] Ошибка распознавания в потоке '{self.stream_id}': {e}", file=sys.stderr)
+        try:
+            self.service.executor.submit(self._drain)
+        except RuntimeError:
+            self._drain() # Пул уже закрывается (shutdown): дорабатываем очередь в этом потоке
+
+    def _make_room(self, size):
+        """Выбрасывает блоки аудио из очереди по политике переполнения (вызывается под _lock)."""
+        excess = self._pending_samples + size - self.max_pending_samples
+        if excess <= 0:
+            return
+        self.overflows += 1
+        skip_to_live = self.service.overflow_policy == OVERFLOW_SKIP_TO_LIVE
+        kept = deque()
+        for entry in self._pending:
+            item = entry[0]
+            if not callable(item) and (skip_to_live or excess > 0):
+                excess -= item.size
+                self._pending_samples -= item.size
+                self.dropped_samples += item.size
+                continue
+            kept.append(entry)
+        self._pending = kept
+
+    def wait_for_room(self, size, timeout):
+        """Ждет, пока в очереди освободится место под `size` отсчетов. Возвращает False по таймауту."""
+        with self._room:
+            return self._room.wait_for(lambda: self.closed or self._pending_samples + size <= self.max_pending_samples, timeout)
+
+    @property
+    def pending_ms(self) -> float:
+        return self._pending_samples * 1000 / self.sample_rate
+
+    def _submit(self, item):
+        with self._lock:
+            if not callable(item):
+                self._make_room(item.size)
+                self._pending_samples += item.size
+            self._pending.append((item, time.perf_counter()))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.service.executor.submit(self._drain)
+
+
+class RecognitionService:
+    """
+    Держит модель (и, опционально, запасную малую) и набор потоков
+    распознавания, которые добавляются и удаляются по мере начала и
+    окончания звонков.
+
+    `on_result` вызывается из рабочих потоков пула со словарем события
+    (recognition_partial / utterance_end / recognition_final / recognition_final_on_stop),
+    помеченным идентификатором потока и именем модели.
+    """
+
+    def __init__(self, model_path, on_result, model_rate=VOSK_MODEL_SAMPLE_RATE, max_workers=None, fallback_model_path=None,
+                 partial_rate=PARTIAL_RATE_DEFAULT, model=None, fallback_model=None,
+                 max_pending_ms=PENDING_MAX_MS, overflow_policy=OVERFLOW_DROP_OLDEST):
+        if overflow_policy not in (OVERFLOW_DROP_OLDEST, OVERFLOW_SKIP_TO_LIVE):
+            raise ValueError(f"Неизвестная политика переполнения: {overflow_policy}")
+        self.model_path = model_path
+        self.model_rate = model_rate
+        self.max_pending_ms = max_pending_ms
+        self.overflow_policy = overflow_policy
+        self.on_result = on_result
+        self.partial_interval = None
+        self.set_partial_rate(partial_rate)
+        # Уже загруженные модели (например, супервизором до fork()) не загружаются повторно
+        self.model = model if model is not None else Model(model_path)
+        self.primary_model_name = os.path.basename(os.path.normpath(model_path))
+        self.models = {self.primary_model_name: self.model}
+        self.fallback_model_name = None
+        if fallback_model_path:
+            self.fallback_model_name = os.path.basename(os.path.normpath(fallback_model_path))
+            self.models[self.fallback_model_name] = fallback_model if fallback_model is not None else Model(fallback_model_path)
+            print(f"[VOSK_SERVICE] Запасная модель '{fallback_model_path}' загружена.", file=sys.stderr)
+        self.model_rtf = {}
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="vosk-worker")
+        self.streams = {}
+        self._lock = threading.Lock()
+        print(f"[VOSK_SERVICE] Модель '{model_path}' загружена, пул распознавания: {self.max_workers} потоков.", file=sys.stderr)
+
+    def add_stream(self, stream_id, sample_rate, use_vad=True, **tags) -> RecognitionStream:
+        """Создает поток распознавания (например, при начале звонка)."""
+        with self._lock:
+            if stream_id in self.streams:
+                raise ValueError(f"Поток распознавания '{stream_id}' уже существует")
+            stream = RecognitionStream(self, stream_id, sample_rate, use_vad=use_vad, tags=tags)
+            self.streams[stream_id] = stream
+        print(f"[VOSK_SERVICE] Добавлен поток '{stream_id}' ({sample_rate} Hz). Активных потоков: {len(self.streams)}", file=sys.stderr)
+        return stream
+
+    def remove_stream(self, stream_id):
+        """Завершает поток: незаконченная фраза отдается как recognition_final_on_stop."""
+        with self._lock:
+            stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return
+        stream.closed = True
+        with stream._room:
+            stream._room.notify_all() # Ждущий места в очереди источник больше не ждет
+        stream._submit(lambda: stream._finalize("recognition_final_on_stop"))
+        print(f"[VOSK_SERVICE] Поток '{stream_id}' удален. Активных потоков: {len(self.streams)}", file=sys.stderr)
+
+    def feed(self, stream_id, samples, wait=None):
+        """
+        Ставит блок моно int16 (на частоте потока) в очередь на распознавание.
+        С `wait` (сек) сначала ждет места в очереди и только по таймауту
+        выбрасывает звук по политике переполнения.
+        """
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.closed:
+            return
+        samples = as_int16_array(samples)
+        if wait:
+            stream.wait_for_room(samples.size, wait)
+        stream._submit(samples)
+
+    def set_grammar(self, stream_id, phrases=None):
+        """
+        Задает потоку список ожидаемых фраз (None - открытый словарь).
+        Текущая фраза завершается, модель не перезагружается.
+        """
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.closed:
+            return
+        if phrases is not None:
+            phrases = [p.strip().lower() for p in phrases if p and p.strip()] or None
+        stream._submit(lambda: stream._apply_grammar(phrases))
+
+    def set_partial_rate(self, rate):
+        """Максимум частичных результатов в секунду на поток; 0 - не запрашивать их вовсе."""
+        self.partial_interval = 1.0 / rate if rate and rate > 0 else None
+        print(f"[VOSK_SERVICE] Частота partial: {rate if self.partial_interval else 0}/с", file=sys.stderr)
+
+    def set_endpointing(self, stream_id, stable_ms=ENDPOINT_STABLE_MS, silence_db=ENDPOINT_SILENCE_DB):
+        """Включает ранний эндпоинтинг потока; stable_ms=None - только эндпоинтер Kaldi."""
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.closed:
+            return
+        settings = None if stable_ms is None else {"stable_ms": stable_ms, "silence_db": silence_db}
+
+        def apply():
+            stream.endpointing = settings
+            stream._reset_utterance()
+        stream._submit(apply)
+
+    def _observe_rtf(self, model_name, rtf):
+        """Сглаженный RTF по всем потокам для каждой модели (для прогноза при возврате)."""
+        previous = self.model_rtf.get(model_name)
+        self.model_rtf[model_name] = rtf if previous is None else previous + METRICS_SMOOTHING * (rtf - previous)
+
+    def projected_primary_rtf(self, fallback_rtf) -> float:
+        """Оценивает RTF основной модели по текущему RTF малой и их наблюдаемому соотношению."""
+        primary = self.model_rtf.get(self.primary_model_name)
+        fallback = self.model_rtf.get(self.fallback_model_name)
+        if not primary or not fallback:
+            return 0.0
+        return fallback_rtf * primary / fallback
+
+    def stats(self) -> dict:
+        with self._lock:
+            streams = list(self.streams.values())
+        return {
+            "streams": len(streams),
+            "workers": self.max_workers,
+            "pending_blocks": sum(len(s._pending) for s in streams),
+            "overflow_policy": self.overflow_policy,
+            "model_rtf": {name: round(rtf, 3) for name, rtf in self.model_rtf.items()},
+            "partial_rate": round(1.0 / self.partial_interval, 2) if self.partial_interval else 0,
+            "per_stream": {
+                s.stream_id: {"model": s.model_name, "grammar": s.grammar is not None, "rtf": round(s.rtf, 3), "queue_lag": round(s.queue_lag, 3), "model_switches": s.model_switches, "partials_sent": s.partials_sent,
+                                "endpointing": s.endpointing, "early_endpoints": s.early_endpoints,
+                                "pending_ms": round(s.pending_ms), "overflows": s.overflows, "dropped_sec": round(s.dropped_samples / s.sample_rate, 1)}
+                for s in streams
+            },
+        }
+
+    def shutdown(self):
+        for stream_id in list(self.streams):
+            self.remove_stream(stream_id)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,257 @@
+# recognition_supervisor.py
+"""
+Супервизор распознавания: загружает модель Vosk один раз и запускает
+рабочие процессы через fork(), которые разделяют страницы модели по
+принципу copy-on-write.
+
+Упавший рабочий процесс перезапускается новым fork() от уже загруженной
+модели - за миллисекунды вместо многосекундной загрузки vosk-model-ru-0.42.
+Супервизор периодически печатает время загрузки модели и память каждого
+рабочего (RSS и PSS: PSS учитывает разделяемые страницы пропорционально).
+
+С --service вместо цикла по устройствам в рабочем процессе запускается
+сервис распознавания vosk_recognition_tcp_client.py: захват с его
+устройства, командный сервер (start_recognition и др.) и прием
+аудиопотоков от proxy_server'а. Запасная малая модель, если задана,
+тоже загружается в супервизоре один раз.
+
+Примеры:
+    python3 recognition_supervisor.py --model /app/vosk-model-ru-0.42 -d 1
+    python3 recognition_supervisor.py --service --model /app/vosk-model-ru-0.42 --fallback-model /app/vosk-model-small-ru-0.22
+"""
+import argparse
+import gc
+import os
+import signal
+import sys
+import time
+
+from vosk import Model
+
+VOSK_MODEL_SAMPLE_RATE = 16000
+REPORT_INTERVAL = 60 # Как часто (сек) печатать память рабочих процессов
+RESTART_BACKOFF_MAX = 5.0 # Максимальная пауза перед перезапуском часто падающего рабочего
+STABLE_UPTIME = 10.0 # Рабочий, проживший дольше, считается стабильным (пауза сбрасывается)
+
+
+def _read_proc_kb(path, field):
+    """Читает значение в kB из /proc/<pid>/status или smaps_rollup."""
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def memory_usage(pid):
+    """Возвращает (rss_kb, pss_kb) процесса; None, если данные недоступны."""
+    rss = _read_proc_kb(f"/proc/{pid}/status", "VmRSS")
+    pss = _read_proc_kb(f"/proc/{pid}/smaps_rollup", "Pss")
+    return rss, pss
+
+
+def _format_kb(value):
+    return "n/a" if value is None else f"{value / 1024:.0f} MiB"
+
+
+def _worker_main(model, device, model_rate, use_vad):
+    """Тело рабочего процесса после fork(): захват звука и распознавание."""
+    # sounddevice инициализирует PortAudio при импорте, поэтому импортируем
+    # его только в дочернем процессе, а не в супервизоре до fork().
+    import _vosk_loop
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    available_devices = _vosk_loop.list_audio_devices()
+    if not available_devices:
+        print("[SUPERVISOR_WORKER] Не найдено ни одного устройства ввода.", file=sys.stderr)
+        return
+    device_index = _vosk_loop.select_device(device, available_devices)
+    _vosk_loop.run_recognition(model, device_index, model_rate=model_rate, use_vad=use_vad)
+
+
+def _service_worker_main(model_path, model, fallback_model_path, fallback_model):
+    """Тело рабочего процесса сервиса: клиент Vosk с командным сервером и приемом потоков."""
+    import vosk_recognition_tcp_client
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    vosk_recognition_tcp_client.run_service(model_path, fallback_model_path, model=model, fallback_model=fallback_model)
+
+
+class Worker:
+    def __init__(self, device):
+        self.device = device # None - рабочий процесс сервиса распознавания
+        self.label = "сервиса распознавания" if device is None else f"устройства {device}"
+        self.pid = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = 0.0
+        self.next_start = 0.0
+
+
+class RecognitionSupervisor:
+
+    def __init__(self, model_path, devices, model_rate=VOSK_MODEL_SAMPLE_RATE, use_vad=True, fallback_model_path=None):
+        self.model_path = model_path
+        self.fallback_model_path = fallback_model_path
+        self.model_rate = model_rate
+        self.use_vad = use_vad
+        self.workers = [Worker(device) for device in devices]
+        self.model = None
+        self.fallback_model = None
+        self.model_load_time = None
+        self.stopping = False
+
+    def load_model(self):
+        started = time.monotonic()
+        self.model = Model(self.model_path)
+        if self.fallback_model_path:
+            self.fallback_model = Model(self.fallback_model_path)
+        self.model_load_time = time.monotonic() - started
+        rss, _ = memory_usage(os.getpid())
+        if self.fallback_model is not None:
+            print(f"[SUPERVISOR] Запасная модель '{self.fallback_model_path}' загружена.", file=sys.stderr)
+        print(f"[SUPERVISOR] Модель '{self.model_path}' загружена за {self.model_load_time:.2f} с. Память супервизора: RSS {_format_kb(rss)}", file=sys.stderr)
+        # Переносим все объекты в постоянное поколение GC, чтобы сборщик мусора
+        # в дочерних процессах не трогал их заголовки и не копировал страницы.
+        gc.freeze()
+
+    def _spawn(self, worker):
+        started = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                if worker.device is None:
+                    _service_worker_main(self.model_path, self.model, self.fallback_model_path, self.fallback_model)
+                else:
+                    _worker_main(self.model, worker.device, self.model_rate, self.use_vad)
+            except BaseException as e:
+                print(f"[SUPERVISOR_WORKER] Рабочий процесс {worker.label} завершился с ошибкой: {e}", file=sys.stderr)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        worker.pid = pid
+        worker.started_at = time.monotonic()
+        print(f"[SUPERVISOR] Рабочий процесс {worker.label} запущен (PID {pid}) за {(worker.started_at - started) * 1000:.1f} мс без загрузки модели.", file=sys.stderr)
+
+    def _on_exit(self, pid, status):
+        worker = next((w for w in self.workers if w.pid == pid), None)
+        if worker is None:
+            return
+        uptime = time.monotonic() - worker.started_at
+        worker.pid = None
+        if self.stopping:
+            return
+        if os.WIFSIGNALED(status):
+            reason = f"сигнал {os.WTERMSIG(status)}"
+        else:
+            reason = f"код {os.WEXITSTATUS(status)}"
+        # Часто падающий рабочий перезапускается с нарастающей паузой
+        worker.backoff = 0.0 if uptime >= STABLE_UPTIME else min(RESTART_BACKOFF_MAX, max(0.1, worker.backoff * 2))
+        worker.next_start = time.monotonic() + worker.backoff
+        worker.restarts += 1
+        print(f"[SUPERVISOR] Рабочий процесс {worker.label} (PID {pid}) завершился ({reason}) через {uptime:.1f} с. Перезапуск #{worker.restarts} через {worker.backoff:.1f} с.", file=sys.stderr)
+
+    def report(self):
+        lines = [f"[SUPERVISOR] Время загрузки модели: {self.model_load_time:.2f} с"]
+        for worker in self.workers:
+            if worker.pid is None:
+                lines.append(f"  {worker.label}: не запущен (перезапусков: {worker.restarts})")
+                continue
+            rss, pss = memory_usage(worker.pid)
+            lines.append(f"  {worker.label}: PID {worker.pid}, RSS {_format_kb(rss)}, PSS {_format_kb(pss)}, перезапусков: {worker.restarts}")
+        print("\n".join(lines), file=sys.stderr)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.load_model()
+        last_report = time.monotonic()
+
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.pid is None and now >= worker.next_start:
+                    self._spawn(worker)
+
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+            if pid:
+                self._on_exit(pid, status)
+                continue
+
+            if now - last_report >= REPORT_INTERVAL:
+                last_report = now
+                self.report()
+            time.sleep(0.05)
+
+        print("[SUPERVISOR] Остановка рабочих процессов...", file=sys.stderr)
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.waitpid(worker.pid, 0)
+                except ChildProcessError:
+                    pass
+        print("[SUPERVISOR] Остановлен.", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Супервизор распознавания Vosk с предзагрузкой модели и fork-рабочими.")
+    parser.add_argument(
+        "-m", "--model", type=str, default="model",
+        help="Путь к папке с моделью Vosk"
+    )
+    parser.add_argument(
+        "-d", "--device", type=int, action="append",
+        help="Номер устройства ввода; можно указать несколько раз - по рабочему процессу на устройство"
+    )
+    parser.add_argument(
+        "--model-rate", type=int, default=VOSK_MODEL_SAMPLE_RATE,
+        help="Частота дискретизации модели"
+    )
+    parser.add_argument(
+        "--no-vad", action="store_true",
+        help="Не отсекать тишину детектором речи"
+    )
+    parser.add_argument(
+        "--service", action="store_true",
+        help="Запустить сервис распознавания (устройство, команды и прием потоков) вместо рабочих по устройствам"
+    )
+    parser.add_argument(
+        "--fallback-model", type=str, default=None,
+        help="Путь к малой модели для сервиса; пропускается, если папки нет"
+    )
+    args = parser.parse_args()
+    if args.service and args.device:
+        parser.error("--service захватывает звук сам (AUDIO_INPUT_DEVICE_ID) и не сочетается с -d")
+
+    fallback_model_path = args.fallback_model if args.service and args.fallback_model and os.path.isdir(args.fallback_model) else None
+    devices = [None] if args.service else args.device or [0]
+    supervisor = RecognitionSupervisor(args.model, devices, model_rate=args.model_rate, use_vad=not args.no_vad,
+                                       fallback_model_path=fallback_model_path)
+    try:
+        supervisor.run()
+    except Exception as e:
+        print(f"[SUPERVISOR] Критическая ошибка: {type(e).__name__}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
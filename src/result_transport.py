@@ -0,0 +1,144 @@
+# result_transport.py
+"""
+Доставка результатов распознавания proxy_server'у (порт 9991).
+
+Одно постоянное TCP-соединение на процесс вместо соединения на каждый
+результат. Результаты копятся в ограниченном буфере и уходят пачками
+(несколько JSON-строк за один sendall), пока соединение живо. При
+обрыве отправитель переподключается с нарастающей паузой, а
+неотправленные результаты ждут в буфере; если буфер переполнен,
+отбрасываются самые старые. Каждый результат получает "seq" (номер по
+порядку) и "sender" (идентификатор процесса-отправителя), по которым
+proxy_server замечает пропуски и повторы.
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+CONNECT_TIMEOUT = 2 # Таймаут подключения (сек)
+SEND_TIMEOUT = 5 # Таймаут отправки пачки (сек)
+BACKOFF_INITIAL = 0.2 # Первая пауза перед переподключением (сек)
+BACKOFF_MAX = 5.0 # Максимальная пауза перед переподключением (сек)
+REPLAY_LIMIT = 1000 # Сколько неотправленных результатов держать на время переподключения
+BATCH_MAX = 50 # Максимум результатов в одной отправке
+
+
+class ResultSender:
+
+    def __init__(self, host, port, replay_limit=REPLAY_LIMIT, batch_max=BATCH_MAX):
+        self.host = host
+        self.port = port
+        self.replay_limit = replay_limit
+        self.batch_max = batch_max
+        self.sender_id = f"{os.getpid()}-{int(time.time())}"
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._pending = deque()
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="result-sender")
+        self._thread.start()
+        print(f"[SENDER] Поток отправки результатов запущен. Цель: {self.host}:{self.port}", file=sys.stderr)
+
+    def send(self, result: dict):
+        """Ставит результат в очередь отправки; не блокируется на сети."""
+        with self._cond:
+            message = dict(result, seq=self._next_seq, sender=self.sender_id)
+            self._next_seq += 1
+            self._pending.append(message)
+            if len(self._pending) > self.replay_limit:
+                self._pending.popleft()
+                self.dropped += 1
+            self._cond.notify()
+
+    def stop(self, timeout=5):
+        """Дожидается отправки накопленного (если proxy_server доступен) и останавливает поток."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        print(f"[SENDER] Поток отправки результатов завершен. Отправлено: {self.sent} ({self.batches} пачек), "
+              f"потеряно при переполнении: {self.dropped}, переподключений: {self.reconnects}", file=sys.stderr)
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {"sent": self.sent, "batches": self.batches, "pending": pending, "dropped": self.dropped, "reconnects": self.reconnects}
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(SEND_TIMEOUT)
+        return sock
+
+    def _run(self):
+        sock = None
+        backoff = BACKOFF_INITIAL
+        connected_once = False
+        failing = False
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                batch = list(islice(self._pending, self.batch_max))
+
+            if sock is None:
+                try:
+                    sock = self._connect()
+                except OSError as e:
+                    if not failing:
+                        print(f"[SENDER_ERR] Нет соединения с {self.host}:{self.port}: {e}. Прокси-сервер запущен? Результаты ждут в буфере.", file=sys.stderr)
+                        failing = True
+                    with self._cond:
+                        if self._stopping:
+                            break
+                        self._cond.wait(backoff)
+                    backoff = min(BACKOFF_MAX, backoff * 2)
+                    continue
+                if connected_once:
+                    self.reconnects += 1
+                    print(f"[SENDER] Соединение с {self.host}:{self.port} восстановлено, в буфере {len(self._pending)} результатов.", file=sys.stderr)
+                connected_once = True
+                failing = False
+
+            payload = "".join(json.dumps(message, ensure_ascii=False) + '\n' for message in batch).encode('utf-8')
+            try:
+                sock.sendall(payload)
+            except OSError as e:
+                print(f"[SENDER_ERR] Ошибка сети при отправке: {e}. Переподключение через {backoff:.1f} с...", file=sys.stderr)
+                sock.close()
+                sock = None
+                # Прокси может принимать соединения и сразу их рвать (например, при
+                # перезапуске) - без паузы здесь поток крутился бы без задержки
+                with self._cond:
+                    if self._stopping:
+                        break
+                    self._cond.wait(backoff)
+                backoff = min(BACKOFF_MAX, backoff * 2)
+                continue # Пачка осталась в буфере и уйдет после переподключения
+
+            last_seq = batch[-1]["seq"]
+            with self._cond:
+                # Пока шла отправка, переполнение могло уже вытеснить часть пачки
+                while self._pending and self._pending[0]["seq"] <= last_seq:
+                    self._pending.popleft()
+            self.sent += len(batch)
+            self.batches += 1
+            backoff = BACKOFF_INITIAL # Пауза сбрасывается только после успешной отправки
+
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,223 @@
+# transcribe_recordings.py
+"""
+Пакетная расшифровка записей звонков sip-session3.
+
+sip-session3 (--auto-record или /record) пишет WAV в
+<audio.directory>/<account>/<YYYYMMDD>/<время>-<абонент>-<направление>.wav.
+Скрипт обходит эти каталоги, пропускает уже расшифрованные файлы по
+манифесту и раздает остальные пулу процессов. Модель загружается один
+раз в родительском процессе, рабочие получают ее через fork() и
+разделяют страницы по принципу copy-on-write (как в recognition_supervisor).
+Длинные записи читаются с диска блоками, а не целиком. Расшифровка
+кладется рядом с записью: <имя>.txt со строками "[мм:сс.с] фраза".
+
+Пример:
+    python3 transcribe_recordings.py ~/.sipclient/history -m /app/vosk-model-ru-0.42 -j 8
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import sys
+import time
+import wave
+
+from vosk import Model, KaldiRecognizer
+
+from audio_dsp import PolyphaseResampler, as_int16_array, downmix_to_mono
+
+VOSK_MODEL_SAMPLE_RATE = 16000
+RECORDINGS_DIR = os.path.expanduser("~/.sipclient/history") # audio.directory sip-session3 по умолчанию
+MANIFEST_NAME = ".transcripts.json" # Манифест в корне каталога записей
+CHUNK_SECONDS = 4 # Сколько секунд записи читается с диска за раз
+MIN_FILE_AGE = 30 # Файлы моложе (сек) могут еще записываться - пропускаем
+
+_model = None # Загружается в родителе до fork(), рабочие используют общую копию
+
+
+def find_recordings(root):
+    """Возвращает отсортированный список WAV-файлов в каталоге записей."""
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(".wav"):
+                found.append(os.path.join(dirpath, name))
+    return sorted(found)
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"[TRANSCRIBE] Манифест '{path}' не прочитан ({e}), все файлы будут обработаны заново.", file=sys.stderr)
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def _format_time(seconds):
+    return f"{int(seconds // 60):02d}:{seconds % 60:04.1f}"
+
+
+def _phrase_line(result):
+    text = result.get("text")
+    if not text:
+        return None
+    words = result.get("result") or []
+    start = words[0]["start"] if words else 0.0
+    return f"[{_format_time(start)}] {text}"
+
+
+def transcribe_file(path, model_rate=VOSK_MODEL_SAMPLE_RATE):
+    """Расшифровывает одну запись блоками и пишет <имя>.txt рядом с ней."""
+    started = time.monotonic()
+    lines = []
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"поддерживается только 16-битный PCM, а не {wav.getsampwidth() * 8}-битный")
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        duration = wav.getnframes() / rate
+        resampler = PolyphaseResampler(rate, model_rate)
+        recognizer = KaldiRecognizer(_model, model_rate)
+        recognizer.SetWords(True) # Нужны времена слов для меток фраз
+        chunk_frames = rate * CHUNK_SECONDS
+        while True:
+            data = wav.readframes(chunk_frames)
+            if not data:
+                break
+            samples = as_int16_array(data)
+            if channels > 1:
+                samples = downmix_to_mono(samples.reshape(-1, channels))
+            if recognizer.AcceptWaveform(resampler.process(samples).tobytes()):
+                line = _phrase_line(json.loads(recognizer.Result()))
+                if line:
+                    lines.append(line)
+        line = _phrase_line(json.loads(recognizer.FinalResult()))
+        if line:
+            lines.append(line)
+
+    transcript_path = os.path.splitext(path)[0] + ".txt"
+    tmp_path = transcript_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + ("\n" if lines else ""))
+    os.replace(tmp_path, transcript_path)
+    return transcript_path, len(lines), duration, time.monotonic() - started
+
+
+def _worker(task):
+    path, model_rate = task
+    try:
+        return path, transcribe_file(path, model_rate), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def pending_recordings(root, manifest, now=None):
+    """Записи, которых нет в манифесте или которые изменились после расшифровки."""
+    now = time.time() if now is None else now
+    pending = []
+    for path in find_recordings(root):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if now - st.st_mtime < MIN_FILE_AGE:
+            continue
+        entry = manifest.get(os.path.relpath(path, root))
+        if entry and entry.get("size") == st.st_size and entry.get("mtime") == st.st_mtime:
+            continue
+        pending.append((path, st.st_size, st.st_mtime))
+    return pending
+
+
+def transcribe_directory(root, workers, model_rate=VOSK_MODEL_SAMPLE_RATE):
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    pending = pending_recordings(root, manifest)
+    print(f"[TRANSCRIBE] {root}: к расшифровке {len(pending)} записей, уже готово {len(manifest)}.", file=sys.stderr)
+    if not pending:
+        return 0
+
+    stats = {path: (size, mtime) for path, size, mtime in pending}
+    audio_seconds = 0.0
+    failed = 0
+    started = time.monotonic()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers) as pool:
+        # Длинные записи первыми, чтобы в конце пул не ждал одного большого файла
+        tasks = [(path, model_rate) for path, _, _ in sorted(pending, key=lambda p: -p[1])]
+        for done, (path, result, error) in enumerate(pool.imap_unordered(_worker, tasks), 1):
+            relpath = os.path.relpath(path, root)
+            if error:
+                failed += 1
+                print(f"[TRANSCRIBE_ERR] {relpath}: {error}", file=sys.stderr)
+                continue
+            transcript_path, phrases, duration, elapsed = result
+            audio_seconds += duration
+            size, mtime = stats[path]
+            manifest[relpath] = {"size": size, "mtime": mtime, "transcript": os.path.basename(transcript_path),
+                                 "phrases": phrases, "duration": round(duration, 1)}
+            # Манифест сохраняется после каждого файла: прерванный запуск продолжится с места остановки
+            save_manifest(manifest_path, manifest)
+            print(f"[TRANSCRIBE] [{done}/{len(tasks)}] {relpath}: {phrases} фраз, {duration:.0f} с аудио за {elapsed:.1f} с", file=sys.stderr)
+
+    wall = time.monotonic() - started
+    speed = audio_seconds / wall if wall else 0.0
+    print(f"[TRANSCRIBE] Готово: {len(pending) - failed} записей, {audio_seconds / 60:.1f} мин аудио за {wall:.0f} с ({speed:.1f}x реального времени), ошибок: {failed}.", file=sys.stderr)
+    return failed
+
+
+def main():
+    global _model
+
+    parser = argparse.ArgumentParser(description="Пакетная расшифровка записей звонков sip-session3.")
+    parser.add_argument(
+        "directories", nargs="*", default=[RECORDINGS_DIR],
+        help="Каталоги записей (audio.directory sip-session3)"
+    )
+    parser.add_argument(
+        "-m", "--model", type=str, default="model",
+        help="Путь к папке с моделью Vosk"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="Число рабочих процессов (по умолчанию - число ядер)"
+    )
+    parser.add_argument(
+        "--model-rate", type=int, default=VOSK_MODEL_SAMPLE_RATE,
+        help="Частота дискретизации модели; записи ресемплируются к ней"
+    )
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    try:
+        _model = Model(args.model)
+    except Exception as e:
+        print(f"[TRANSCRIBE_ERR] Не удалось загрузить модель из '{args.model}': {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"[TRANSCRIBE] Модель загружена за {time.monotonic() - started:.1f} с, рабочих процессов: {args.jobs}.", file=sys.stderr)
+    # Объекты родителя - в постоянное поколение GC, чтобы рабочие не копировали их страницы
+    gc.freeze()
+
+    failed = 0
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            print(f"[TRANSCRIBE_ERR] Каталог '{directory}' не найден.", file=sys.stderr)
+            failed += 1
+            continue
+        failed += transcribe_directory(directory, args.jobs, model_rate=args.model_rate)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,23 @@
 # vosk_recognition_tcp_client_simple.py
 import argparse
-import queue
 import sys
 import json
 import sounddevice as sd
-import socket
+import socketserver
 import threading
 import time
 import os
 
-from vosk import Model, KaldiRecognizer
 import numpy as np
 
+from audio_dsp import CaptureRingBuffer, OVERFLOW_DROP_OLDEST, downmix_to_mono
+from recognition_service import ENDPOINT_SILENCE_DB, ENDPOINT_STABLE_MS, RecognitionService
+from result_transport import ResultSender
+
 # --- Конфигурация для Vosk-клиента ---
-VOSK_MODEL_PATH = "/app/vosk-model-small-ru-0.22" # <-- УКАЖИТЕ ПУТЬ К ВАШЕЙ МОДЕЛИ
+VOSK_MODEL_PATH = "/app/vosk-model-ru-0.42" # <-- УКАЖИТЕ ПУТЬ К ВАШЕЙ МОДЕЛИ
+# Малая модель, на которую переключаются новые фразы, когда основная не успевает за реальным временем
+VOSK_SMALL_MODEL_PATH = "/app/vosk-model-small-ru-0.22"
 VOSK_MODEL_SAMPLE_RATE = 16000 # Частота, на которой тренирована Vosk модель (обычно 16000)
 
 # Устройство ввода звука. Используйте sd.query_devices() для поиска ID или имени
@@ -23,10 +27,49 @@ AUDIO_INPUT_DEVICE_ID = 1 # <-- УКАЖИТЕ ID/ИМЯ ВАШЕГО АУДИО
 RESULTS_SEND_HOST = "127.0.0.1"
 RESULTS_SEND_PORT = 9991 # Порт, куда отправляются результаты распознавания
 
+# Командный порт (start_recognition / stop_recognition от proxy_server'а)
+VOSK_CLIENT_COMMAND_HOST = "127.0.0.1"
+VOSK_CLIENT_COMMAND_PORT = 9990
+
+# Порт приема внешних аудиопотоков (PCM, который proxy_server получает по WebSocket).
+# Соединение = поток распознавания: строка JSON-заголовка, затем сырой int16 PCM.
+VOSK_CLIENT_INGEST_HOST = "127.0.0.1"
+VOSK_CLIENT_INGEST_PORT = 9992
+INGEST_READ_SIZE = 8192 # Байт за одно чтение из сокета
+# Сколько секунд прием ждет места в очереди потока, не читая сокет (отправитель
+# упирается в TCP-окно и тоже ждет), прежде чем выбросить звук по CAPTURE_OVERFLOW_POLICY
+INGEST_WAIT_TIMEOUT = 2.0
+
+# Идентификатор потока распознавания для локального аудиоустройства
+DEVICE_STREAM_ID = "device"
+
+# Каналы устройства, каждый из которых распознается своим KaldiRecognizer
+# параллельно (например, [0, 1] для абонента и оператора на стерео-петле).
+# None - все каналы сводятся в моно и распознаются одним потоком.
+RECOGNITION_CHANNELS = None
+CHANNEL_LABELS = {} # Необязательные имена каналов для результатов, например {0: "caller", 1: "operator"}
+
+# Ранний эндпоинтинг по умолчанию для start_recognition без "endpointing":
+# None - только эндпоинтер Kaldi, либо {"stable_ms": 600, "silence_db": -45}
+ENDPOINTING_DEFAULT = None
+
+# Отсечение тишины перед декодированием
+VAD_ENABLED = True
+VAD_REPORT_INTERVAL = 60 # Как часто (сек) печатать долю пропущенного аудио и статистику буфера захвата
+QUEUE_REPORT_INTERVAL = 5 # Не чаще этого (сек) печатать потери звука в очередях распознавания
+
+# Буфер захвата между callback'ом sounddevice и распознаванием; те же предел
+# и политика действуют для очереди каждого потока распознавания в сервисе
+CAPTURE_BUFFER_MS = 5000 # Больше этой задержки звук не копится
+CAPTURE_OVERFLOW_POLICY = OVERFLOW_DROP_OLDEST # или OVERFLOW_SKIP_TO_LIVE
+
 # --- Глобальные переменные ---
-audio_q = queue.Queue() # Очередь для аудиоданных из sounddevice callback
-send_q = queue.Queue() # Очередь для распознанных результатов, которые нужно отправить по TCP
+capture_buffer: CaptureRingBuffer = None # Кольцевой буфер аудиоданных из sounddevice callback
+result_sender = ResultSender(RESULTS_SEND_HOST, RESULTS_SEND_PORT) # Постоянное соединение до proxy_server'а
 stop_event = threading.Event() # Событие для сигнализации об остановке
+recognition_active = threading.Event() # Снимается командой stop_recognition
+recognition_active.set()
+device_stream_ids = [] # Потоки распознавания устройства (по одному на канал)
 
 
 def _audio_callback(indata, frames, time_info, status):
@@ -36,54 +79,234 @@ def _audio_callback(indata, frames, time_info, status):
     if status:
         print(f"[VOSK_AUDIO_CB_STATUS] {status}", file=sys.stderr)
     
-    # Всегда помещаем аудиоданные в очередь, пока программа работает
-    audio_q.put(indata.copy())
+    # Копируем блок прямо в заранее выделенный кольцевой буфер
+    capture_buffer.write(indata)
 
-def _send_results_to_proxy_thread_target():
+def _parse_recognition_params(params):
     """
-    Поток, который постоянно отправляет результаты из send_q на proxy_server по TCP.
+    Разбирает параметры распознавания звонка: "phrases" (грамматика) и
+    "endpointing" ({"stable_ms", "silence_db"}, true или false).
+    Возвращает (phrases, stable_ms, silence_db); при ошибке - ValueError.
     """
-    print(f"[SENDER] Поток отправки результатов запущен. Цель: {RESULTS_SEND_HOST}:{RESULTS_SEND_PORT}", file=sys.stderr)
-    while not stop_event.is_set():
+    phrases = params.get("phrases")
+    if phrases is not None and (not isinstance(phrases, list) or not all(isinstance(p, str) for p in phrases)):
+        raise ValueError("'phrases' must be a list of strings.")
+    endpointing = params.get("endpointing", ENDPOINTING_DEFAULT)
+    if endpointing is True:
+        endpointing = {}
+    if endpointing and not isinstance(endpointing, dict):
+        raise ValueError("'endpointing' must be an object, true or false.")
+    if endpointing is None or endpointing is False:
+        return phrases, None, ENDPOINT_SILENCE_DB
+    stable_ms = endpointing.get("stable_ms", ENDPOINT_STABLE_MS)
+    silence_db = endpointing.get("silence_db", ENDPOINT_SILENCE_DB)
+    if not isinstance(stable_ms, (int, float)) or stable_ms <= 0 or not isinstance(silence_db, (int, float)):
+        raise ValueError("'endpointing' needs a positive 'stable_ms' and a numeric 'silence_db'.")
+    return phrases, stable_ms, silence_db
+
+
+def _handle_command(service, line):
+    """
+    Выполняет команду от proxy_server'а. Формат: "<команда> [JSON-параметры]".
+    start_recognition {"phrases": [...]} включает распознавание по грамматике,
+    start_recognition без фраз - открытый словарь.
+    """
+    command, _, payload = line.partition(' ')
+    try:
+        params = json.loads(payload) if payload.strip() else {}
+    except json.JSONDecodeError:
+        return {"status": "error", "message": f"Invalid JSON parameters for '{command}'."}
+
+    if command == "start_recognition":
         try:
-            result_json = send_q.get(timeout=0.1) # Ждем результат с таймаутом
-            
-            # Устанавливаем новое соединение для каждого результата.
-            # Для надежности и простоты в этой демонстрации.
-            # В высоконагруженных системах можно переиспользовать одно соединение.
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(1) # Таймаут на подключение/отправку
-                sock.connect((RESULTS_SEND_HOST, RESULTS_SEND_PORT))
-                message = json.dumps(result_json) + '\n'
-                sock.sendall(message.encode('utf-8'))
-                # print(f"[SENDER] Отправлено: {message.strip()}", file=sys.stderr)
-        except queue.Empty:
-            continue # Таймаут, очередь пуста
-        except socket.error as e:
-            print(f"[SENDER_ERR] Ошибка сети при отправке: {e}. Прокси-сервер запущен?", file=sys.stderr)
-            time.sleep(1) # Короткая пауза перед повторной попыткой
-        except Exception as e:
-            print(f"[SENDER_ERR] Неожиданная ошибка в потоке отправки: {e}", file=sys.stderr)
-            time.sleep(1)
-    print("[SENDER] Поток отправки результатов завершен.", file=sys.stderr)
+            phrases, stable_ms, silence_db = _parse_recognition_params(params)
+        except ValueError as e:
+            return {"status": "error", "message": str(e)}
+        for stream_id in device_stream_ids:
+            service.set_grammar(stream_id, phrases or None)
+            service.set_endpointing(stream_id, stable_ms=stable_ms, silence_db=silence_db)
+        recognition_active.set()
+        mode = f"grammar of {len(phrases)} phrases" if phrases else "open vocabulary"
+        if stable_ms is not None:
+            mode += f", endpointing after {stable_ms} ms below {silence_db} dB"
+        return {"status": "success", "message": f"Recognition started ({mode})."}
+    if command == "stop_recognition":
+        recognition_active.clear()
+        for stream_id in device_stream_ids:
+            service.set_grammar(stream_id, None)
+        return {"status": "success", "message": "Recognition stopped."}
+    if command == "set_partial_rate":
+        rate = params.get("rate")
+        if not isinstance(rate, (int, float)) or rate < 0:
+            return {"status": "error", "message": "'rate' must be a non-negative number."}
+        service.set_partial_rate(rate)
+        return {"status": "success", "message": f"Partial rate set to {rate}/s."}
+    if command == "status":
+        return {"status": "success", "message": "ok", "recognition_active": recognition_active.is_set(), "service": service.stats(),
+                "results_transport": result_sender.stats()}
+    return {"status": "error", "message": f"Unknown command '{command}'."}
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw_line in self.rfile:
+            line = raw_line.decode('utf-8', errors='ignore').strip()
+            if not line:
+                continue
+            print(f"[VOSK_CMD] Получена команда: {line}", file=sys.stderr)
+            response = _handle_command(self.server.service, line)
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + '\n').encode('utf-8'))
+
+
+class _IngestHandler(socketserver.StreamRequestHandler):
+    """
+    Внешний аудиопоток: заголовок {"stream", "sample_rate", "phrases"?, "endpointing"?}
+    и далее моно int16 PCM до закрытия соединения. Распознается общей моделью
+    в пуле сервиса; результаты помечены "stream" и уходят proxy_server'у как обычно.
+    Пока очередь потока полна, сокет не читается - это обратное давление до отправителя.
+    """
+
+    def handle(self):
+        service = self.server.service
+        try:
+            header = json.loads(self.rfile.readline().decode('utf-8'))
+            stream_id = str(header["stream"])
+            sample_rate = int(header["sample_rate"])
+            if not 0 < sample_rate <= 192000:
+                raise ValueError(f"недопустимая частота {sample_rate}")
+            phrases, stable_ms, silence_db = _parse_recognition_params(header)
+            stream = service.add_stream(stream_id, sample_rate, use_vad=VAD_ENABLED, source="ingest")
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[VOSK_INGEST_ERR] Неверный заголовок потока от {self.client_address}: {e}", file=sys.stderr)
+            return
+        if phrases:
+            service.set_grammar(stream_id, phrases)
+        if stable_ms is not None:
+            service.set_endpointing(stream_id, stable_ms=stable_ms, silence_db=silence_db)
+
+        received = 0
+        reported_overflows = 0
+        leftover = b""
+        try:
+            while True:
+                chunk = self.rfile.read1(INGEST_READ_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                data = leftover + chunk
+                # Блок может оборваться посреди отсчета - хвостовой байт ждет следующего чтения
+                usable = len(data) & ~1
+                leftover = data[usable:]
+                if usable:
+                    service.feed(stream_id, np.frombuffer(data[:usable], dtype=np.int16), wait=INGEST_WAIT_TIMEOUT)
+                if stream.overflows != reported_overflows:
+                    reported_overflows = stream.overflows
+                    print(f"[VOSK_INGEST] Поток '{stream_id}': распознавание не успевает ({CAPTURE_OVERFLOW_POLICY}), "
+                          f"переполнений {reported_overflows}, потеряно {stream.dropped_samples / sample_rate:.1f} с аудио", file=sys.stderr)
+        except OSError as e:
+            print(f"[VOSK_INGEST_ERR] Поток '{stream_id}' оборван: {e}", file=sys.stderr)
+        finally:
+            service.remove_stream(stream_id)
+            print(f"[VOSK_INGEST] Поток '{stream_id}' закрыт: {received / 2 / sample_rate:.1f} с аудио, потеряно {stream.dropped_samples / sample_rate:.1f} с", file=sys.stderr)
+
+
+def _start_command_server(service):
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer((VOSK_CLIENT_COMMAND_HOST, VOSK_CLIENT_COMMAND_PORT), _CommandHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True, name="vosk-commands").start()
+    print(f"[VOSK_CMD] Командный сервер слушает {VOSK_CLIENT_COMMAND_HOST}:{VOSK_CLIENT_COMMAND_PORT}", file=sys.stderr)
+    return server
+
+
+def _start_ingest_server(service):
+    server = socketserver.ThreadingTCPServer((VOSK_CLIENT_INGEST_HOST, VOSK_CLIENT_INGEST_PORT), _IngestHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True, name="vosk-ingest").start()
+    print(f"[VOSK_INGEST] Прием аудиопотоков на {VOSK_CLIENT_INGEST_HOST}:{VOSK_CLIENT_INGEST_PORT}", file=sys.stderr)
+    return server
+
+
+def _on_recognition_result(result):
+    """Вызывается сервисом распознавания из рабочих потоков пула."""
+    result_sender.send(result)
+    if result["event"] != "recognition_partial":
+        print(f"[VOSK_FINAL] [{result['stream']}/{result['model']}] {result['text']}", file=sys.stderr)
 
 
 def main():
-    global vosk_model # Теперь модель будет загружаться один раз в main
+    fallback_model_path = VOSK_SMALL_MODEL_PATH if os.path.isdir(VOSK_SMALL_MODEL_PATH) else None
+    run_service(VOSK_MODEL_PATH, fallback_model_path)
+
 
+def run_service(model_path, fallback_model_path=None, model=None, fallback_model=None):
+    """
+    Запускает командный сервер, прием аудиопотоков и, если аудиоустройство
+    доступно, захват с него. Уже загруженные `model` / `fallback_model`
+    передает супервизор, который запускает клиент в рабочем процессе без
+    повторной загрузки моделей.
+    """
     print(f"Vosk Recognition TCP Client (Simple) запущен. PID: {os.getpid()}", file=sys.stderr)
     print(f"Будет отправлять результаты на {RESULTS_SEND_HOST}:{RESULTS_SEND_PORT}", file=sys.stderr)
-    print(f"Использует Vosk модель из: {VOSK_MODEL_PATH}", file=sys.stderr)
+    print(f"Использует Vosk модель из: {model_path}", file=sys.stderr)
+    if fallback_model_path:
+        print(f"Запасная модель при перегрузке: {fallback_model_path}", file=sys.stderr)
 
-    # --- 1. Загрузка Vosk модели ---
+    # --- 1. Загрузка Vosk модели (одна на все потоки распознавания) ---
     try:
-        vosk_model = Model(VOSK_MODEL_PATH)
+        service = RecognitionService(model_path, on_result=_on_recognition_result, model_rate=VOSK_MODEL_SAMPLE_RATE,
+                                     fallback_model_path=fallback_model_path, model=model, fallback_model=fallback_model,
+                                     max_pending_ms=CAPTURE_BUFFER_MS, overflow_policy=CAPTURE_OVERFLOW_POLICY)
         print("[VOSK] Vosk модель загружена.", file=sys.stderr)
     except Exception as e:
-        print(f"[VOSK_ERR] Ошибка загрузки Vosk модели: {e}. Убедитесь, что путь '{VOSK_MODEL_PATH}' верен и модель полная.", file=sys.stderr)
+        print(f"[VOSK_ERR] Ошибка загрузки Vosk модели: {e}. Убедитесь, что путь '{model_path}' верен и модель полная.", file=sys.stderr)
         sys.exit(1)
 
-    # --- 2. Получение информации об аудиоустройстве ---
+    # --- 2. Отправка результатов, командный сервер и прием потоков: аудиоустройство им не нужно ---
+    result_sender.start()
+    command_server = _start_command_server(service)
+    ingest_server = _start_ingest_server(service)
+
+    # --- 3. Поток распознавания для аудиоустройства (ресемплер, VAD, KaldiRecognizer) ---
+    device = _open_device_streams(service)
+
+    # --- 4. Запуск основного цикла распознавания ---
+    try:
+        if device is None:
+            print("[VOSK_ERR] Распознавание с аудиоустройства отключено, обслуживаются только команды и внешние аудиопотоки.", file=sys.stderr)
+            while not stop_event.wait(1.0):
+                pass
+        else:
+            _capture_device(service, *device)
+
+        # Закрываем потоки: незавершенные фразы уходят как recognition_final_on_stop
+        service.shutdown()
+
+    except KeyboardInterrupt:
+        print("\n[VOSK_CLIENT] Распознавание остановлено вручную (Ctrl+C).", file=sys.stderr)
+    except sd.PortAudioError as e:
+        print(f"[VOSK_ERR] Ошибка PortAudio: {e}", file=sys.stderr)
+    except Exception as e:
+        print(f"[VOSK_ERR] Критическая ошибка Vosk клиента: {e}", file=sys.stderr)
+    finally:
+        print("[VOSK_CLIENT] Выполняется очистка ресурсов...", file=sys.stderr)
+        stop_event.set() # Сигнализируем всем потокам об остановке
+        if command_server is not None:
+            command_server.shutdown()
+        if ingest_server is not None:
+            ingest_server.shutdown()
+        result_sender.stop(timeout=5) # Дожидаемся отправки накопленных результатов
+        print("[VOSK_CLIENT] Очистка завершена. Программа остановлена.", file=sys.stderr)
+
+
+def _open_device_streams(service):
+    """
+    Находит аудиоустройство и создает для него потоки распознавания.
+    Возвращает (ID устройства, число каналов, частота, {канал: поток})
+    или None, если устройство недоступно.
+    """
     try:
         device_info = sd.query_devices(AUDIO_INPUT_DEVICE_ID, 'input')
         device_id_to_use = device_info['index']
@@ -96,72 +319,90 @@ def main():
     except Exception as e:
         print(f"[VOSK_ERR] Не удалось найти или настроить аудиоустройство '{AUDIO_INPUT_DEVICE_ID}': {e}", file=sys.stderr)
         print("[VOSK_ERR] Доступные устройства ввода:", file=sys.stderr)
-        for i, dev in enumerate(sd.query_devices()):
-            if dev['max_input_channels'] > 0:
-                print(f"  ID: {i}, Name: {dev['name']}, Channels: {dev['max_input_channels']}, Default_SR: {dev['default_samplerate']}", file=sys.stderr)
-        sys.exit(1)
+        try:
+            for i, dev in enumerate(sd.query_devices()):
+                if dev['max_input_channels'] > 0:
+                    print(f"  ID: {i}, Name: {dev['name']}, Channels: {dev['max_input_channels']}, Default_SR: {dev['default_samplerate']}", file=sys.stderr)
+        except Exception as e:
+            print(f"  (список недоступен: {e})", file=sys.stderr)
+        return None
 
-    # --- 3. Инициализация KaldiRecognizer ---
-    rec = KaldiRecognizer(vosk_model, VOSK_MODEL_SAMPLE_RATE)
+    if RECOGNITION_CHANNELS is None:
+        channel_streams = {None: service.add_stream(DEVICE_STREAM_ID, actual_samplerate, use_vad=VAD_ENABLED)}
+    else:
+        invalid = [ch for ch in RECOGNITION_CHANNELS if not 0 <= ch < num_channels_device]
+        if invalid:
+            print(f"[VOSK_ERR] У устройства {num_channels_device} каналов, каналы {invalid} недоступны.", file=sys.stderr)
+            return None
+        channel_streams = {}
+        for ch in RECOGNITION_CHANNELS:
+            tags = {"channel": ch}
+            if ch in CHANNEL_LABELS:
+                tags["channel_label"] = CHANNEL_LABELS[ch]
+            channel_streams[ch] = service.add_stream(f"{DEVICE_STREAM_ID}:ch{ch}", actual_samplerate, use_vad=VAD_ENABLED, **tags)
+        print(f"[VOSK] Раздельное распознавание каналов {list(channel_streams)} в пуле из {service.max_workers} потоков.", file=sys.stderr)
+    device_stream_ids[:] = [stream.stream_id for stream in channel_streams.values()]
+    resampler = next(iter(channel_streams.values())).resampler
+    if not resampler.passthrough:
+        print(f"[VOSK] Ресемплинг {actual_samplerate} Hz -> {VOSK_MODEL_SAMPLE_RATE} Hz (L/M = {resampler.up}/{resampler.down})", file=sys.stderr)
+    return device_id_to_use, num_channels_device, actual_samplerate, channel_streams
 
-    # --- 4. Запуск потока для отправки результатов по TCP ---
-    sender_thread = threading.Thread(target=_send_results_to_proxy_thread_target, daemon=True)
-    sender_thread.start()
 
-    # --- 5. Запуск основного цикла распознавания ---
-    try:
-        # Открываем аудиопоток. Он будет работать постоянно.
-        with sd.InputStream(samplerate=actual_samplerate, device=device_id_to_use,
-                            channels=num_channels_device, dtype='int16', callback=_audio_callback):
-            print("[VOSK] Vosk распознавание запущено. Аудиопоток активен. Говорите в микрофон.", file=sys.stderr)
-            print("Для остановки нажмите Ctrl+C.", file=sys.stderr)
-            
-            while not stop_event.is_set():
-                try:
-                    data = audio_q.get(timeout=0.1) # Ждем аудио из очереди с таймаутом
-
-                    # Если устройство многоканальное, берем только первый канал для Vosk
-                    if data.ndim > 1:
-                        data_mono = data[:, 0]
-                    else:
-                        data_mono = data
-
-                    # Подаем данные в распознаватель
-                    if rec.AcceptWaveform(data_mono.tobytes()):
-                        result_final = json.loads(rec.Result())
-                        if result_final.get('text'):
-                            send_q.put({"event": "recognition_final", "text": result_final["text"]})
-                            print(f"[VOSK_FINAL] {result_final['text']}", file=sys.stderr)
-                    else:
-                        partial_result = json.loads(rec.PartialResult())
-                        if partial_result.get('partial'):
-                            send_q.put({"event": "recognition_partial", "text": partial_result["partial"]})
-                            # print(f"[VOSK_PARTIAL] {partial_result['partial']}", end='\r', file=sys.stderr) # Отладочный вывод
-
-                except queue.Empty:
-                    continue # Таймаут очереди, просто продолжаем ждать
-                except Exception as e:
-                    print(f"[VOSK_ERR] Неожиданная ошибка в Vosk распознавании: {e}", file=sys.stderr)
-                    break # Выход из цикла, если произошла ошибка
-            
-            # Получаем окончательный результат при остановке (если была незавершенная фраза)
-            final_result_on_stop = json.loads(rec.FinalResult())
-            if final_result_on_stop.get('text'):
-                send_q.put({"event": "recognition_final_on_stop", "text": final_result_on_stop["text"]})
-                print(f"[VOSK_FINAL_ON_STOP] {final_result_on_stop['text']}", file=sys.stderr)
+def _capture_device(service, device_id_to_use, num_channels_device, actual_samplerate, channel_streams):
+    """Захватывает звук устройства и раздает его потокам распознавания до stop_event или ошибки."""
+    global capture_buffer
 
-    except KeyboardInterrupt:
-        print("\n[VOSK_CLIENT] Распознавание остановлено вручную (Ctrl+C).", file=sys.stderr)
-    except sd.PortAudioError as e:
-        print(f"[VOSK_ERR] Ошибка PortAudio: {e}", file=sys.stderr)
-    except Exception as e:
-        print(f"[VOSK_ERR] Критическая ошибка Vosk клиента: {e}", file=sys.stderr)
-    finally:
-        print("[VOSK_CLIENT] Выполняется очистка ресурсов...", file=sys.stderr)
-        stop_event.set() # Сигнализируем всем потокам об остановке
-        if sender_thread and sender_thread.is_alive():
-            sender_thread.join(timeout=5) # Ждем завершения потока отправки
-        print("[VOSK_CLIENT] Очистка завершена. Программа остановлена.", file=sys.stderr)
+    last_vad_report = time.monotonic()
+    capture_buffer = CaptureRingBuffer(actual_samplerate, num_channels_device, capacity_ms=CAPTURE_BUFFER_MS, policy=CAPTURE_OVERFLOW_POLICY)
+    reported_overruns = 0
+    reported_queue_overflows = 0
+    last_queue_report = 0.0
+
+    # Открываем аудиопоток. Он будет работать постоянно.
+    with sd.InputStream(samplerate=actual_samplerate, device=device_id_to_use,
+                        channels=num_channels_device, dtype='int16', callback=_audio_callback):
+        print("[VOSK] Vosk распознавание запущено. Аудиопоток активен. Говорите в микрофон.", file=sys.stderr)
+        print("Для остановки нажмите Ctrl+C.", file=sys.stderr)
+        
+        while not stop_event.is_set():
+            try:
+                data = capture_buffer.read(timeout=0.1) # Забираем все накопленное аудио
+                if data is None:
+                    continue # Таймаут, буфер пуст
+
+                if capture_buffer.overruns != reported_overruns:
+                    reported_overruns = capture_buffer.overruns
+                    print(f"[VOSK_CAPTURE] Переполнение буфера захвата ({CAPTURE_OVERFLOW_POLICY}): всего {reported_overruns}, потеряно {capture_buffer.dropped_frames / actual_samplerate:.1f} с аудио", file=sys.stderr)
+
+                if not recognition_active.is_set():
+                    continue # Распознавание остановлено командой stop_recognition
+
+                # Каждый выбранный канал (или моно-смесь) - в свой поток; ресемплинг,
+                # VAD и декодирование выполняются параллельно в пуле сервиса
+                for ch, stream in channel_streams.items():
+                    service.feed(stream.stream_id, downmix_to_mono(data, channel=ch))
+
+                queue_overflows = sum(stream.overflows for stream in channel_streams.values())
+                if queue_overflows != reported_queue_overflows and time.monotonic() - last_queue_report >= QUEUE_REPORT_INTERVAL:
+                    reported_queue_overflows = queue_overflows
+                    last_queue_report = time.monotonic()
+                    dropped_sec = max(stream.dropped_samples for stream in channel_streams.values()) / actual_samplerate
+                    print(f"[VOSK_QUEUE] Распознавание не успевает ({CAPTURE_OVERFLOW_POLICY}): переполнений очереди {queue_overflows}, потеряно {dropped_sec:.1f} с аудио", file=sys.stderr)
+
+                if time.monotonic() - last_vad_report >= VAD_REPORT_INTERVAL:
+                    last_vad_report = time.monotonic()
+                    for stream in channel_streams.values():
+                        if stream.vad is not None:
+                            print(f"[VOSK_VAD] [{stream.stream_id}] Пропущено тишины: {stream.vad.skipped_fraction:.1%} аудио", file=sys.stderr)
+                    print(f"[VOSK_CAPTURE] Задержка буфера: {capture_buffer.lag_ms:.0f} мс, переполнений: {capture_buffer.overruns}, потеряно кадров: {capture_buffer.dropped_frames}", file=sys.stderr)
+
+            except Exception as e:
+                print(f"[VOSK_ERR] Неожиданная ошибка в Vosk распознавании: {e}", file=sys.stderr)
+                break # Выход из цикла, если произошла ошибка
+        
+        for stream in channel_streams.values():
+            if stream.vad is not None:
+                print(f"[VOSK_VAD] [{stream.stream_id}] Итого пропущено тишины: {stream.vad.skipped_fraction:.1%} аудио", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
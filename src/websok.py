@@ -1,19 +1,31 @@
 # websocket_proxy_server.py
 import asyncio
+import itertools
 import websockets
 import json
+import re
 import socket
 import sys
 import os
 import threading
 import time
 import queue
+import struct
 import tempfile # Для создания временных файлов
+import wave
 import requests
 
 # --- Импорты для TTS ---
 import pyttsx3
 
+from keyword_spotter import KeywordSpotter
+from audio_dsp import PolyphaseResampler, linear_to_ulaw
+
+try:
+    import opuslib # Необязательно: сжатие Opus для прослушивания звонка и голоса оператора
+except ImportError:
+    opuslib = None
+
 # --- Конфигурация сервера ---
 WS_HOST = "0.0.0.0"
 WS_PORT = 8765
@@ -47,9 +59,82 @@ VOSK_CLIENT_COMMAND_PORT = 9990
 VOSK_CLIENT_RESULTS_LISTEN_HOST = "127.0.0.1"
 VOSK_CLIENT_RESULTS_LISTEN_PORT = 9991
 
+# --- ASR как сервис: PCM из бинарных WS-кадров распознается Vosk-клиентом ---
+# Каждый поток - отдельное TCP-соединение на порт приема Vosk-клиента; модель общая.
+VOSK_CLIENT_INGEST_HOST = "127.0.0.1"
+VOSK_CLIENT_INGEST_PORT = 9992
+ASR_MAX_STREAMS = 8 # Одновременно распознаваемых WS-потоков
+ASR_QUEUE_TIMEOUT = 10 # Сколько секунд asr_start ждет свободного места, прежде чем отказать
+ASR_RESULT_GRACE = 5 # Сколько секунд после asr_stop доставлять владельцу последние результаты
+
+# Ключевые слова и тревожные фразы, при появлении которых в partial/final
+# рассылается событие keyword_detected (меняется WS-командой set_keywords)
+SPOTTER_KEYWORDS = ["пожар", "подтверждаю"]
+
+# Частота partial-результатов, которую прокси запрашивает у Vosk-клиента:
+# PARTIAL_MAX_RATE делится на число подписчиков потока расшифровки, но не ниже
+# PARTIAL_MIN_RATE; если partial не нужен никому (ни клиентам, ни поиску
+# ключевых слов), частота 0 - Vosk-клиент перестает их запрашивать.
+PARTIAL_MAX_RATE = 10.0
+PARTIAL_MIN_RATE = 2.0
+
+# Звук звонка для операторов в браузере. sip-session3 отдает кадры PCM
+# (подписчик /tap) на UDP-порт ретранслятора, ретранслятор раздает их
+# WS-слушателям бинарными кадрами: 14-байтный заголовок как FRAME_HEADER в
+# sys/udp_audio.py (b"AU", тип, флаги, seq, метка времени, частота) и звук.
+# Голос оператора (бинарные кадры после talk_start) идет в звонок через
+# /udpaudio sip-session3 в обратном направлении.
+CALL_AUDIO_RELAY_HOST = "127.0.0.1"
+CALL_AUDIO_RELAY_PORT = 9993
+CALL_AUDIO_RELAY_FORMAT = "pcm16000" # Формат подписчика /tap: широкополосный PCM, из него кодируются остальные
+CALL_AUDIO_RELAY_RATE = 16000
+CALL_AUDIO_INJECT_PORT = 9994 # Порт, который /udpaudio sip-session3 слушает для голоса оператора
+CALL_AUDIO_HEADER = struct.Struct("!2sBBHII")
+CALL_AUDIO_MAGIC = b"AU"
+PT_L16, PT_PCMU, PT_OPUS = 0, 1, 3
+LISTEN_MAX_CLIENTS = 16 # Одновременных слушателей звонка
+LISTEN_QUEUE_FRAMES = 25 # Очередь слушателя (0.5 с); отстающий теряет свои самые старые кадры
+TALK_FRAME_MS = 20 # Голос оператора режется на кадры этой длины (как у микшера)
+TALK_MAX_MESSAGE_BYTES = 64000 # Предел одного бинарного кадра оператора
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000) # Частоты, которые поддерживает декодер Opus
+
+# Автоинформаторы операторов: звук звонка с начала набора (ранние медиа) и
+# первые секунды после ответа распознаются Vosk по грамматике из этих фраз
+# (поток с грамматикой Vosk-клиент ведет на малой модели). Найденная фраза
+# завершает звонок через /failcall с кодом outgoing-failed-announcement-<код>.
+# Список меняется для звонка полем "announcements" команды call.
+ANNOUNCEMENT_PHRASES = {
+    "абонент недоступен": "unavailable",
+    "аппарат абонента выключен": "unavailable",
+    "абонент не отвечает": "no-answer",
+    "номер не существует": "no-such-number",
+    "номер не обслуживается": "no-such-number",
+    "неправильно набран номер": "wrong-number",
+    "абонент занят": "busy",
+}
+ANNOUNCEMENT_AFTER_ANSWER = 8 # Сколько секунд слушать после ответа
+ANNOUNCEMENT_MAX_DURATION = 90 # Предел всего окна (если ответа так и не было)
+ANNOUNCEMENT_MAX_BUFFER = 64000 # Байт PCM в очереди к Vosk-клиенту, сверх - кадры отбрасываются
+ANNOUNCEMENT_STREAM_PREFIX = "announce-" # Префикс внутренних потоков Vosk для автоинформаторов
+
 # --- Глобальные состояния ---
 current_sip_client_process: asyncio.subprocess.Process = None
 websocket_clients: set = set()
+keyword_only_clients: set = set() # WS-клиенты, которым не нужен поток partial/final, только keyword_detected
+keyword_spotter = KeywordSpotter(SPOTTER_KEYWORDS)
+asr_slots = asyncio.Semaphore(ASR_MAX_STREAMS) # Ограничение и очередь WS-потоков распознавания
+asr_stream_owners: dict = {} # id потока распознавания -> WS-клиент, которому идут его результаты
+asr_stream_ids = itertools.count(1)
+result_seq_by_sender: dict = {} # Последний "seq" от каждого Vosk-отправителя (для поиска пропусков)
+results_lost: int = 0 # Сколько результатов не дошло, по пропускам в "seq"
+partial_texts: dict = {} # Текущий partial по потокам (Vosk-клиент присылает только изменившийся хвост)
+current_partial_rate: float = None # Последняя частота partial, отправленная Vosk-клиенту
+listen_sessions: dict = {} # WS-клиент -> сессия прослушивания звонка (формат, очередь кадров, задача отправки)
+call_audio_tap_id: int = None # Номер подписчика /tap в sip-session3, пока есть слушатели
+talk_owner = None # WS-клиент, чей голос сейчас идет в звонок (один оператор за раз)
+amd_policy: dict = None # Что делать, если звонок попал на автоответчик: {"action": "hangup"|"message", "text": ...}
+announcement_watch: dict = None # Распознавание автоинформатора текущего звонка (поток Vosk, фразы, таймер)
+announcement_ingest_warned: bool = False # Недоступность приема потоков Vosk уже сообщена в лог
 
 # --- Глобальный TTS движок ---
 tts_engine: pyttsx3.Engine = None
@@ -166,7 +251,11 @@ async def _kill_existing_sip_client_program(force_kill_if_stuck: bool = False):
     """
     Пытается корректно завершить запущенную программу sip-session3, при необходимости убивает.
     """
-    global current_sip_client_process, sip_client_stdout_task, sip_client_stderr_task
+    global current_sip_client_process, sip_client_stdout_task, sip_client_stderr_task, call_audio_tap_id, amd_policy
+
+    call_audio_tap_id = None # Подписчики /tap живут только в процессе sip-session3
+    amd_policy = None
+    await _announcement_watch_stop()
 
     if current_sip_client_process is None or current_sip_client_process.returncode is not None:
         if current_sip_client_process:
@@ -310,6 +399,418 @@ async def send_command_to_vosk_client(command: str) -> dict:
             await writer.wait_closed()
     return response_data_dict
 
+async def _broadcast_to_ws_clients(event: dict, recipients=None):
+    """Рассылает событие WS-клиентам (по умолчанию всем) и убирает отключившихся."""
+    message = json.dumps(event)
+    disconnected_clients = set()
+    for client_ws in list(websocket_clients if recipients is None else recipients):
+        try:
+            await client_ws.send(message)
+        except websockets.exceptions.ConnectionClosedOK:
+            disconnected_clients.add(client_ws)
+        except websockets.exceptions.ConnectionClosedError as e:
+            print(f"[WS_BROADCAST_ERR] Ошибка отправки на {client_ws.remote_address}: {e}", file=sys.stderr)
+            disconnected_clients.add(client_ws)
+        except Exception as e:
+            print(f"[WS_BROADCAST_ERR] Неожиданная ошибка отправки на {client_ws.remote_address}: {e}", file=sys.stderr)
+            disconnected_clients.add(client_ws)
+    websocket_clients.difference_update(disconnected_clients)
+    keyword_only_clients.difference_update(disconnected_clients)
+
+
+def _check_result_sequence(result: dict) -> bool:
+    """
+    Снимает с результата "seq"/"sender" и проверяет порядок. Возвращает False
+    для повтора (уже полученного результата); пропуски считаются и логируются.
+    """
+    global results_lost
+    seq = result.pop("seq", None)
+    sender = result.pop("sender", None)
+    if seq is None:
+        return True # Отправитель без нумерации
+    last = result_seq_by_sender.get(sender)
+    if last is not None:
+        if seq <= last:
+            return False
+        if seq > last + 1:
+            results_lost += seq - last - 1
+            print(f"[VOSK_RESULTS_TCP_ERR] Пропуск результатов от '{sender}': {last + 1}..{seq - 1} (всего потеряно {results_lost})", file=sys.stderr)
+    result_seq_by_sender[sender] = seq
+    return True
+
+
+def _restore_partial_text(result: dict) -> dict:
+    """
+    Собирает полный текст partial из "offset"/"delta" (общее начало с прошлым
+    partial потока + новый хвост); на финальных результатах забывает partial.
+    """
+    stream_id = result.get("stream", "device")
+    if result.get("event") != "recognition_partial":
+        partial_texts.pop(stream_id, None)
+        return result
+    if "delta" not in result:
+        return result
+    text = partial_texts.get(stream_id, "")[:result.get("offset", 0)] + result["delta"]
+    partial_texts[stream_id] = text
+    restored = {k: v for k, v in result.items() if k not in ("offset", "delta")}
+    restored["text"] = text
+    return restored
+
+
+def _desired_partial_rate() -> float:
+    transcript_subscribers = len(websocket_clients - keyword_only_clients)
+    if transcript_subscribers:
+        return max(PARTIAL_MIN_RATE, PARTIAL_MAX_RATE / transcript_subscribers)
+    if websocket_clients and keyword_spotter.keywords:
+        return PARTIAL_MAX_RATE # Ключевые слова ищутся по partial - задержка важнее трафика
+    return 0.0
+
+
+async def _update_partial_rate():
+    """Сообщает Vosk-клиенту новую частоту partial, если число подписчиков ее изменило."""
+    global current_partial_rate
+    rate = _desired_partial_rate()
+    if rate == current_partial_rate:
+        return
+    response = await send_command_to_vosk_client(f"set_partial_rate {json.dumps({'rate': rate})}")
+    if response.get("status") == "success":
+        current_partial_rate = rate
+
+
+def _spot_keywords(result: dict) -> list:
+    """
+    Прогоняет partial/final через автомат ключевых слов и возвращает события
+    keyword_detected для фраз, впервые появившихся в текущем высказывании.
+    """
+    event = result.get("event", "")
+    if not event.startswith("recognition_"):
+        return []
+    stream_id = result.get("stream", "device")
+    text = result.get("text", "")
+    final = event != "recognition_partial"
+    return [
+        {"event": "keyword_detected", "keyword": keyword, "text": text, "stream": stream_id, "final": final}
+        for keyword in keyword_spotter.update(stream_id, text, final=final)
+    ]
+
+
+async def _asr_open(websocket, request: dict):
+    """
+    Начинает распознавание PCM, который клиент будет присылать бинарными кадрами.
+    Возвращает (сессия или None, ответ клиенту).
+    """
+    sample_rate = request.get("sample_rate")
+    if not isinstance(sample_rate, int) or not 0 < sample_rate <= 192000:
+        return None, {"status": "error", "command": "asr_start", "message": "'sample_rate' must be a positive integer (Hz)."}
+
+    queued_at = time.monotonic()
+    try:
+        await asyncio.wait_for(asr_slots.acquire(), timeout=ASR_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None, {"status": "error", "command": "asr_start", "message": f"All {ASR_MAX_STREAMS} recognition slots are busy, try again later."}
+
+    stream_id = f"ws-{next(asr_stream_ids)}"
+    header = {"stream": stream_id, "sample_rate": sample_rate}
+    header.update({key: request[key] for key in ("phrases", "endpointing") if key in request})
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(VOSK_CLIENT_INGEST_HOST, VOSK_CLIENT_INGEST_PORT),
+            timeout=3
+        )
+        writer.write((json.dumps(header, ensure_ascii=False) + '\n').encode('utf-8'))
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError) as e:
+        asr_slots.release()
+        print(f"[ASR_WS_ERR] Не удалось открыть поток распознавания на {VOSK_CLIENT_INGEST_HOST}:{VOSK_CLIENT_INGEST_PORT}: {e}", file=sys.stderr)
+        return None, {"status": "error", "command": "asr_start", "message": f"Vosk client ingest is unavailable: {e}"}
+
+    asr_stream_owners[stream_id] = websocket
+    print(f"[ASR_WS] Поток '{stream_id}' ({sample_rate} Hz) открыт для {websocket.remote_address}", file=sys.stderr)
+    session = {"stream": stream_id, "writer": writer, "bytes": 0}
+    return session, {"status": "success", "command": "asr_start", "stream": stream_id, "queued_sec": round(time.monotonic() - queued_at, 2)}
+
+
+async def _asr_close(session: dict):
+    """Закрывает поток: Vosk-клиент дожимает фразу и присылает recognition_final_on_stop."""
+    writer = session["writer"]
+    try:
+        writer.close()
+        await writer.wait_closed()
+    except OSError:
+        pass
+    finally:
+        asr_slots.release()
+    # Последние результаты еще идут владельцу, потом поток забывается
+    asyncio.get_running_loop().call_later(ASR_RESULT_GRACE, asr_stream_owners.pop, session["stream"], None)
+    print(f"[ASR_WS] Поток '{session['stream']}' закрыт, получено {session['bytes']} байт PCM", file=sys.stderr)
+
+
+
+class _CallAudioRelay(asyncio.DatagramProtocol):
+    """
+    Принимает кадры звонка от sip-session3 и раскладывает их по очередям
+    слушателей. Каждый формат кодируется один раз на кадр, отправка идет
+    из задач слушателей, поэтому медленный браузер не задерживает ни
+    остальных, ни прием.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self._ulaw_resampler = PolyphaseResampler(CALL_AUDIO_RELAY_RATE, 8000)
+        self._opus_encoder = None
+
+    def _encode(self, audio_format, seq, timestamp, rate, datagram, pcm):
+        if audio_format == "pcm":
+            return datagram # Заголовок и PCM как есть
+        if audio_format == "ulaw":
+            codes = linear_to_ulaw(self._ulaw_resampler.process(pcm)).tobytes()
+            return CALL_AUDIO_HEADER.pack(CALL_AUDIO_MAGIC, PT_PCMU, 0, seq, timestamp * 8000 // rate, 8000) + codes
+        if self._opus_encoder is None:
+            self._opus_encoder = opuslib.Encoder(rate, 1, opuslib.APPLICATION_VOIP)
+        packet = self._opus_encoder.encode(bytes(pcm), len(pcm) // 2)
+        return CALL_AUDIO_HEADER.pack(CALL_AUDIO_MAGIC, PT_OPUS, 0, seq, timestamp, rate) + packet
+
+    def datagram_received(self, data, addr):
+        if len(data) <= CALL_AUDIO_HEADER.size or data[:2] != CALL_AUDIO_MAGIC or not (listen_sessions or announcement_watch):
+            return
+        _, payload_type, _, seq, timestamp, rate = CALL_AUDIO_HEADER.unpack_from(data)
+        if payload_type != PT_L16 or rate != CALL_AUDIO_RELAY_RATE:
+            return
+        self.frames += 1
+        pcm = memoryview(data)[CALL_AUDIO_HEADER.size:]
+        if announcement_watch is not None:
+            _announcement_feed(pcm)
+        encoded = {}
+        for session in listen_sessions.values():
+            audio_format = session["format"]
+            message = encoded.get(audio_format)
+            if message is None:
+                try:
+                    message = encoded[audio_format] = self._encode(audio_format, seq, timestamp, rate, data, pcm)
+                except Exception as e:
+                    print(f"[CALL_AUDIO_ERR] Ошибка кодирования '{audio_format}': {e}", file=sys.stderr)
+                    continue
+            frames = session["queue"]
+            if frames.full():
+                frames.get_nowait()
+                session["dropped"] += 1
+            frames.put_nowait(message)
+
+
+async def _call_audio_subscribe():
+    """Подписывает ретранслятор на звук звонка в sip-session3 (один подписчик на всех слушателей)."""
+    global call_audio_tap_id
+    if call_audio_tap_id is not None:
+        return True
+    response = await send_command_to_sip_client(f"/tap udp {CALL_AUDIO_RELAY_HOST} {CALL_AUDIO_RELAY_PORT} {CALL_AUDIO_RELAY_FORMAT}")
+    if response.get("status") != "success" or "subscriber" not in response:
+        print(f"[CALL_AUDIO_ERR] sip-session3 не подключил отвод звука: {response.get('message')}", file=sys.stderr)
+        return False
+    call_audio_tap_id = response["subscriber"]
+    print(f"[CALL_AUDIO] Отвод звука звонка подключен (подписчик #{call_audio_tap_id})", file=sys.stderr)
+    return True
+
+
+async def _call_audio_unsubscribe():
+    global call_audio_tap_id
+    if call_audio_tap_id is None:
+        return
+    tap_id, call_audio_tap_id = call_audio_tap_id, None
+    await send_command_to_sip_client(f"/untap {tap_id}")
+    print(f"[CALL_AUDIO] Отвод звука звонка отключен (подписчик #{tap_id})", file=sys.stderr)
+
+
+async def _announcement_watch_start(phrases: dict):
+    """
+    Открывает поток Vosk с грамматикой из фраз автоинформаторов и подключает к нему звук звонка.
+    Возвращает False, если звонок остается без распознавания автоинформаторов.
+    """
+    global announcement_watch, announcement_ingest_warned
+    await _announcement_watch_stop()
+    stream_id = f"{ANNOUNCEMENT_STREAM_PREFIX}{next(asr_stream_ids)}"
+    header = {"stream": stream_id, "sample_rate": CALL_AUDIO_RELAY_RATE, "phrases": list(phrases)}
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(VOSK_CLIENT_INGEST_HOST, VOSK_CLIENT_INGEST_PORT),
+            timeout=3
+        )
+        writer.write((json.dumps(header, ensure_ascii=False) + '\n').encode('utf-8'))
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError) as e:
+        # Без приема потоков это повторялось бы на каждом звонке - сообщаем один раз за процесс,
+        # а каждый звонок узнает об этом из поля "announcement_watch" ответа
+        if not announcement_ingest_warned:
+            announcement_ingest_warned = True
+            print(f"[ANNOUNCEMENT_ERR] Прием потоков Vosk на {VOSK_CLIENT_INGEST_HOST}:{VOSK_CLIENT_INGEST_PORT} недоступен ({e}): "
+                  f"автоинформаторы не распознаются. Запущен ли recognition_supervisor.py --service?", file=sys.stderr)
+        return False
+    loop = asyncio.get_running_loop()
+    announcement_watch = {"stream": stream_id, "writer": writer, "phrases": phrases, "dropped": 0,
+                          "timer": loop.call_later(ANNOUNCEMENT_MAX_DURATION, _announcement_watch_expire, stream_id)}
+    if not await _call_audio_subscribe():
+        await _announcement_watch_stop()
+        return False
+    print(f"[ANNOUNCEMENT] Поток '{stream_id}' слушает звонок ({len(phrases)} фраз)", file=sys.stderr)
+    return True
+
+
+async def _announcement_watch_stop():
+    global announcement_watch
+    watch, announcement_watch = announcement_watch, None
+    if watch is None:
+        return
+    watch["timer"].cancel()
+    try:
+        watch["writer"].close()
+        await watch["writer"].wait_closed()
+    except OSError:
+        pass
+    if not listen_sessions:
+        await _call_audio_unsubscribe()
+    print(f"[ANNOUNCEMENT] Поток '{watch['stream']}' закрыт (отброшено кадров: {watch['dropped']})", file=sys.stderr)
+
+
+def _announcement_watch_expire(stream_id: str, delay: float = 0):
+    """Окно распознавания истекло (или звонок ответил - тогда оно сокращается до delay секунд)."""
+    if announcement_watch is None or announcement_watch["stream"] != stream_id:
+        return
+    if delay:
+        announcement_watch["timer"].cancel()
+        announcement_watch["timer"] = asyncio.get_running_loop().call_later(delay, _announcement_watch_expire, stream_id)
+        return
+    asyncio.create_task(_announcement_watch_stop())
+
+
+def _announcement_feed(pcm):
+    writer = announcement_watch["writer"]
+    if writer.is_closing() or writer.transport.get_write_buffer_size() > ANNOUNCEMENT_MAX_BUFFER:
+        announcement_watch["dropped"] += 1 # Vosk-клиент не успевает - теряем звук, а не память
+        return
+    writer.write(pcm)
+
+
+async def _announcement_result(result: dict):
+    """Ищет фразу автоинформатора в результате; найденная завершает звонок с ее кодом."""
+    text = result.get("text") or ""
+    match = next(((phrase, code) for phrase, code in announcement_watch["phrases"].items() if phrase in text), None)
+    if match is None:
+        return
+    phrase, code = match
+    print(f"[ANNOUNCEMENT] Автоинформатор: '{phrase}' -> {code}. Завершаем звонок.", file=sys.stderr)
+    await _announcement_watch_stop()
+    await _broadcast_to_ws_clients({"event": "announcement_detected", "phrase": phrase, "code": code})
+    await send_command_to_sip_client(f"/failcall announcement-{code}")
+
+
+async def _listen_pump(websocket, session):
+    """Отправляет кадры одному слушателю; send() ждет, пока клиент принимает (обратное давление)."""
+    frames = session["queue"]
+    while True:
+        message = await frames.get()
+        await websocket.send(message)
+        session["sent"] += 1
+
+
+async def _listen_start(websocket, request: dict) -> dict:
+    audio_format = request.get("format", "pcm")
+    if audio_format not in ("pcm", "ulaw", "opus"):
+        return {"status": "error", "command": "listen_start", "message": "'format' must be one of: pcm, ulaw, opus."}
+    if audio_format == "opus" and opuslib is None:
+        return {"status": "error", "command": "listen_start", "message": "Opus is not available on this server (opuslib is not installed)."}
+    session = listen_sessions.get(websocket)
+    if session is not None:
+        session["format"] = audio_format # Повторный listen_start меняет формат на лету
+        return {"status": "success", "command": "listen_start", "format": audio_format}
+    if len(listen_sessions) >= LISTEN_MAX_CLIENTS:
+        return {"status": "error", "command": "listen_start", "message": f"Listener limit ({LISTEN_MAX_CLIENTS}) reached."}
+    if not await _call_audio_subscribe():
+        return {"status": "error", "command": "listen_start", "message": "SIP client did not start the call audio tap (is a call active?)."}
+    session = {"format": audio_format, "queue": asyncio.Queue(maxsize=LISTEN_QUEUE_FRAMES), "sent": 0, "dropped": 0}
+    session["task"] = asyncio.create_task(_listen_pump(websocket, session))
+    listen_sessions[websocket] = session
+    print(f"[CALL_AUDIO] {websocket.remote_address} слушает звонок ({audio_format}), слушателей: {len(listen_sessions)}", file=sys.stderr)
+    return {"status": "success", "command": "listen_start", "format": audio_format, "sample_rate": 8000 if audio_format == "ulaw" else CALL_AUDIO_RELAY_RATE}
+
+
+async def _listen_stop(websocket) -> dict:
+    session = listen_sessions.pop(websocket, None)
+    if session is None:
+        return {"status": "error", "command": "listen_stop", "message": "Not listening."}
+    session["task"].cancel()
+    if not listen_sessions and announcement_watch is None:
+        await _call_audio_unsubscribe()
+    print(f"[CALL_AUDIO] {websocket.remote_address} перестал слушать: отправлено {session['sent']}, потеряно {session['dropped']} кадров", file=sys.stderr)
+    return {"status": "success", "command": "listen_stop", "sent": session["sent"], "dropped": session["dropped"]}
+
+
+async def _talk_start(websocket, request: dict):
+    """
+    Начинает передачу голоса оператора в звонок. Возвращает (сессия или None, ответ).
+    Кадры: "pcm" - моно int16 на sample_rate, "ulaw" - G.711 8 кГц, "opus" - пакеты Opus.
+    """
+    global talk_owner
+    audio_format = request.get("format", "pcm")
+    sample_rate = request.get("sample_rate", 8000 if audio_format == "ulaw" else CALL_AUDIO_RELAY_RATE)
+    if audio_format not in ("pcm", "ulaw", "opus") or not isinstance(sample_rate, int) or not 0 < sample_rate <= 48000:
+        return None, {"status": "error", "command": "talk_start", "message": "'format' must be pcm, ulaw or opus and 'sample_rate' a positive integer (Hz)."}
+    if audio_format == "opus" and opuslib is None:
+        return None, {"status": "error", "command": "talk_start", "message": "Opus is not available on this server (opuslib is not installed)."}
+    if audio_format == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+        return None, {"status": "error", "command": "talk_start", "message": f"Opus 'sample_rate' must be one of {', '.join(map(str, OPUS_SAMPLE_RATES))}."}
+    if talk_owner is not None:
+        return None, {"status": "error", "command": "talk_start", "message": "Another operator is already talking."}
+    talk_owner = websocket # Занимаем до ответа sip-session3, чтобы второй оператор не прошел проверку выше
+    sip_client_response = await send_command_to_sip_client(f"/udpaudio {CALL_AUDIO_INJECT_PORT} - 0")
+    # /udpaudio отвечает текстом, а не JSON: первая строка - "Запуск UDP аудио: ..." или "Ошибка: ..."
+    if "Запуск UDP аудио" not in sip_client_response.get("message", ""):
+        talk_owner = None
+        print(f"[CALL_AUDIO_ERR] sip-session3 не принял голос оператора: {sip_client_response.get('message')}", file=sys.stderr)
+        return None, {"status": "error", "command": "talk_start", "message": "SIP client did not start call audio input.", "sip_client_response": sip_client_response}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    session = {
+        "format": audio_format, "rate": 8000 if audio_format == "ulaw" else sample_rate, "sock": sock,
+        "seq": 0, "timestamp": 0, "bytes": 0, "dropped": 0,
+        "decoder": opuslib.Decoder(sample_rate, 1) if audio_format == "opus" else None,
+    }
+    print(f"[CALL_AUDIO] {websocket.remote_address} говорит в звонок ({audio_format}, {session['rate']} Hz)", file=sys.stderr)
+    return session, {"status": "success", "command": "talk_start", "format": audio_format, "sample_rate": session["rate"], "sip_client_response": sip_client_response}
+
+
+def _talk_frame(session: dict, message: bytes):
+    """Режет кадр оператора на куски по TALK_FRAME_MS и отправляет их в /udpaudio sip-session3 с заголовком."""
+    if len(message) > TALK_MAX_MESSAGE_BYTES:
+        session["dropped"] += 1
+        return
+    session["bytes"] += len(message)
+    rate = session["rate"]
+    if session["format"] == "opus":
+        message = session["decoder"].decode(message, rate * 120 // 1000) # До 120 мс в пакете Opus
+    if session["format"] == "ulaw":
+        payload_type, bytes_per_sample = PT_PCMU, 1
+    else:
+        payload_type, bytes_per_sample = PT_L16, 2
+    chunk = rate * TALK_FRAME_MS // 1000 * bytes_per_sample
+    for offset in range(0, len(message) - len(message) % bytes_per_sample, chunk):
+        payload = message[offset:offset + chunk]
+        header = CALL_AUDIO_HEADER.pack(CALL_AUDIO_MAGIC, payload_type, 0, session["seq"] & 0xFFFF, session["timestamp"] & 0xFFFFFFFF, rate)
+        try:
+            session["sock"].sendto(header + payload, (SIP_CLIENT_HOST, CALL_AUDIO_INJECT_PORT))
+        except OSError:
+            session["dropped"] += 1
+        session["seq"] += 1
+        session["timestamp"] += len(payload) // bytes_per_sample
+
+
+async def _talk_stop(session: dict) -> dict:
+    global talk_owner
+    talk_owner = None
+    session["sock"].close()
+    sip_client_response = await send_command_to_sip_client("/stopudpaudio")
+    print(f"[CALL_AUDIO] Голос оператора отключен: получено {session['bytes']} байт, отброшено {session['dropped']} кадров", file=sys.stderr)
+    return {"status": "success", "command": "talk_stop", "sip_client_response": sip_client_response}
+
+
 async def _handle_vosk_results_from_client(reader, writer):
     """
     Обработчик для входящих TCP-соединений от vosk_recognition_tcp_client.py
@@ -328,20 +829,23 @@ async def _handle_vosk_results_from_client(reader, writer):
             
             try:
                 result_json = json.loads(result_str)
+                if not _check_result_sequence(result_json):
+                    continue # Повтор после переподключения
+                result_json = _restore_partial_text(result_json)
+                # Поток распознавания автоинформатора - внутренний, клиентам не рассылается. После
+                # закрытия окна Vosk-клиент еще присылает его recognition_final_on_stop - их отбрасываем
+                if str(result_json.get("stream", "")).startswith(ANNOUNCEMENT_STREAM_PREFIX):
+                    if announcement_watch is not None and result_json["stream"] == announcement_watch["stream"]:
+                        await _announcement_result(result_json)
+                    continue
+                # Результаты WS-потоков распознавания идут только их владельцу
+                owner = asr_stream_owners.get(result_json.get("stream"))
+                # --- ПОИСК КЛЮЧЕВЫХ СЛОВ ---
+                for keyword_event in _spot_keywords(result_json):
+                    print(f"[KEYWORD] '{keyword_event['keyword']}' в потоке '{keyword_event['stream']}': {keyword_event['text']}", file=sys.stderr)
+                    await _broadcast_to_ws_clients(keyword_event, {owner} if owner else None)
                 # --- РАССЫЛКА НА WS-КЛИЕНТЫ ---
-                disconnected_clients = set()
-                for client_ws in list(websocket_clients):
-                    try:
-                        await client_ws.send(json.dumps(result_json))
-                    except websockets.exceptions.ConnectionClosedOK:
-                        disconnected_clients.add(client_ws)
-                    except websockets.exceptions.ConnectionClosedError as e:
-                        print(f"[WS_BROADCAST_ERR] Ошибка отправки на {client_ws.remote_address}: {e}", file=sys.stderr)
-                        disconnected_clients.add(client_ws)
-                    except Exception as e:
-                        print(f"[WS_BROADCAST_ERR] Неожиданная ошибка отправки на {client_ws.remote_address}: {e}", file=sys.stderr)
-                        disconnected_clients.add(client_ws)
-                websocket_clients.difference_update(disconnected_clients)
+                await _broadcast_to_ws_clients(result_json, {owner} if owner else websocket_clients - keyword_only_clients)
 
             except json.JSONDecodeError:
                 print(f"[VOSK_RESULTS_TCP_ERR] Невалидный JSON от Vosk-клиента: '{result_str}'", file=sys.stderr)
@@ -394,6 +898,16 @@ async def _generate_and_play_speech(text: str) -> dict:
 
         print(f"[TTS] Речь сохранена во временный файл: {temp_wav_file}", file=sys.stderr)
 
+        # Речь идет в звонок через микрофон, мимо play_sound: AMD sip-session3 не должен
+        # принять ее за приветствие автоответчика
+        if current_sip_client_process is not None:
+            try:
+                with wave.open(temp_wav_file, 'rb') as wav:
+                    duration_ms = wav.getnframes() * 1000 // wav.getframerate()
+                await send_command_to_sip_client(f"/amdmute {duration_ms}")
+            except (wave.Error, EOFError) as e:
+                print(f"[TTS_ERR] Не удалось определить длительность речи для AMD: {e}", file=sys.stderr)
+
         # Воспроизведение через paplay
         paplay_cmd = [PAPLAY_COMMAND_PATH, temp_wav_file, f'--device={PAPLAY_DEVICE}']
         print(f"[PAPLAY] Воспроизведение TTS: {' '.join(paplay_cmd)}", file=sys.stderr)
@@ -429,6 +943,38 @@ async def _generate_and_play_speech(text: str) -> dict:
                 print(f"[TTS_ERR] Не удалось удалить временный TTS файл {temp_wav_file}: {e}", file=sys.stderr)
 
 
+async def _amd_leave_message(text: str):
+    """Говорит короткое сообщение автоответчику после сигнала и кладет трубку."""
+    await _generate_and_play_speech(text)
+    await send_command_to_sip_client("/hangup")
+
+
+async def _amd_apply_policy(result: str):
+    """
+    Действие по политике звонка: на автоответчике останавливаем начатую речь
+    (полный текст тревоги не нужен записи), затем кладем трубку сразу
+    ("hangup") или после сигнала оставляем короткое сообщение ("message").
+    """
+    global amd_policy
+    if amd_policy is None or result == "human":
+        amd_policy = None
+        return
+    if result == "machine":
+        try:
+            process228.kill()
+        except Exception:
+            pass
+        if amd_policy["action"] == "hangup":
+            amd_policy = None
+            print("[AMD] Автоответчик: кладем трубку.", file=sys.stderr)
+            await send_command_to_sip_client("/hangup")
+    elif result == "beep" and amd_policy["action"] == "message":
+        text = amd_policy["text"]
+        amd_policy = None
+        print("[AMD] Автоответчик: оставляем сообщение.", file=sys.stderr)
+        asyncio.create_task(_amd_leave_message(text))
+
+
 # --- Функция для чтения stdout SIP-клиента и отправки DTMF ---
 async def _read_sip_client_stdout_and_handle_dtmf():
     global current_sip_client_process, websocket_clients
@@ -439,9 +985,13 @@ async def _read_sip_client_stdout_and_handle_dtmf():
     reader = current_sip_client_process.stdout
     print("[SIP_PROGRAM_READER] Запущена задача чтения stdout SIP-клиента для DTMF.", file=sys.stderr)
     
-    # Регулярное выражение для поиска "Got DMTF X"
+    # Регулярное выражение для поиска "Got DMTF X (источник)"; источник - rfc2833 или inband
     import re
-    dtmf_pattern = re.compile(r"Got DMTF (\S+)")
+    dtmf_pattern = re.compile(r"Got DMTF (\S+)(?: \((\w+)\))?")
+    progress_pattern = re.compile(r"Call progress tone: ([\w-]+)")
+    amd_result_pattern = re.compile(r"AMD result: (human|machine) \(([\w-]+)\)")
+    amd_beep_pattern = re.compile(r"AMD beep: (\w+)")
+    call_failed_pattern = re.compile(r"Call failed: ([\w-]+)")
 
     try:
         while True:
@@ -453,6 +1003,34 @@ async def _read_sip_client_stdout_and_handle_dtmf():
             decoded_line = line.decode('utf-8', errors='ignore').strip()
             print(f"[PROGRAM_OUT] {decoded_line}", file=sys.stderr) # Печатаем весь stdout
             
+            # Исходящий звонок завершен по тону хода соединения (занято, SIT, факс...)
+            progress_match = progress_pattern.search(decoded_line)
+            if progress_match:
+                print(f"[CALL_PROGRESS] Тон хода соединения: {progress_match.group(1)}. Отправка по WebSocket.", file=sys.stderr)
+                await _broadcast_to_ws_clients({"event": "call_progress", "tone": progress_match.group(1)})
+
+            # Досрочное завершение звонка (тон, автоответчик, автоинформатор)
+            failed_match = call_failed_pattern.search(decoded_line)
+            if failed_match:
+                await _broadcast_to_ws_clients({"event": "call_failed", "reason": failed_match.group(1)})
+                await _announcement_watch_stop()
+
+            # Ответ: автоинформатор слушаем еще ANNOUNCEMENT_AFTER_ANSWER секунд
+            if decoded_line == "Connected" and announcement_watch is not None:
+                _announcement_watch_expire(announcement_watch["stream"], ANNOUNCEMENT_AFTER_ANSWER)
+
+            # Определение автоответчика: результат и сигнал, после которого можно оставить сообщение
+            amd_match = amd_result_pattern.search(decoded_line)
+            if amd_match:
+                print(f"[AMD] Ответил {amd_match.group(1)} ({amd_match.group(2)}).", file=sys.stderr)
+                await _broadcast_to_ws_clients({"event": "amd_result", "result": amd_match.group(1), "reason": amd_match.group(2)})
+                await _amd_apply_policy(amd_match.group(1))
+            amd_match = amd_beep_pattern.search(decoded_line)
+            if amd_match:
+                print(f"[AMD] Сигнал автоответчика: {amd_match.group(1)}.", file=sys.stderr)
+                await _broadcast_to_ws_clients({"event": "amd_beep", "beep": amd_match.group(1)})
+                await _amd_apply_policy("beep")
+
             # Проверяем на DTMF
             match = dtmf_pattern.search(decoded_line)
             if match:
@@ -460,6 +1038,8 @@ async def _read_sip_client_stdout_and_handle_dtmf():
                 print(f"[DTMF_DETECTED] Обнаружен DTMF: {dtmf_digit}. Отправка по WebSocket.", file=sys.stderr)
                 
                 dtmf_event = {"event": "dtmf_received", "digit": dtmf_digit}
+                if match.group(2):
+                    dtmf_event["source"] = match.group(2)
                 
                 disconnected_clients = set()
                 for client_ws in list(websocket_clients):
@@ -489,14 +1069,39 @@ async def websocket_handler(websocket, path):
     # Добавляем sip_client_stdout_task и sip_client_stderr_task в global здесь,
     # так как они могут быть присвоены внутри этой функции (при запуске sip-клиента).
     global sip_client_stdout_task, sip_client_stderr_task
+    global keyword_spotter # Пересоздается командой set_keywords
+    global amd_policy # Задается командой call
 
 
     client_address = websocket.remote_address
     print(f"[WS] Новое WebSocket-соединение от {client_address}")
     websocket_clients.add(websocket) # Добавляем нового клиента в список
+    asyncio.create_task(_update_partial_rate())
+
+    asr_session = None # Поток распознавания PCM из бинарных кадров этого клиента
+    talk_session = None # Голос оператора в звонок из бинарных кадров этого клиента
 
     try:
         async for message in websocket:
+            if isinstance(message, bytes):
+                # Бинарный кадр - голос оператора после talk_start...
+                if talk_session is not None:
+                    _talk_frame(talk_session, message)
+                    continue
+                # ...или моно int16 PCM для потока, открытого asr_start
+                if asr_session is None:
+                    continue
+                try:
+                    asr_session["writer"].write(message)
+                    asr_session["bytes"] += len(message)
+                    await asr_session["writer"].drain() # Обратное давление, если распознавание не успевает
+                except OSError as e:
+                    print(f"[ASR_WS_ERR] Поток '{asr_session['stream']}' оборван: {e}", file=sys.stderr)
+                    await _asr_close(asr_session)
+                    await websocket.send(json.dumps({"status": "error", "command": "asr_audio", "stream": asr_session["stream"], "message": "Recognition stream lost."}))
+                    asr_session = None
+                continue
+
             print(f"[WS] Получено сообщение от {client_address}: {message}")
             ws_response = {} # Ответ для WebSocket клиента
 
@@ -518,6 +1123,16 @@ async def websocket_handler(websocket, path):
                         ws_response = {"status": "error", "message": "Missing 'number' for 'call' command."}
                         await websocket.send(json.dumps(ws_response))
                         continue
+                    announcements = request.get("announcements", ANNOUNCEMENT_PHRASES) # false - не распознавать
+                    if announcements and (not isinstance(announcements, dict) or not all(isinstance(k, str) and isinstance(v, str) and re.match(r'^[\w-]+$', v) for k, v in announcements.items())):
+                        ws_response = {"status": "error", "message": "'announcements' must map phrases to codes (letters, digits, '-')."}
+                        await websocket.send(json.dumps(ws_response))
+                        continue
+                    on_machine = request.get("on_machine") # None - только сообщить amd_result
+                    if on_machine not in (None, "hangup", "message") or (on_machine == "message" and not request.get("machine_text")):
+                        ws_response = {"status": "error", "message": "'on_machine' must be 'hangup' or 'message' (with 'machine_text')."}
+                        await websocket.send(json.dumps(ws_response))
+                        continue
 
                     # Проверка статуса SIP-клиента перед звонком
                     call_active_on_sip_client = False
@@ -572,6 +1187,10 @@ async def websocket_handler(websocket, path):
                         # Отправка команды "audio" на SIP-клиент (через его TCP-интерфейс)
                         call_command_for_sip = f"/audio {number}@{AUDIO_CALL_DOMAIN}"
                         sip_client_response_call = await send_command_to_sip_client(call_command_for_sip)
+                        amd_policy = {"action": on_machine, "text": request.get("machine_text")} if on_machine else None
+                        announcements_watched = await _announcement_watch_start(announcements) if announcements else None
+                        if listen_sessions:
+                            await _call_audio_subscribe() # Слушатели остались с прошлого звонка
                         
                         ws_response = {
                             "status": "success",
@@ -580,6 +1199,8 @@ async def websocket_handler(websocket, path):
                             "sip_client_response": sip_client_response_call,
                             "program_pid": current_sip_client_process.pid
                         }
+                        if announcements_watched is not None:
+                            ws_response["announcement_watch"] = announcements_watched
                     except FileNotFoundError:
                         ws_response = {"status": "error", "message": f"Program '{call_program_path}' not found. Make sure it's in the correct path."}
                         print(f"[WS] Ошибка: Программа '{call_program_path}' не найдена.", file=sys.stderr)
@@ -590,6 +1211,7 @@ async def websocket_handler(websocket, path):
                 
                 elif command == "hangup":
                     # Отправка команды "hangup" на SIP-клиент (через его TCP-интерфейс)
+                    await _announcement_watch_stop()
                     sip_client_response = await send_command_to_sip_client("/hangup")
                     ws_response = {
                         "status": "success",
@@ -615,8 +1237,16 @@ async def websocket_handler(websocket, path):
                     }
 
                 elif command == "start_recognition":
-                    # Отправляем команду Vosk-клиенту по TCP
-                    response = await send_command_to_vosk_client("start_recognition")
+                    # Отправляем команду Vosk-клиенту по TCP. Необязательный список
+                    # "phrases" переводит распознавание на ограниченную грамматику,
+                    # "endpointing" ({"stable_ms", "silence_db"} или false) задает ранний
+                    # конец фразы (событие utterance_end) для этого звонка.
+                    params = {key: request[key] for key in ("phrases", "endpointing") if key in request}
+                    if params:
+                        vosk_command = f"start_recognition {json.dumps(params, ensure_ascii=False)}"
+                    else:
+                        vosk_command = "start_recognition"
+                    response = await send_command_to_vosk_client(vosk_command)
                     ws_response = {
                         "status": response["status"],
                         "command": "start_recognition",
@@ -631,6 +1261,66 @@ async def websocket_handler(websocket, path):
                         "message": response["message"]
                     }
 
+                elif command == "asr_start":
+                    # {"command": "asr_start", "sample_rate": 16000, "phrases"?: [...], "endpointing"?: {...}},
+                    # далее бинарные кадры PCM; partial/final приходят на это же соединение
+                    if asr_session is not None:
+                        ws_response = {"status": "error", "command": "asr_start", "message": f"Stream '{asr_session['stream']}' is already open."}
+                    else:
+                        asr_session, ws_response = await _asr_open(websocket, request)
+
+                elif command == "asr_stop":
+                    if asr_session is None:
+                        ws_response = {"status": "error", "command": "asr_stop", "message": "No open recognition stream."}
+                    else:
+                        await _asr_close(asr_session)
+                        ws_response = {"status": "success", "command": "asr_stop", "stream": asr_session["stream"]}
+                        asr_session = None
+
+                elif command == "listen_start":
+                    # {"command": "listen_start", "format"?: "pcm"|"ulaw"|"opus"} - звук звонка
+                    # приходит на это соединение бинарными кадрами с заголовком
+                    ws_response = await _listen_start(websocket, request)
+
+                elif command == "listen_stop":
+                    ws_response = await _listen_stop(websocket)
+
+                elif command == "talk_start":
+                    # {"command": "talk_start", "format"?: "pcm"|"ulaw"|"opus", "sample_rate"?: 16000},
+                    # далее бинарные кадры с голосом оператора идут в звонок
+                    if talk_session is not None:
+                        ws_response = {"status": "error", "command": "talk_start", "message": "Already talking."}
+                    else:
+                        talk_session, ws_response = await _talk_start(websocket, request)
+
+                elif command == "talk_stop":
+                    if talk_session is None:
+                        ws_response = {"status": "error", "command": "talk_stop", "message": "Not talking."}
+                    else:
+                        ws_response = await _talk_stop(talk_session)
+                        talk_session = None
+
+                elif command == "set_keywords":
+                    # Новый набор фраз для поиска; "transcripts": false - присылать этому
+                    # клиенту только keyword_detected без потока partial/final
+                    keywords = request.get("keywords")
+                    if keywords is not None and not (isinstance(keywords, list) and all(isinstance(k, str) for k in keywords)):
+                        ws_response = {"status": "error", "message": "'keywords' must be a list of strings."}
+                    else:
+                        if keywords is not None:
+                            keyword_spotter = KeywordSpotter(keywords)
+                        if request.get("transcripts") is False:
+                            keyword_only_clients.add(websocket)
+                        elif request.get("transcripts") is True:
+                            keyword_only_clients.discard(websocket)
+                        asyncio.create_task(_update_partial_rate())
+                        ws_response = {
+                            "status": "success",
+                            "command": "set_keywords",
+                            "keywords": keyword_spotter.keywords,
+                            "transcripts": websocket not in keyword_only_clients
+                        }
+
                 elif command == "speak":
                     text_to_speak = request.get("text")
                     if text_to_speak:
@@ -684,6 +1374,14 @@ async def websocket_handler(websocket, path):
     finally:
         if websocket in websocket_clients: # Проверяем, чтобы избежать KeyError
             websocket_clients.remove(websocket)
+        keyword_only_clients.discard(websocket)
+        if asr_session is not None:
+            await _asr_close(asr_session)
+        if websocket in listen_sessions:
+            await _listen_stop(websocket)
+        if talk_session is not None:
+            await _talk_stop(talk_session)
+        asyncio.create_task(_update_partial_rate())
 
 
 async def main():
@@ -694,6 +1392,7 @@ async def main():
     print(f"Сервер будет запускать внешний SIP-клиент: {call_program_cmd}")
     print(f"Сервер будет общаться с Vosk-клиентом (для команд) на {VOSK_CLIENT_COMMAND_HOST}:{VOSK_CLIENT_COMMAND_PORT}")
     print(f"Сервер будет слушать результаты Vosk-клиента на {VOSK_CLIENT_RESULTS_LISTEN_HOST}:{VOSK_CLIENT_RESULTS_LISTEN_PORT}")
+    print(f"Сервер будет передавать PCM из WebSocket на распознавание в {VOSK_CLIENT_INGEST_HOST}:{VOSK_CLIENT_INGEST_PORT} (до {ASR_MAX_STREAMS} потоков)")
 
     # Инициализация TTS движка
     print("[TTS] Инициализация TTS движка...", file=sys.stderr)
@@ -721,6 +1420,12 @@ async def main():
     results_addr = vosk_results_server.sockets[0].getsockname()
     print(f"[VOSK_RESULTS_TCP] Сервер для результатов Vosk запущен на {results_addr}", file=sys.stderr)
 
+    # UDP-ретранслятор звука звонка для WS-слушателей
+    await asyncio.get_running_loop().create_datagram_endpoint(
+        _CallAudioRelay, local_addr=(CALL_AUDIO_RELAY_HOST, CALL_AUDIO_RELAY_PORT)
+    )
+    print(f"[CALL_AUDIO] Ретранслятор звука звонка слушает {CALL_AUDIO_RELAY_HOST}:{CALL_AUDIO_RELAY_PORT} (до {LISTEN_MAX_CLIENTS} слушателей, Opus: {'есть' if opuslib else 'нет'})", file=sys.stderr)
+
 
     async with websockets.serve(websocket_handler, WS_HOST, WS_PORT):
         await vosk_results_server.serve_forever() # Запускаем сервер для результатов Vosk на неопределенное время
@@ -0,0 +1,165 @@
+# audio_assets.py
+"""
+Звуки sip-session3 в памяти: тоны DTMF, гудки, сигналы удержания и
+окончания звонка.
+
+AudioAssetCache один раз при старте декодирует WAV-файлы в массивы int16
+на частоте микшера (сведение в моно и ресемплинг - audio_dsp), так что во
+время звонка звуки не читаются с диска и плееры не создаются.
+ClipScheduler смешивает запущенные звуки покадрово: у каждого звука есть
+точное начало в отсчетах выходного потока, повторы с паузой и громкость,
+поэтому серию тонов (например, набор DTMF) можно разложить по времени
+заранее с точностью до отсчета.
+"""
+import os
+import sys
+import wave
+from threading import Lock
+
+import numpy as np
+
+from sipclient.audio_dsp import PolyphaseResampler, as_int16_array, downmix_to_mono
+
+MIXER_FRAME_MS = 20 # Длительность кадра микшера
+
+
+def decode_wav(path, sample_rate):
+    """Читает 16-битный WAV и возвращает моно int16 на частоте sample_rate."""
+    with wave.open(path, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"поддерживается только 16-битный PCM, а не {wav.getsampwidth() * 8}-битный")
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        samples = as_int16_array(wav.readframes(wav.getnframes()))
+    if channels > 1:
+        samples = downmix_to_mono(samples[:samples.size - samples.size % channels].reshape(-1, channels))
+    return PolyphaseResampler(rate, sample_rate).process(samples).copy()
+
+
+class AudioAssetCache:
+    """Декодированные звуки по пути к файлу; все на одной частоте (микшера)."""
+
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self._assets = {}
+        self._lock = Lock()
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._assets
+
+    @property
+    def nbytes(self):
+        return sum(samples.nbytes for samples in self._assets.values())
+
+    def load(self, path):
+        samples = decode_wav(path, self.sample_rate)
+        samples.setflags(write=False) # Один массив на все проигрывания
+        with self._lock:
+            self._assets[os.path.abspath(path)] = samples
+        return samples
+
+    def preload(self, paths):
+        """Загружает список файлов; возвращает [(путь, ошибка), ...] для не загрузившихся."""
+        failed = []
+        for path in paths:
+            try:
+                self.load(path)
+            except (OSError, EOFError, ValueError, wave.Error) as e:
+                failed.append((path, e))
+        return failed
+
+    def get(self, path):
+        """Звук из кэша; то, что не было загружено заранее, читается один раз при первом обращении."""
+        samples = self._assets.get(os.path.abspath(path))
+        if samples is None:
+            print(f"[ASSETS] '{path}' не был загружен заранее, читаем с диска.", file=sys.stderr)
+            samples = self.load(path)
+        return samples
+
+
+class Playback:
+    """Один запущенный звук в ClipScheduler; stop() можно вызывать из любого потока."""
+
+    def __init__(self, samples, start, volume=100, loop_count=1, pause_samples=0):
+        if volume != 100:
+            samples = (samples.astype(np.int32) * volume // 100).astype(np.int16)
+        self.samples = samples
+        self.start = start
+        self.period = samples.size + pause_samples
+        # loop_count=0 - бесконечный повтор, как у WavePlayer
+        self.end = None if loop_count == 0 else start + loop_count * self.period - pause_samples
+        self.stopped = False
+
+    @property
+    def duration_samples(self):
+        return None if self.end is None else self.end - self.start
+
+    def stop(self):
+        self.stopped = True
+
+    def finished(self, position):
+        return self.stopped or (self.end is not None and position >= self.end)
+
+    def mix_into(self, out, position):
+        """Добавляет свою часть интервала [position, position + len(out)) в out (int32)."""
+        frame_end = position + out.size
+        if self.end is not None:
+            frame_end = min(frame_end, self.end)
+        cursor = max(position, self.start)
+        size = self.samples.size
+        while cursor < frame_end:
+            offset = (cursor - self.start) % self.period
+            if offset >= size:
+                cursor += self.period - offset # Пауза между повторами
+                continue
+            count = min(size - offset, frame_end - cursor)
+            out[cursor - position:cursor - position + count] += self.samples[offset:offset + count]
+            cursor += count
+
+
+class ClipScheduler:
+    """
+    Смеситель звуков по кадрам микшера. `position` - номер первого отсчета
+    следующего кадра; play() ставит звук на position + delay_ms, next_frame()
+    выдает очередной кадр (или None, если играть нечего).
+    """
+
+    def __init__(self, sample_rate, frame_ms=MIXER_FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self.position = 0
+        self._playbacks = []
+        self._lock = Lock()
+
+    def samples_for(self, ms):
+        return int(ms) * self.sample_rate // 1000
+
+    def play(self, samples, delay_ms=0, volume=100, loop_count=1, pause_ms=0):
+        with self._lock:
+            playback = Playback(samples, self.position + self.samples_for(delay_ms), volume, loop_count, self.samples_for(pause_ms))
+            self._playbacks.append(playback)
+        return playback
+
+    def stop_all(self):
+        with self._lock:
+            for playback in self._playbacks:
+                playback.stop()
+            self._playbacks = []
+
+    @property
+    def active(self):
+        return len(self._playbacks)
+
+    def next_frame(self):
+        with self._lock:
+            position = self.position
+            self.position += self.frame_samples
+            playbacks = [playback for playback in self._playbacks if not playback.finished(position)]
+            self._playbacks = playbacks
+        if not playbacks:
+            return None
+        out = np.zeros(self.frame_samples, dtype=np.int32)
+        for playback in playbacks:
+            playback.mix_into(out, position)
+        return np.clip(out, -32768, 32767).astype(np.int16).tobytes()
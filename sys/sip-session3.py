@@ -24,6 +24,7 @@ from optparse import OptionParser
 from pathlib import Path
 from threading import Event, Thread, RLock
 from time import sleep
+import time
 
 from application import log
 from application.system import makedirs
@@ -37,7 +38,6 @@ from gnutls.crypto import X509Certificate, X509PrivateKey
 
 from twisted.internet import reactor
 from zope.interface import implementer
-from sipsimple.audio import WaveRecorder
 
 try:
     from otr import OTRTransport, OTRState, SMPStatus
@@ -76,6 +76,9 @@ from sipclient.configuration.settings import SIPSimpleSettingsExtension
 from sipclient.log import Logger
 from sipclient.system import IPAddressMonitor, copy_default_certificates
 from sipclient.ui import UI # Import only UI, not RichText, Prompt, Question
+from sipclient.audio_assets import AudioAssetCache, ClipScheduler
+from sipclient.audio_dsp import AnsweringMachineDetector, CallProgressDetector, DtmfDetector
+from sipclient.udp_audio import AudioTap, DatagramReceiver, DatagramSubscriber, DetectorSubscriber, JitterBuffer, JitterBufferPlayer, SharedMemorySubscriber, format_name, parse_audio_format
 
 import socket
 from threading import Thread, Event
@@ -100,6 +103,17 @@ except ImportError:
         def __init__(self, *args, **kwargs):
             pass
 
+DTMF_INTERVAL_MS = 300 # Шаг между цифрами /dtmf (меняется командой /dtmfpace)
+DTMF_TONE_MS = None # Длительность тона цифры; None - весь WAV
+SOUND_PORT_FRAME_MS = 20 # Кадр MemoryPlayerPort (как у микшера)
+INBAND_DTMF_DETECTION = True # Искать тональные DTMF в звуке каждого звонка
+DTMF_DEDUP_MS = 500 # Одна клавиша, пришедшая и по RFC 2833, и тоном, выдается один раз
+CALL_PROGRESS_DETECTION = True # Класть трубку исходящего звонка, услышав занято/перегрузку/SIT/факс
+AMD_DETECTION = True # Определять автоответчик в начале ответившего исходящего звонка
+AMD_PLAYBACK_ON_MACHINE = 'hangup' # Звонки из каталога playback на автоответчик: 'hangup' или 'continue'
+AMD_MUTE_TAIL_MS = 300 # Сколько после конца нашего звука (тоны, подсказки, TTS) AMD еще не слушает микс
+UDP_RECEIVE_TIMEOUT = 0.5 # Как часто поток приема UDP проверяет флаг остановки (сек)
+
 @implementer(IAudioPort)
 class UDPPlayerPort(Thread):
     def __init__(self, mixer, host, port):
@@ -120,11 +134,13 @@ class UDPPlayerPort(Thread):
             self.ui.write(f"[!] UDP Player Port: не удалось забиндить порт: {e}")
             self.stop()
             return
+        receiver = DatagramReceiver(self.socket)
         while not self.stopped.is_set():
             try:
-                data, addr = self.socket.recvfrom(4096)
-                if data and self._player_port and self._player_port.is_active:
-                    self._player_port.write_samples(data)
+                for datagram in receiver.receive(timeout=UDP_RECEIVE_TIMEOUT):
+                    if datagram and self._player_port and self._player_port.is_active:
+                        # В микшер - копия: буфер пула перезапишется следующей пачкой
+                        self._player_port.write_samples(bytes(datagram))
             except Exception: break
         self.socket.close()
 
@@ -154,11 +170,62 @@ class UDPPlayerPort(Thread):
     def producer_slot(self): return self._player_port.slot if self._player_port else None
 
 @implementer(IAudioPort)
-class UDPRecorderPort(object):
-    def __init__(self, mixer, host, port):
+class MemoryPlayerPort(Thread):
+    """
+    Источник для моста: звуки из памяти (AudioAssetCache), которые ClipScheduler
+    смешивает по кадрам. Порт создается один раз и постоянно стоит в мосту;
+    без звуков он ничего не пишет в микшер.
+    """
+    def __init__(self, mixer, name):
+        Thread.__init__(self, daemon=True, name=f"MemoryPlayerPort-{name}")
         self.mixer = mixer
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.target_address = (host, port)
+        self.scheduler = ClipScheduler(mixer.sample_rate, SOUND_PORT_FRAME_MS)
+        self.stopped = Event()
+        self._player_port = None
+
+    def run(self):
+        frame_sec = self.scheduler.frame_ms / 1000.0
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            frame = self.scheduler.next_frame()
+            player_port = self._player_port
+            if frame is not None and player_port is not None and player_port.is_active:
+                try: player_port.write_samples(frame)
+                except Exception: pass
+            # Расписание по абсолютным меткам: позиция планировщика идет вровень с микшером
+            next_tick += frame_sec
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.stopped.wait(delay)
+
+    def start(self):
+        if self._player_port is not None: return
+        self._player_port = MixerPort(self.mixer)
+        self._player_port.start()
+        Thread.start(self)
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=False, producer_slot_changed=True, old_producer_slot=None, new_producer_slot=self.producer_slot))
+
+    def stop(self):
+        if self._player_port is None: return
+        old_producer_slot = self.producer_slot
+        self.stopped.set()
+        self.scheduler.stop_all()
+        self._player_port.stop()
+        self._player_port = None
+        notification_center = NotificationCenter()
+        notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=False, producer_slot_changed=True, old_producer_slot=old_producer_slot, new_producer_slot=None))
+
+    @property
+    def consumer_slot(self): return None
+    @property
+    def producer_slot(self): return self._player_port.slot if self._player_port else None
+
+class AudioTapPort(object):
+    """Потребитель моста: кадры микшера раздаются подписчикам AudioTap (UDP, Unix-сокет, разделяемая память)."""
+    def __init__(self, mixer):
+        self.mixer = mixer
+        self.tap = AudioTap(mixer.sample_rate)
         self._recorder_port = None
         self.ui = UI() # Получаем экземпляр UI для логирования
 
@@ -169,20 +236,20 @@ class UDPRecorderPort(object):
         self._recorder_port.start()
         notification_center = NotificationCenter()
         notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=True, producer_slot_changed=False, old_consumer_slot=None, new_consumer_slot=self.consumer_slot))
-        self.ui.write(f"[*] UDP Recorder Port: готов отправлять на {self.target_address}")
+        self.ui.write(f"[*] Audio Tap: отвод звука звонка запущен ({self.mixer.sample_rate} Гц)")
 
     def stop(self):
         if self._recorder_port is None: return
         old_consumer_slot = self.consumer_slot
         self._recorder_port.stop()
         self._recorder_port = None
-        self.socket.close()
+        self.tap.close()
         notification_center = NotificationCenter()
         notification_center.post_notification('AudioPortDidChangeSlots', sender=self, data=NotificationData(consumer_slot_changed=True, producer_slot_changed=False, old_consumer_slot=old_consumer_slot, new_consumer_slot=None))
-        self.ui.write("[*] UDP Recorder Port: остановлен.")
+        self.ui.write(f"[*] Audio Tap: остановлен. Роздано кадров: {self.tap.frames}")
 
     def _handle_audio_frame(self, frame):
-        try: self.socket.sendto(frame.data, self.target_address)
+        try: self.tap.feed(frame.data)
         except Exception: pass
 
     @property
@@ -208,11 +275,13 @@ class UDPListener(Thread):
             self.ui.write(f"[!] UDP Listener: ошибка биндинга порта: {e}")
             return
 
+        receiver = DatagramReceiver(self.socket)
         while not self.stopped.is_set():
             try:
-                data, _ = self.socket.recvfrom(4096)
-                if data and self.callback:
-                    self.callback(data)
+                # callback получает memoryview в буфер пула; данные, нужные дольше вызова, он копирует сам
+                for datagram in receiver.receive(timeout=UDP_RECEIVE_TIMEOUT):
+                    if datagram and self.callback:
+                        self.callback(datagram)
             except Exception:
                 break
         self.socket.close()
@@ -225,50 +294,8 @@ class UDPListener(Thread):
         except OSError:
             pass
 
-class UDPFileAdapter:
-    """
-    Объект, который притворяется файлом для WaveRecorder,
-    но отправляет данные в UDP, пропуская WAV-заголовок.
-    """
-    def __init__(self, host, port):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.target_address = (host, port)
-        self.header_skipped = False
-        # Стандартный размер WAV заголовка - 44 байта.
-        # Мы пропустим чуть больше для надежности.
-        self.bytes_to_skip = 44
-        self.ui = UI() # Получаем экземпляр UI для логирования
-        self.ui.write(f"[*] UDP File Adapter: готов отправлять на {self.target_address}")
-
-    def write(self, data):
-        """WaveRecorder будет вызывать этот метод."""
-        if not self.header_skipped:
-            if len(data) < self.bytes_to_skip:
-                self.bytes_to_skip -= len(data)
-                return len(data) # "Записываем" и игнорируем
-            else:
-                # Отправляем данные после заголовка
-                payload = data[self.bytes_to_skip:]
-                self.header_skipped = True
-                self.bytes_to_skip = 0
-        else:
-            payload = data
-
-        if payload:
-            try:
-                self.socket.sendto(payload, self.target_address)
-            except Exception as e:
-                self.ui.write(f"[!] UDP File Adapter: ошибка отправки: {e}")
-        return len(data)
-
-    def close(self):
-        self.socket.close()
-        self.ui.write("[*] UDP File Adapter: закрыт.")
-
-    # Методы, которые может ожидать WaveRecorder
-    def flush(self): pass
-    def seekable(self): return False
-    def tell(self): return 0
+def dtmf_sound_path(digit):
+    return ResourcePath('sounds/dtmf_%s_tone.wav' % {'*': 'star', '#': 'pound'}.get(digit, digit)).normalized
 
 
 # This is a helper function for sending formatted notice messages
@@ -785,6 +812,13 @@ class OutgoingCallInitializer(object):
         if chat:
             self.streams.append(MediaStreamRegistry.ChatStream())
         self.wave_ringtone = None
+        self.session = None
+        self.progress_subscriber = None # Номер подписчика отвода с классификатором тонов хода соединения
+        self.amd_subscriber = None # Номер подписчика отвода с детектором автоответчика
+        self.amd_decided = False # AMD уже решил, кто ответил: файл playback можно играть
+        self.playback_stream = None # Аудиопоток, на котором файл playback ждет решения AMD
+        self.failure = None # Причина, по которой звонок завершен досрочно (fail_call)
+        application.outgoing_call = self
 
     def start(self):
         if self.play_file:
@@ -854,6 +888,7 @@ class OutgoingCallInitializer(object):
         session = Session(self.account)
         notification_center.add_observer(self, sender=session)
         session.connect(ToHeader(self.target), routes=notification.data.result, streams=self.streams)
+        self.session = session
         application = SIPSessionApplication()
         application.outgoing_session = session
 
@@ -875,26 +910,105 @@ class OutgoingCallInitializer(object):
             remote_identity = '"%s" <%s>' % (session.remote_identity.display_name, remote_identity)
         show_notice("Initiating SIP session from %s to %s via %s..." % (local_identity, remote_identity, session.route))
         self.message_session_to = None
+        self._start_call_progress()
+
+    def _start_call_progress(self):
+        """Слушает звонок (ранние медиа и разговор) на тоны занято, перегрузки, SIT и факса."""
+        if not CALL_PROGRESS_DETECTION or self.progress_subscriber is not None:
+            return
+        application = SIPSessionApplication()
+        detector = CallProgressDetector(application.voice_audio_mixer.sample_rate)
+        on_tone = lambda event: reactor.callFromThread(self._got_call_progress_tone, event[0])
+        self.progress_subscriber = application._add_tap_subscriber(DetectorSubscriber('call progress %s' % self.target, detector, on_tone))
+
+    def _stop_call_progress(self):
+        if self.progress_subscriber is not None:
+            SIPSessionApplication()._remove_tap_subscriber(self.progress_subscriber)
+            self.progress_subscriber = None
+
+    def _start_amd(self):
+        """Слушает первые секунды ответа: человек или автоответчик, затем beep автоответчика."""
+        if not AMD_DETECTION or self.amd_subscriber is not None:
+            return
+        application = SIPSessionApplication()
+        detector = AnsweringMachineDetector(application.voice_audio_mixer.sample_rate)
+        on_event = lambda event: reactor.callFromThread(self._got_amd_event, event[0], event[1])
+        # Отвод слышит весь микс: пока звучит наш собственный звук, кадры детектору не отдаются
+        subscriber = DetectorSubscriber('AMD %s' % self.target, detector, on_event, gate=application.amd_listening)
+        self.amd_subscriber = application._add_tap_subscriber(subscriber)
+
+    def _stop_amd(self):
+        if self.amd_subscriber is not None:
+            SIPSessionApplication()._remove_tap_subscriber(self.amd_subscriber)
+            self.amd_subscriber = None
+
+    def _got_amd_event(self, kind, reason):
+        """Результат AMD печатается для websok; звонок с файлом на автоответчик завершается сам."""
+        if self.amd_subscriber is None:
+            return
+        if kind == 'beep':
+            show_notice('AMD beep: %s' % reason)
+            self._stop_amd()
+            return
+        show_notice('AMD result: %s (%s)' % (kind, reason))
+        if kind == 'human':
+            self._stop_amd()
+        elif self.play_file and AMD_PLAYBACK_ON_MACHINE == 'hangup':
+            self.fail_call('machine')
+            return
+        self._release_playback()
+
+    def _release_playback(self):
+        """AMD решил: запускаем файл playback, если он ждал решения."""
+        self.amd_decided = True
+        stream, self.playback_stream = self.playback_stream, None
+        if stream is not None:
+            self._stop_amd() # Дальше в миксе наша запись - beep в ней искать незачем
+            self._start_playback(stream)
+
+    def _got_call_progress_tone(self, kind):
+        """Звонок не состоится (или ответил факс) - кладем трубку сразу, не дожидаясь таймаутов SIP."""
+        if self.progress_subscriber is None:
+            return
+        show_notice('Call progress tone: %s, hanging up' % kind)
+        self.fail_call(kind)
+
+    def fail_call(self, reason):
+        """
+        Досрочно завершает звонок, который не состоится: файл playback сохраняется
+        как outgoing-failed-<reason>, websok получает строку "Call failed: <reason>".
+        Возвращает False, если звонка нет или он уже завершается.
+        """
+        if self.session is None or self.failure is not None:
+            return False
+        self.failure = reason
+        show_notice('Call failed: %s' % reason)
+        self._stop_call_progress()
+        self._stop_amd()
+        self.playback_stream = None
+        self._playback_end(failed_reason='outgoing-failed-' + reason)
+        self.session.end()
+        return True
 
     def _NH_SIPSessionGotRingIndication(self, notification):
         settings = SIPSimpleSettings()
         # ui = UI() # UI instance already available as self.ui
         ringtone = settings.sounds.audio_outbound
         if ringtone and self.wave_ringtone is None and not self.play_file:
-            self.wave_ringtone = WavePlayer(SIPApplication.voice_audio_mixer, ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
-            SIPApplication.voice_audio_bridge.add(self.wave_ringtone)
-            self.wave_ringtone.start()
+            self.wave_ringtone = SIPSessionApplication().play_sound(ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
         self.ui.write('Ringing...') # Changed from ui.status
 
     def _NH_SIPSessionWillStart(self, notification):
         # ui = UI() # UI instance already available as self.ui
         if self.wave_ringtone:
             self.wave_ringtone.stop()
-            SIPApplication.voice_audio_bridge.remove(self.wave_ringtone)
             self.wave_ringtone = None
         self.ui.write('Connecting...') # Changed from ui.status
 
     def _NH_SIPSessionDidEnd(self, notification):
+        self._stop_call_progress()
+        self._stop_amd()
+        self.playback_stream = None
         self._playback_end()
         session = notification.sender
         show_notice('Session ended by %s' % notification.data.originator)
@@ -915,6 +1029,7 @@ class OutgoingCallInitializer(object):
         session = notification.sender
         self.ui.write('Connected') # Changed from ui.status
         # No need for reactor.callLater to clear status as it's just a log now
+        self._start_amd()
 
         application = SIPSessionApplication()
         application.on_call_started() # <-- Вызов метода для обновления глобального статуса
@@ -950,24 +1065,35 @@ class OutgoingCallInitializer(object):
 
     def _NH_MediaStreamDidStart(self, notification):
         stream = notification.sender
-        if stream.type == 'audio' and self.play_file:
-            script = "%s/scripts/%s-playback-start" % (self.playback_dir, self.remote_identity)
-            if os.path.exists(script):
-                show_notice("Running script %s" % script)
-                p = subprocess.Popen(script)
-            else:
-                pass
-                #show_notice("Script does not exist %s" % script)
+        if stream.type != 'audio' or not self.play_file:
+            return
+        if AMD_DETECTION and not self.amd_decided:
+            # AMD слышит весь микс: наша запись с первой секунды выглядела бы
+            # длинным приветствием автоответчика, поэтому файл ждет решения
+            self.playback_stream = stream
+            show_notice("Playback waits for answering machine detection")
+            return
+        self._start_playback(stream)
+
+    def _start_playback(self, stream):
+        """Запускает скрипт playback-start и файл playback в мост звонка."""
+        script = "%s/scripts/%s-playback-start" % (self.playback_dir, self.remote_identity)
+        if os.path.exists(script):
+            show_notice("Running script %s" % script)
+            p = subprocess.Popen(script)
+        else:
+            pass
+            #show_notice("Script does not exist %s" % script)
 
-            file = ResourcePath(self.play_file).normalized
-            show_notice("Playback file %s\n" % file)
+        file = ResourcePath(self.play_file).normalized
+        show_notice("Playback file %s\n" % file)
 
-            self.playback_wave_player = WavePlayer(SIPApplication.voice_audio_mixer, file)
-            notification_center = NotificationCenter()
-            notification_center.add_observer(self, sender=self.playback_wave_player)
-            stream.bridge.add(self.playback_wave_player)
-            #SIPApplication.voice_audio_bridge.add(self.playback_wave_player)
-            self.playback_wave_player.start()
+        self.playback_wave_player = WavePlayer(SIPApplication.voice_audio_mixer, file)
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=self.playback_wave_player)
+        stream.bridge.add(self.playback_wave_player)
+        #SIPApplication.voice_audio_bridge.add(self.playback_wave_player)
+        self.playback_wave_player.start()
 
     def _NH_WavePlayerDidEnd(self, notification):
         notification_center = NotificationCenter()
@@ -993,6 +1119,8 @@ class OutgoingCallInitializer(object):
 
     def _NH_SIPSessionDidFail(self, notification):
         code = notification.data.code
+        self._stop_call_progress()
+        self._stop_amd()
         self._playback_end(failed_reason='outgoing-failed-' + str(code))
 
         notification_center = NotificationCenter()
@@ -1030,7 +1158,6 @@ class OutgoingCallInitializer(object):
 
         if self.wave_ringtone:
             self.wave_ringtone.stop()
-            SIPApplication.voice_audio_bridge.remove(self.wave_ringtone)
             self.wave_ringtone = None
         if notification.data.failure_reason == 'user request' and code == 487:
             show_notice('SIP session cancelled')
@@ -1066,24 +1193,20 @@ class OutgoingCallInitializer(object):
             show_notice("Saved playback file to %s\n" % save_path)
             os.rename(self.play_file, save_path)
 
+        # Пауза 0.2 с перед сигналом задается началом звука в планировщике, без sleep
         if not failed_reason:
             settings = SIPSimpleSettings()
-            api.sleep(0.2)
             rogertone = settings.sounds.roger_beep
-            roger_tone = WavePlayer(SIPApplication.voice_audio_mixer, rogertone.path.normalized)
             show_notice("Play roger beep")
-            SIPApplication.voice_audio_bridge.add(roger_tone)
-            roger_tone.start()
+            application.play_sound(rogertone.path.normalized, delay_ms=200)
         else:
-            api.sleep(0.2)
-            hangup_tone = WavePlayer(SIPApplication.voice_audio_mixer, ResourcePath('sounds/hangup_tone.wav').normalized)
-            SIPApplication.voice_audio_bridge.add(hangup_tone)
-            hangup_tone.start()
+            application.play_sound(ResourcePath('sounds/hangup_tone.wav').normalized, delay_ms=200)
 
+        # Скрипт получает исход, как в имени сохраненного файла: outgoing или outgoing-failed-<причина>
         script = "%s/scripts/%s-playback-end" % (self.playback_dir, self.remote_identity)
         if os.path.exists(script):
-            show_notice("Running script %s\n" % script)
-            p = subprocess.Popen(script)
+            show_notice("Running script %s %s\n" % (script, failed_reason or 'outgoing'))
+            p = subprocess.Popen([script, failed_reason or 'outgoing'])
 
         if os.path.exists(self.play_file):
             try:
@@ -1124,13 +1247,9 @@ class IncomingCallInitializer(object):
             if IncomingCallInitializer.sessions == 1:
                 ringtone = self.session.account.sounds.audio_inbound.sound_file if self.session.account.sounds.audio_inbound is not None else None
                 if ringtone:
-                    self.wave_ringtone = WavePlayer(SIPApplication.alert_audio_mixer, ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
-                    SIPApplication.alert_audio_bridge.add(self.wave_ringtone)
-                    self.wave_ringtone.start()
+                    self.wave_ringtone = application.play_sound(ringtone.path.normalized, port='alert', volume=ringtone.volume, loop_count=0, pause_time=2)
         elif IncomingCallInitializer.tone_ringtone is None:
-            IncomingCallInitializer.tone_ringtone = WavePlayer(SIPApplication.voice_audio_mixer, ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
-            SIPApplication.voice_audio_bridge.add(IncomingCallInitializer.tone_ringtone)
-            IncomingCallInitializer.tone_ringtone.start()
+            IncomingCallInitializer.tone_ringtone = application.play_sound(ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
         self.session.send_ring_indication()
 
         # No longer ask question directly, just log it.
@@ -1323,9 +1442,7 @@ class IncomingProposalHandler(object):
 
         # start ringing
         if IncomingProposalHandler.tone_ringtone is None:
-            IncomingProposalHandler.tone_ringtone = WavePlayer(SIPApplication.voice_audio_mixer, ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
-            SIPApplication.voice_audio_bridge.add(IncomingProposalHandler.tone_ringtone)
-            IncomingProposalHandler.tone_ringtone.start()
+            IncomingProposalHandler.tone_ringtone = SIPSessionApplication().play_sound(ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
         self.session.send_ring_indication()
 
         # No longer ask question directly, just log it.
@@ -1520,9 +1637,7 @@ class OutgoingTransferHandler(object):
         # ui = UI() # UI instance already available as self.ui
         ringtone = settings.sounds.audio_outbound
         if ringtone and self.wave_ringtone is None:
-            self.wave_ringtone = WavePlayer(SIPApplication.voice_audio_mixer, ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
-            SIPApplication.voice_audio_bridge.add(self.wave_ringtone)
-            self.wave_ringtone.start()
+            self.wave_ringtone = SIPSessionApplication().play_sound(ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
         self.ui.write('Ringing...') # Changed from ui.status
 
     def _NH_SIPSessionWillStart(self, notification):
@@ -1606,13 +1721,9 @@ class IncomingTransferHandler(object):
             if IncomingTransferHandler.sessions == 1:
                 ringtone = self.session.account.sounds.audio_inbound.sound_file if self.session.account.sounds.audio_inbound is not None else None
                 if ringtone:
-                    self.wave_ringtone = WavePlayer(SIPApplication.alert_audio_mixer, ringtone.path.normalized, volume=ringtone.volume, loop_count=0, pause_time=2)
-                    SIPApplication.alert_audio_bridge.add(self.wave_ringtone)
-                    self.wave_ringtone.start()
+                    self.wave_ringtone = application.play_sound(ringtone.path.normalized, port='alert', volume=ringtone.volume, loop_count=0, pause_time=2)
         elif IncomingTransferHandler.tone_ringtone is None:
-            IncomingTransferHandler.tone_ringtone = WavePlayer(SIPApplication.voice_audio_mixer, ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
-            SIPApplication.voice_audio_bridge.add(IncomingTransferHandler.tone_ringtone)
-            IncomingTransferHandler.tone_ringtone.start()
+            IncomingTransferHandler.tone_ringtone = application.play_sound(ResourcePath('sounds/ring_tone.wav').normalized, loop_count=0, pause_time=6)
         self.session.send_ring_indication()
 
         # No longer ask question directly, just log it.
@@ -1784,15 +1895,26 @@ class SIPSessionApplication(SIPApplication):
         self.filepath = None
         self.enable_video = False
         self.udp_player = None   # Ссылка на наш UDP-плеер
-        self.udp_recorder = None # Ссылка на наш UDP-рекордер
-        self.udp_input_port = None
-        self.udp_output_port = None
+        self.audio_tap_port = None # Один отвод звука на мост, подписчики добавляются командой /tap
+        self.udp_output_subscriber = None # Номер подписчика отвода, созданного /udpaudio
         self.udp_listener = None
+        self.udp_jitter_buffer = None # Джиттер-буфер между UDP-сокетом и мостом звонка
+        self.udp_jitter_player = None
         self.mic_is_forwarded = False
+        self.sound_caches = {} # Частота микшера -> AudioAssetCache (звуки декодируются один раз при старте)
+        self.sound_ports = {} # 'voice', 'alert', 'dtmf' -> MemoryPlayerPort
+        self.dtmf_interval_ms = DTMF_INTERVAL_MS
+        self.dtmf_tone_ms = DTMF_TONE_MS
+        self.dtmf_detector_subscriber = None # Номер подписчика отвода с детектором тональных DTMF
+        self.dtmf_lock = RLock()
+        self.last_dtmf = (None, None, 0.0) # (цифра, источник, время) последней выданной цифры
+        self.inband_dtmf_muted_until = 0.0 # До этого времени в миксе звучат наши собственные тоны DTMF
+        self.amd_muted_until = 0.0 # До этого времени в миксе звучит наш собственный звук (тоны, подсказки, TTS)
 
         self.active_session = None # Текущая активная сессия (одна из connected_sessions)
         self.message_session_to = None
         self.outgoing_session = None
+        self.outgoing_call = None # Последний OutgoingCallInitializer (для /failcall)
         self.connected_sessions = [] # Все активные/удерживаемые сессии
         self.sessions_with_proposals = set()
         self.hangup_timers = {}
@@ -1825,7 +1947,7 @@ class SIPSessionApplication(SIPApplication):
         self.enable_playback = False
         self.auto_record = False
 
-    def _CH_udpaudio(self, listen_port, send_host, send_port, responder=None):
+    def _CH_udpaudio(self, listen_port, send_host, send_port, output_format=None, responder=None):
         if responder is None:
             responder = self.ui.write
 
@@ -1838,44 +1960,50 @@ class SIPSessionApplication(SIPApplication):
             responder("Ошибка: В текущем звонке нет аудиопотока.")
             return
 
-        if self.udp_input_port or self.udp_output_port:
-            responder("Ошибка: UDP-режим уже активен.")
+        if self.udp_listener:
+            responder("Ошибка: UDP-режим уже активен (для дополнительных получателей звука используйте /tap).")
             return
 
         try:
             listen_port = int(listen_port)
-            send_port = int(send_port)
+            send_port = int(send_port) if send_host != '-' else None
         except ValueError:
             responder("Ошибка: Порты должны быть числами.")
             return
 
-        responder(f"Запуск UDP аудио: слушаем {listen_port}, отправляем на {send_host}:{send_port}")
-
         try:
-            # --- ВЫВОД ЗВУКА (Звонок -> UDP) с помощью WaveRecorder ---
-            # 1. Создаем наш псевдо-файл
-            udp_adapter = UDPFileAdapter(send_host, int(send_port))
+            payload_type, output_rate = parse_audio_format(output_format, self.voice_audio_mixer.sample_rate)
+        except ValueError as e:
+            responder(f"Ошибка: {e}")
+            return
 
-            # 2. Создаем стандартный WaveRecorder, который точно работает,
-            # и передаем ему наш адаптер вместо пути к файлу.
-            self.udp_recorder = WaveRecorder(self.voice_audio_mixer, udp_adapter)
+        if send_port is None:
+            responder(f"Запуск UDP аудио: слушаем {listen_port}, без вывода звонка в UDP")
+        else:
+            responder(f"Запуск UDP аудио: слушаем {listen_port}, отправляем на {send_host}:{send_port} ({format_name(payload_type, output_rate)})")
 
-            # 3. Добавляем WaveRecorder в мост. ЭТО ДОЛЖНО РАБОТАТЬ.
-            self.voice_audio_bridge.add(self.udp_recorder)
-            self.udp_recorder.start()
-            responder("[*] Вывод звука в UDP запущен.")
+        try:
+            # --- ВЫВОД ЗВУКА (Звонок -> UDP): подписчик общего отвода звука; send_host "-" - только ввод ---
+            if send_port is not None:
+                subscriber = DatagramSubscriber((send_host, send_port), self.voice_audio_mixer.sample_rate, payload_type, output_rate)
+                self.udp_output_subscriber = self._add_tap_subscriber(subscriber)
+                responder("[*] Вывод звука в UDP запущен.")
 
             # --- ВВОД ЗВУКА (UDP -> Звонок) ---
             input_target_port = self.voice_audio_bridge.demultiplexer
             if not input_target_port or not input_target_port.is_active:
                 raise Exception("Не удалось найти активный входной порт в аудио-мосте.")
 
+            # Датаграммы идут в джиттер-буфер (он же декодирует G.711 и ресемплирует), а в мост - ровно по кадру микшера раз в 20 мс
+            self.udp_jitter_buffer = JitterBuffer(self.voice_audio_mixer.sample_rate)
+            self.udp_jitter_player = JitterBufferPlayer(self.udp_jitter_buffer, input_target_port.write_samples, report=self.ui.write)
             self.udp_listener = UDPListener(
                 host='0.0.0.0',
                 port=int(listen_port),
-                callback=input_target_port.write_samples
+                callback=self.udp_jitter_buffer.push
             )
             self.udp_listener.start()
+            self.udp_jitter_player.start()
 
             try:
                 self.voice_audio_bridge.remove(self.voice_audio_mixer)
@@ -1896,7 +2024,7 @@ class SIPSessionApplication(SIPApplication):
         if responder is None:
             responder = self.ui.write
 
-        if not self.udp_listener and not self.udp_recorder:
+        if not self.udp_listener and not self.udp_output_subscriber:
             responder("UDP-режим не был активен.")
             return
 
@@ -1906,10 +2034,15 @@ class SIPSessionApplication(SIPApplication):
                 self.udp_listener.stop()
                 self.udp_listener = None
 
-            if self.udp_recorder:
-                self.voice_audio_bridge.remove(self.udp_recorder)
-                self.udp_recorder.stop()
-                self.udp_recorder = None
+            if self.udp_jitter_player:
+                self.udp_jitter_player.stop()
+                self.udp_jitter_player = None
+                responder(f"[*] UDP джиттер-буфер: {self.udp_jitter_buffer.format_stats()}")
+                self.udp_jitter_buffer = None
+
+            if self.udp_output_subscriber:
+                self._remove_tap_subscriber(self.udp_output_subscriber)
+                self.udp_output_subscriber = None
 
             if self.mic_is_forwarded:
                 if not self.voice_audio_mixer in self.voice_audio_bridge:
@@ -1920,6 +2053,161 @@ class SIPSessionApplication(SIPApplication):
         except Exception as e:
             responder(f"[!] Ошибка при остановке UDP-режима: {e}")
 
+    def _CH_udpstats(self, responder=None):
+        if responder is None:
+            responder = self.ui.write
+        if self.udp_jitter_buffer is None:
+            responder("UDP-режим не активен.")
+            return
+        stats = {"input": self.udp_jitter_buffer.stats()}
+        if self.udp_output_subscriber and self.audio_tap_port:
+            subscriber = self.audio_tap_port.tap.get(self.udp_output_subscriber)
+            if subscriber:
+                stats["output"] = subscriber.stats()
+        responder(json.dumps(stats))
+
+
+    def _add_tap_subscriber(self, subscriber):
+        """Добавляет подписчика к отводу звука, при первом подписчике подключая отвод к мосту."""
+        if self.audio_tap_port is None:
+            self.audio_tap_port = AudioTapPort(self.voice_audio_mixer)
+            self.voice_audio_bridge.add(self.audio_tap_port)
+            self.audio_tap_port.start()
+        return self.audio_tap_port.tap.add(subscriber)
+
+    def _remove_tap_subscriber(self, subscriber_id):
+        """Отписывает подписчика; без подписчиков отвод отключается от моста."""
+        if self.audio_tap_port is None:
+            return None
+        subscriber = self.audio_tap_port.tap.remove(subscriber_id)
+        if not len(self.audio_tap_port.tap):
+            self.voice_audio_bridge.remove(self.audio_tap_port)
+            self.audio_tap_port.stop()
+            self.audio_tap_port = None
+        return subscriber
+
+    def _start_inband_dtmf(self):
+        """Подключает к отводу звука детектор тональных DTMF (один на все звонки)."""
+        if not INBAND_DTMF_DETECTION or self.dtmf_detector_subscriber is not None:
+            return
+        detector = DtmfDetector(self.voice_audio_mixer.sample_rate)
+        on_digit = lambda event: reactor.callFromThread(self._report_dtmf, event[0], 'inband')
+        self.dtmf_detector_subscriber = self._add_tap_subscriber(DetectorSubscriber('inband DTMF', detector, on_digit))
+
+    def _stop_inband_dtmf(self):
+        if self.dtmf_detector_subscriber is not None:
+            self._remove_tap_subscriber(self.dtmf_detector_subscriber)
+            self.dtmf_detector_subscriber = None
+
+    def _mute_inband_dtmf(self, duration_ms):
+        """Детектор слышит весь микс, поэтому пока играют наши тоны DTMF, тональные цифры не принимаются."""
+        with self.dtmf_lock:
+            self.inband_dtmf_muted_until = max(self.inband_dtmf_muted_until, time.monotonic() + (duration_ms + DTMF_DEDUP_MS) / 1000.0)
+
+    def _mute_amd(self, duration_ms):
+        """Как и DTMF, AMD слышит весь микс: пока звучит наш звук, кадры детектору не отдаются."""
+        self.amd_muted_until = max(self.amd_muted_until, time.monotonic() + (duration_ms + AMD_MUTE_TAIL_MS) / 1000.0)
+
+    def amd_listening(self):
+        """Вызывается потоком отвода для каждого кадра детектора автоответчика."""
+        return time.monotonic() >= self.amd_muted_until
+
+    def _report_dtmf(self, digit, source):
+        """
+        Единая точка выдачи принятой цифры ('rfc2833' или 'inband'). Шлюзы, которые
+        передают клавишу обоими способами, дают одно событие. Возвращает True,
+        если цифра выдана.
+        """
+        now = time.monotonic()
+        with self.dtmf_lock:
+            if source == 'inband' and now < self.inband_dtmf_muted_until:
+                return False
+            last_digit, last_source, last_time = self.last_dtmf
+            if digit == last_digit and source != last_source and now - last_time < DTMF_DEDUP_MS / 1000.0:
+                return False
+            self.last_dtmf = (digit, source, now)
+        show_notice('Got DMTF %s (%s)' % (digit, source))
+        return True
+
+    def _CH_tap(self, kind=None, *args, responder=None):
+        if responder is None:
+            responder = self.ui.write
+
+        sample_rate = self.voice_audio_mixer.sample_rate
+        try:
+            if kind == 'udp' and len(args) in (2, 3):
+                payload_type, rate = parse_audio_format(args[2] if len(args) == 3 else None, sample_rate)
+                subscriber = DatagramSubscriber((args[0], int(args[1])), sample_rate, payload_type, rate)
+            elif kind == 'unix' and len(args) in (1, 2):
+                payload_type, rate = parse_audio_format(args[1] if len(args) == 2 else None, sample_rate)
+                subscriber = DatagramSubscriber(args[0], sample_rate, payload_type, rate)
+            elif kind == 'shm' and len(args) in (1, 2):
+                subscriber = SharedMemorySubscriber(args[0], sample_rate, *(int(arg) for arg in args[1:]))
+            else:
+                responder("Использование: /tap udp {host} {port} [формат] | /tap unix {путь} [формат] | /tap shm {имя} [емкость_мс]")
+                return
+        except (ValueError, OSError) as e:
+            responder(f"Ошибка: {e}")
+            return
+
+        try:
+            subscriber_id = self._add_tap_subscriber(subscriber)
+        except Exception as e:
+            subscriber.close()
+            responder(f"[!] Не удалось подключить отвод звука: {e}")
+            return
+        # Ответ одной JSON-строкой: websok.py берет из него номер подписчика для /untap
+        responder(json.dumps({"status": "success", "subscriber": subscriber_id, "kind": subscriber.kind, "target": subscriber.describe()}, ensure_ascii=False))
+
+    def _CH_untap(self, subscriber_id=None, responder=None):
+        if responder is None:
+            responder = self.ui.write
+
+        if self.audio_tap_port is None:
+            responder("Отвод звука не активен.")
+            return
+        call = self.outgoing_call
+        if subscriber_id == 'all':
+            # Внутренние детекторы (DTMF, тоны хода соединения, AMD) - не подписчики
+            # пользователя: "all" их не трогает, отключить можно только по номеру
+            internal = {self.dtmf_detector_subscriber}
+            if call is not None:
+                internal.update((call.progress_subscriber, call.amd_subscriber))
+            subscriber_ids = [sid for sid in self.audio_tap_port.tap.stats() if sid not in internal]
+        else:
+            try:
+                subscriber_ids = [int(subscriber_id)]
+            except (TypeError, ValueError):
+                responder("Использование: /untap {номер}|all")
+                return
+        for sid in subscriber_ids:
+            if sid == self.udp_output_subscriber:
+                self.udp_output_subscriber = None
+            if sid == self.dtmf_detector_subscriber:
+                self.dtmf_detector_subscriber = None
+            if call is not None and sid == call.progress_subscriber:
+                call.progress_subscriber = None
+            amd_removed = call is not None and sid == call.amd_subscriber
+            if amd_removed:
+                call.amd_subscriber = None
+            subscriber = self._remove_tap_subscriber(sid)
+            if subscriber is None:
+                responder(f"Подписчик #{sid} не найден.")
+            else:
+                responder(f"[*] Подписчик #{sid} отключен: доставлено {subscriber.delivered}, потеряно {subscriber.dropped}, ошибок {subscriber.errors}")
+            if amd_removed:
+                call._release_playback() # Решения AMD уже не будет - playback не должен ждать его вечно
+
+    def _CH_taps(self, responder=None):
+        if responder is None:
+            responder = self.ui.write
+
+        if self.audio_tap_port is None:
+            responder("Отвод звука не активен.")
+            return
+        for subscriber_id, stats in self.audio_tap_port.tap.stats().items():
+            responder(f"  #{subscriber_id} {stats['kind']} {stats['target']}: доставлено {stats['delivered']}, "
+                      f"потеряно {stats['dropped']}, ошибок {stats['errors']}, в очереди {stats['queued']}")
     def _CH_playaudio(self, filepath, responder=None):
         if responder is None:
             responder = self.ui.write
@@ -2222,6 +2510,7 @@ class SIPSessionApplication(SIPApplication):
         show_notice('Available video codecs: %s\n' % ', '.join([codec.decode() for codec in engine._ua.available_video_codecs]))
 
         self.ip_address_monitor.start()
+        self._start_sound_ports()
 
         if self.enable_playback:
             show_notice("Polling %s for wav files" % self.playback_dir)
@@ -2278,9 +2567,64 @@ class SIPSessionApplication(SIPApplication):
         call_initializer = OutgoingCallInitializer(self.account, play_object['target'], audio=True, play_file=self.play_file)
         call_initializer.start()
 
+    def _sound_cache(self, sample_rate):
+        cache = self.sound_caches.get(sample_rate)
+        if cache is None:
+            cache = self.sound_caches[sample_rate] = AudioAssetCache(sample_rate)
+        return cache
+
+    def _start_sound_ports(self):
+        """Декодирует тоны и сигналы в память и ставит в мосты постоянные порты для их проигрывания."""
+        settings = SIPSimpleSettings()
+        started = time.monotonic()
+        voice_sounds = [ResourcePath('sounds/%s' % name).normalized for name in ('ring_tone.wav', 'hangup_tone.wav', 'hold_tone.wav')]
+        voice_sounds += [dtmf_sound_path(digit) for digit in '0123456789*#']
+        voice_sounds += [sound.path.normalized for sound in (settings.sounds.audio_outbound, settings.sounds.roger_beep) if sound]
+        alert_sounds = [account.sounds.audio_inbound.sound_file.path.normalized for account in AccountManager().iter_accounts()
+                        if getattr(account, 'sounds', None) is not None and account.sounds.audio_inbound is not None and account.sounds.audio_inbound.sound_file]
+        failed = self._sound_cache(self.voice_audio_mixer.sample_rate).preload(voice_sounds)
+        failed += self._sound_cache(self.alert_audio_mixer.sample_rate).preload(alert_sounds)
+        for path, error in failed:
+            show_notice('Could not preload sound %s: %s' % (path, error))
+        loaded_bytes = sum(cache.nbytes for cache in self.sound_caches.values())
+        show_notice('Preloaded %d sounds (%d KB) in %.2f s' % (len(voice_sounds) + len(alert_sounds) - len(failed), loaded_bytes // 1024, time.monotonic() - started))
+
+        # 'dtmf' - отдельный порт, чтобы при inband DTMF в поток звонка уходили только тоны, без гудков
+        for name, mixer, bridge in (('voice', self.voice_audio_mixer, self.voice_audio_bridge),
+                                    ('dtmf', self.voice_audio_mixer, self.voice_audio_bridge),
+                                    ('alert', self.alert_audio_mixer, self.alert_audio_bridge)):
+            sound_port = MemoryPlayerPort(mixer, name)
+            bridge.add(sound_port)
+            sound_port.start()
+            self.sound_ports[name] = sound_port
+
+    def play_sound(self, path, port='voice', volume=100, loop_count=1, pause_time=0, delay_ms=0, duration_ms=None):
+        """
+        Проигрывает звук из памяти через MemoryPlayerPort. Параметры как у WavePlayer
+        (pause_time в секундах); delay_ms - начало относительно следующего кадра,
+        duration_ms - обрезать звук. Возвращает Playback (у него есть stop()) или None.
+        """
+        sound_port = self.sound_ports.get(port)
+        if sound_port is None:
+            return None
+        try:
+            samples = self._sound_cache(sound_port.mixer.sample_rate).get(path)
+        except Exception as e:
+            show_notice('Could not play sound %s: %s' % (path, e))
+            return None
+        if duration_ms:
+            samples = samples[:sound_port.scheduler.samples_for(duration_ms)]
+        playback = sound_port.scheduler.play(samples, delay_ms, volume, loop_count, pause_time * 1000)
+        if port == 'voice' and playback.duration_samples is not None:
+            self._mute_amd(delay_ms + playback.duration_samples * 1000 // sound_port.mixer.sample_rate)
+        return playback
+
     def _NH_SIPApplicationWillEnd(self, notification):
         show_notice('Application will end')
         self.ip_address_monitor.stop()
+        for sound_port in self.sound_ports.values():
+            sound_port.stop()
+        self.sound_ports = {}
 
     def _NH_SIPApplicationDidEnd(self, notification):
         self.ui.stop()
@@ -2837,6 +3181,7 @@ class SIPSessionApplication(SIPApplication):
             self.active_session.hold()
         self.active_session = session
         self.message_session_to = None
+        self._start_inband_dtmf()
 
         # self._update_prompt() # Removed TTY-specific prompt update.
         if len(self.connected_sessions) > 1:
@@ -2923,6 +3268,8 @@ class SIPSessionApplication(SIPApplication):
         if not on_hold_streams and self.hold_tone is not None:
             self.hold_tone.stop()
             self.hold_tone = None
+        if not self.connected_sessions:
+            self._stop_inband_dtmf()
 
         self._CH_sessions() # Обновляем список сессий (теперь он может быть пуст)
 
@@ -2951,9 +3298,7 @@ class SIPSessionApplication(SIPApplication):
             else:
                 self.ignore_local_hold = False
             if self.hold_tone is None:
-                self.hold_tone = WavePlayer(self.voice_audio_mixer, ResourcePath('sounds/hold_tone.wav').normalized, loop_count=0, pause_time=30, volume=50)
-                self.voice_audio_bridge.add(self.hold_tone)
-                self.hold_tone.start()
+                self.hold_tone = self.play_sound(ResourcePath('sounds/hold_tone.wav').normalized, loop_count=0, pause_time=30, volume=50)
         else:
             if notification.data.originator == 'remote':
                 if session is self.active_session:
@@ -3006,14 +3351,12 @@ class SIPSessionApplication(SIPApplication):
         # self._update_prompt() # Removed TTY-specific prompt update.
 
     def _NH_AudioStreamGotDTMF(self, notification):
-        notification_center = NotificationCenter()
         digit = notification.data.digit
-        filename = 'sounds/dtmf_%s_tone.wav' % {'*': 'star', '#': 'pound'}.get(digit, digit)
-        wave_player = WavePlayer(self.voice_audio_mixer, ResourcePath(filename).normalized)
-        notification_center.add_observer(self, sender=wave_player)
-        self.voice_audio_bridge.add(wave_player)
-        wave_player.start()
-        show_notice('Got DMTF %s' % notification.data.digit)
+        if not self._report_dtmf(digit, 'rfc2833'):
+            return
+        playback = self.play_sound(dtmf_sound_path(digit), duration_ms=self.dtmf_tone_ms)
+        if playback is not None:
+            self._mute_inband_dtmf(playback.duration_samples * 1000 // self.voice_audio_mixer.sample_rate)
 
     def _NH_RTPStreamZRTPVerifiedStateChanged(self, notification):
         # self._update_prompt() # Removed TTY-specific prompt update.
@@ -3710,23 +4053,63 @@ class SIPSessionApplication(SIPApplication):
                     responder('Message session not found')
                     pass
 
+    def _CH_failcall(self, reason=None, responder=None):
+        """Завершает исходящий звонок с причиной отказа (например, по фразе автоинформатора оператора)."""
+        if responder is None: responder = self.ui.write
+        if not reason or not re.match(r'^[\w-]+$', reason):
+            responder(json.dumps({"status": "error", "message": "Usage: /failcall {reason}"}))
+            return
+        if self.outgoing_call is None or not self.outgoing_call.fail_call(reason):
+            responder(json.dumps({"status": "error", "message": "No outgoing call to fail"}))
+            return
+        responder(json.dumps({"status": "success", "reason": reason}))
+
+    def _CH_amdmute(self, duration_ms=None, responder=None):
+        """Звук, который идет в звонок мимо play_sound (TTS websok через микрофон), не должен попасть в AMD."""
+        if responder is None: responder = self.ui.write
+        try:
+            duration_ms = int(duration_ms)
+        except (TypeError, ValueError):
+            duration_ms = -1
+        if duration_ms < 0:
+            responder(json.dumps({"status": "error", "message": "Usage: /amdmute {duration_ms}"}))
+            return
+        self._mute_amd(duration_ms)
+        responder(json.dumps({"status": "success", "duration_ms": duration_ms}))
+
     @run_in_green_thread
     def _CH_dtmf(self, tones, responder=None):
         if responder is None: responder = self.ui.write
         if self.active_session is not None:
             audio_stream = next((stream for stream in self.active_session.streams if stream.type == 'audio'), None)
             if audio_stream is not None:
-                notification_center = NotificationCenter()
+                dtmf_port = self.sound_ports.get('dtmf')
+                if self.active_session.account.rtp.inband_dtmf and dtmf_port is not None and dtmf_port not in audio_stream.bridge:
+                    audio_stream.bridge.add(dtmf_port)
+                # Тоны всей серии раскладываются заранее с точным шагом; цикл ниже только отсчитывает RFC 2833
+                interval_ms = self.dtmf_interval_ms
+                self._mute_inband_dtmf(len(tones) * interval_ms)
+                for index, digit in enumerate(tones):
+                    self.play_sound(dtmf_sound_path(digit), port='dtmf', delay_ms=index * interval_ms, duration_ms=self.dtmf_tone_ms)
                 for digit in tones:
-                    filename = 'sounds/dtmf_%s_tone.wav' % {'*': 'star', '#': 'pound'}.get(digit, digit)
-                    wave_player = WavePlayer(self.voice_audio_mixer, ResourcePath(filename).normalized)
-                    notification_center.add_observer(self, sender=wave_player)
                     audio_stream.send_dtmf(digit)
-                    if self.active_session.account.rtp.inband_dtmf:
-                        audio_stream.bridge.add(wave_player)
-                    self.voice_audio_bridge.add(wave_player)
-                    wave_player.start()
-                    api.sleep(0.3)
+                    api.sleep(interval_ms / 1000.0)
+
+    def _CH_dtmfpace(self, interval_ms=None, tone_ms=None, responder=None):
+        if responder is None: responder = self.ui.write
+        if interval_ms is not None:
+            try:
+                interval_ms = int(interval_ms)
+                tone_ms = int(tone_ms) if tone_ms not in (None, 'full') else None
+            except ValueError:
+                responder('Usage: /dtmfpace {interval_ms} [tone_ms|full]')
+                return
+            if interval_ms <= 0 or (tone_ms is not None and not 0 < tone_ms <= interval_ms):
+                responder('DTMF interval must be positive and the tone must fit into it')
+                return
+            self.dtmf_interval_ms = interval_ms
+            self.dtmf_tone_ms = tone_ms
+        responder('DTMF pacing: %d ms per digit, tone %s' % (self.dtmf_interval_ms, '%d ms' % self.dtmf_tone_ms if self.dtmf_tone_ms else 'full'))
 
     def _CH_record(self, state='toggle', responder=None):
         if responder is None: responder = self.ui.write
@@ -4162,6 +4545,15 @@ class SIPSessionApplication(SIPApplication):
         lines.append('In call commands:')
         lines.append('  /hangup: hang-up the active session')
         lines.append('  /dtmf {0-9|*|#|A-D}...: send DTMF tones')
+        lines.append('  /udpaudio {listen_port} {send_host} {send_port} [pcm|pcm<rate>|nb|ulaw|alaw]: exchange call audio over UDP (send_host - for input only)')
+        lines.append('  /stopudpaudio: stop UDP audio')
+        lines.append('  /udpstats: show UDP jitter buffer and output statistics')
+        lines.append('  /tap udp {host} {port} [format] | unix {path} [format] | shm {name} [ms]: add a call audio subscriber')
+        lines.append('  /untap {id}|all: remove call audio subscribers')
+        lines.append('  /taps: list call audio subscribers')
+        lines.append('  /dtmfpace [interval_ms] [tone_ms|full]: show or set DTMF pacing')
+        lines.append('  /failcall {reason}: end the outgoing call as outgoing-failed-{reason}')
+        lines.append('  /amdmute {duration_ms}: do not feed the next duration_ms of call audio to answering machine detection')
         lines.append('  /record [on|off]: toggle/set audio recording')
         lines.append('  /hold [on|off]: hold/unhold')
         lines.append('  /zrtp_verified: toggle verified flag for ZRTP peer (both parties must do it)')
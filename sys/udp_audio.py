@@ -0,0 +1,755 @@
+# udp_audio.py
+"""
+UDP-аудио для sip-session3: формат кадров и джиттер-буфер для звука,
+который внешние программы подают в звонок по UDP.
+
+Кадр: 14-байтный заголовок и звук. Заголовок - магия b"AU", тип полезной
+нагрузки, флаги, номер последовательности (16 бит), метка времени в
+отсчетах (32 бита) и частота дискретизации (32 бита), всё big-endian.
+Датаграммы без заголовка принимаются как раньше (сырой 16-битный PCM
+на частоте микшера) и нумеруются по порядку прихода.
+
+Полезная нагрузка - 16-битный PCM на любой частоте или G.711 (µ-law,
+A-law) на 8 кГц. AudioEncoder ресемплирует кадры микшера и компандирует
+их (таблицы G.711 в audio_dsp), AudioDecoder делает обратное для входящих кадров,
+так что в мост всегда попадает PCM на частоте микшера.
+
+Джиттер-буфер отделяет прием датаграмм от подачи звука в мост: поток
+воспроизведения забирает ровно один кадр микшера раз в `frame_ms`,
+пакеты переупорядочиваются по номеру, опоздавшие и повторные
+отбрасываются, потерянные маскируются повтором последнего кадра с
+затуханием. Целевая глубина буфера подстраивается под измеренный
+джиттер и растет после каждого опустошения.
+
+AudioTap раздает звук звонка сразу нескольким подписчикам (UDP, Unix-сокет,
+разделяемая память). У каждого подписчика своя ограниченная очередь и
+свой поток: поток микшера только кладет кадр в очереди и никогда не ждет
+подписчика, а отстающий подписчик теряет свои самые старые кадры, не
+задерживая остальных.
+
+DatagramReceiver принимает датаграммы без выделения памяти на каждую:
+recvfrom_into в заранее выделенные буферы, а после одного пробуждения
+сокет вычитывается до конца, так что пачка кадров обрабатывается за
+один проход. Сравнение с прежним циклом recvfrom(4096):
+    python3 -m sipclient.udp_audio --benchmark
+"""
+import itertools
+import select
+import socket
+import struct
+import sys
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from threading import Condition, Event, Lock, Thread
+
+import numpy as np
+
+from sipclient.audio_dsp import PolyphaseResampler, alaw_to_linear, as_int16_array, linear_to_alaw, linear_to_ulaw, ulaw_to_linear
+
+FRAME_MAGIC = b"AU"
+FRAME_HEADER = struct.Struct("!2sBBHII") # магия, тип, флаги, seq, timestamp, частота
+PT_L16 = 0 # 16-битный PCM little-endian (как write_samples микшера)
+PT_PCMU = 1 # G.711 µ-law, 8 кГц
+PT_PCMA = 2 # G.711 A-law, 8 кГц
+G711_RATE = 8000
+NARROWBAND_RATE = 8000
+PAYLOAD_NAMES = {PT_L16: "pcm", PT_PCMU: "ulaw", PT_PCMA: "alaw"}
+
+MIXER_FRAME_MS = 20 # Длительность кадра микшера (ptime pjmedia по умолчанию)
+JITTER_MIN_DEPTH_MS = 40 # Минимальная целевая глубина буфера
+JITTER_MAX_DEPTH_MS = 400 # Максимальная целевая глубина буфера
+CONCEALMENT_MAX_FRAMES = 3 # Сколько кадров подряд маскировать повтором, дальше - тишина
+CONCEALMENT_DECAY = 0.5 # Затухание повторяемого кадра на каждый следующий шаг
+
+TAP_QUEUE_FRAMES = 50 # Очередь подписчика (1 с звука); при переполнении теряются самые старые кадры
+SHM_MAGIC = b"AUSM"
+SHM_HEADER = struct.Struct("<4sIIIQ") # магия, частота, байт в кадре, число слотов, счетчик записанных кадров
+SHM_CAPACITY_MS = 2000 # Емкость кольца в разделяемой памяти по умолчанию
+
+UDP_MAX_DATAGRAM = 4096 # Размер буфера под одну датаграмму
+UDP_RECV_BATCH = 32 # Сколько датаграмм вычитывать за одно пробуждение
+
+
+def pack_frame(seq, timestamp, payload, sample_rate, payload_type=PT_L16, flags=0):
+    """Собирает датаграмму: заголовок + полезная нагрузка."""
+    return FRAME_HEADER.pack(FRAME_MAGIC, payload_type, flags, seq & 0xFFFF, timestamp & 0xFFFFFFFF, sample_rate) + payload
+
+
+def parse_frame(datagram):
+    """
+    Разбирает датаграмму. Возвращает (payload_type, flags, seq, timestamp, sample_rate, payload)
+    или None, если заголовка нет (сырой PCM старых отправителей).
+    """
+    if len(datagram) < FRAME_HEADER.size or datagram[:2] != FRAME_MAGIC:
+        return None
+    magic, payload_type, flags, seq, timestamp, sample_rate = FRAME_HEADER.unpack_from(datagram)
+    return payload_type, flags, seq, timestamp, sample_rate, datagram[FRAME_HEADER.size:]
+
+
+_G711_ENCODE = {PT_PCMU: linear_to_ulaw, PT_PCMA: linear_to_alaw}
+_G711_DECODE = {PT_PCMU: ulaw_to_linear, PT_PCMA: alaw_to_linear}
+
+
+def parse_audio_format(spec, mixer_rate):
+    """
+    Разбирает формат вывода /udpaudio. Возвращает (payload_type, частота).
+      pcm         - 16-битный PCM на частоте микшера (как раньше)
+      pcm16000    - 16-битный PCM на указанной частоте
+      nb          - узкополосный 16-битный PCM 8 кГц
+      ulaw, alaw  - G.711, 8 кГц, байт на отсчет
+    """
+    spec = (spec or "pcm").lower()
+    if spec in ("ulaw", "pcmu", "mulaw"):
+        return PT_PCMU, G711_RATE
+    if spec in ("alaw", "pcma"):
+        return PT_PCMA, G711_RATE
+    if spec in ("nb", "narrowband"):
+        return PT_L16, NARROWBAND_RATE
+    if spec == "pcm":
+        return PT_L16, mixer_rate
+    if spec.startswith("pcm") and spec[3:].isdigit() and int(spec[3:]) > 0:
+        return PT_L16, int(spec[3:])
+    raise ValueError(f"неизвестный формат '{spec}' (pcm, pcm<частота>, nb, ulaw, alaw)")
+
+
+def format_name(payload_type, rate):
+    return f"{PAYLOAD_NAMES.get(payload_type, payload_type)}/{rate}"
+
+
+class AudioEncoder:
+    """PCM микшера -> полезная нагрузка выбранного формата (ресемплинг + компандирование)."""
+
+    def __init__(self, mixer_rate, payload_type=PT_L16, rate=None):
+        self.mixer_rate = mixer_rate
+        self.payload_type = payload_type
+        self.rate = rate or mixer_rate
+        self.resampler = PolyphaseResampler(mixer_rate, self.rate)
+
+    def encode(self, pcm):
+        """Возвращает (полезная нагрузка, число отсчетов в ней)."""
+        if self.payload_type == PT_L16 and self.resampler.passthrough:
+            return pcm, len(pcm) // 2
+        samples = self.resampler.process(as_int16_array(pcm))
+        encode = _G711_ENCODE.get(self.payload_type)
+        if encode is None:
+            return samples.tobytes(), samples.size
+        return encode(samples).tobytes(), samples.size
+
+
+class AudioDecoder:
+    """Полезная нагрузка любого поддерживаемого формата -> PCM на частоте микшера."""
+
+    def __init__(self, mixer_rate):
+        self.mixer_rate = mixer_rate
+        self._resamplers = {} # частота отправителя -> ресемплер (у каждого свое состояние)
+
+    def decode(self, payload_type, rate, payload):
+        """Возвращает bytes PCM или None, если формат не поддерживается."""
+        rate = rate or self.mixer_rate
+        decode = _G711_DECODE.get(payload_type)
+        if decode is not None:
+            samples = decode(payload)
+        elif payload_type == PT_L16:
+            payload = payload[:len(payload) & ~1]
+            if rate == self.mixer_rate:
+                return bytes(payload)
+            samples = as_int16_array(payload)
+        else:
+            return None
+        if rate != self.mixer_rate:
+            resampler = self._resamplers.get(rate)
+            if resampler is None:
+                resampler = self._resamplers[rate] = PolyphaseResampler(rate, self.mixer_rate)
+            samples = resampler.process(samples)
+        return samples.tobytes()
+
+
+class DatagramReceiver:
+    """
+    Пакетный прием датаграмм в пул заранее выделенных буферов.
+
+    receive() ждет готовности сокета и вычитывает до `batch` датаграмм без
+    блокировки. Возвращаемые memoryview указывают в буферы пула и
+    действительны только до следующего вызова: кто хранит данные дольше,
+    должен их скопировать.
+    """
+
+    def __init__(self, sock, max_datagram=UDP_MAX_DATAGRAM, batch=UDP_RECV_BATCH):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self._views = [memoryview(bytearray(max_datagram)) for _ in range(batch)]
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLIN)
+        self.wakeups = 0
+        self.datagrams = 0
+
+    def _drain(self):
+        received = []
+        for view in self._views:
+            try:
+                size, _ = self.sock.recvfrom_into(view)
+            except BlockingIOError:
+                break
+            received.append(view[:size])
+        return received
+
+    def receive(self, timeout=None):
+        """Список принятых датаграмм (пустой по таймауту, `timeout` в секундах)."""
+        # Под нагрузкой в сокете почти всегда что-то есть: сначала читаем, poll - только если пусто
+        received = self._drain()
+        if not received:
+            if not self._poll.poll(None if timeout is None else int(timeout * 1000)):
+                return received
+            received = self._drain()
+        self.wakeups += 1
+        self.datagrams += len(received)
+        return received
+
+
+class JitterBuffer:
+
+    def __init__(self, sample_rate, frame_ms=MIXER_FRAME_MS, min_depth_ms=JITTER_MIN_DEPTH_MS, max_depth_ms=JITTER_MAX_DEPTH_MS):
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self.min_depth_ms = min_depth_ms
+        self.max_depth_ms = max_depth_ms
+        self._lock = Lock()
+        self._packets = {} # расширенный seq -> PCM
+        self._buffered_bytes = 0
+        self._out = bytearray() # PCM по порядку, еще не нарезанный на кадры
+        self._next_seq = None
+        self._highest = None
+        self._legacy_seq = 0
+        self._decoder = AudioDecoder(sample_rate)
+        self.input_format = None
+        self._playing = False
+        self._last_frame = None
+        self._concealed_run = 0
+        self._last_arrival = None
+        self._last_payload_ms = 0.0
+        self._underrun_floor = 0.0
+        self.jitter_ms = 0.0
+        self.received = 0
+        self.late = 0
+        self.duplicates = 0
+        self.lost = 0
+        self.concealed = 0
+        self.underruns = 0
+        self.trimmed = 0
+        self.played = 0
+
+    @property
+    def depth_ms(self):
+        return (self._buffered_bytes + len(self._out)) * 500.0 / self.sample_rate
+
+    @property
+    def target_ms(self):
+        jitter_target = 2.0 * self.jitter_ms + self.frame_ms
+        return min(self.max_depth_ms, max(self.min_depth_ms, jitter_target, self._underrun_floor))
+
+    def push(self, datagram, now=None):
+        """Вызывается потоком приема для каждой датаграммы."""
+        now = time.monotonic() if now is None else now
+        frame = parse_frame(datagram)
+        if frame is None:
+            seq, payload = self._legacy_seq, bytes(datagram)
+            self._legacy_seq = (self._legacy_seq + 1) & 0xFFFF
+        else:
+            payload_type, _, seq, _, rate, payload = frame
+            if not payload:
+                return
+            # Декодер всегда отдает новый bytes - буфер пула приемника можно перезаписывать
+            payload = self._decoder.decode(payload_type, rate, payload)
+            if payload is None:
+                return
+            self.input_format = format_name(payload_type, rate or self.sample_rate)
+        if not payload:
+            return
+
+        with self._lock:
+            self.received += 1
+            # Разворачиваем 16-битный номер относительно самого старшего принятого
+            if self._highest is None:
+                ext = seq
+            else:
+                ext = self._highest + ((seq - self._highest + 0x8000) & 0xFFFF) - 0x8000
+            if self._next_seq is not None and ext < self._next_seq:
+                self.late += 1
+                return
+            if ext in self._packets:
+                self.duplicates += 1
+                return
+            self._packets[ext] = payload
+            self._buffered_bytes += len(payload)
+
+            if self._highest is None or ext > self._highest:
+                # Джиттер по RFC 3550: отклонение интервала прихода от длительности предыдущего пакета
+                if self._last_arrival is not None and ext == self._highest + 1:
+                    deviation = (now - self._last_arrival) * 1000.0 - self._last_payload_ms
+                    self.jitter_ms += (abs(deviation) - self.jitter_ms) / 16.0
+                self._highest = ext
+                self._last_arrival = now
+                self._last_payload_ms = len(payload) * 500.0 / self.sample_rate
+
+    def _take(self, ext):
+        payload = self._packets.pop(ext)
+        self._buffered_bytes -= len(payload)
+        return payload
+
+    def _conceal(self):
+        self.concealed += 1
+        self._concealed_run += 1
+        if self._last_frame is None or self._concealed_run > CONCEALMENT_MAX_FRAMES:
+            return bytes(self.frame_bytes)
+        samples = np.frombuffer(self._last_frame, dtype=np.int16).astype(np.float32)
+        samples *= CONCEALMENT_DECAY ** self._concealed_run
+        return samples.astype(np.int16).tobytes()
+
+    def pop(self):
+        """
+        Вызывается раз в frame_ms потоком воспроизведения. Возвращает ровно
+        один кадр PCM или None, пока буфер набирает целевую глубину.
+        """
+        with self._lock:
+            if not self._playing:
+                if self.depth_ms < self.target_ms:
+                    return None
+                self._playing = True
+                if self._next_seq is None or self._next_seq not in self._packets:
+                    self._next_seq = min(self._packets) if self._packets else self._next_seq
+
+            self._underrun_floor = max(0.0, self._underrun_floor - self.frame_ms / 1000.0) # ~1 мс в секунду
+
+            # Буфер сильно глубже цели (отправитель прислал пачку) - выбрасываем кадр, чтобы не копить задержку
+            if self.depth_ms > self.target_ms + 3 * self.frame_ms:
+                if len(self._out) >= self.frame_bytes:
+                    del self._out[:self.frame_bytes]
+                    self.trimmed += 1
+                elif self._next_seq in self._packets:
+                    self._take(self._next_seq)
+                    self._next_seq += 1
+                    self.trimmed += 1
+
+            while len(self._out) < self.frame_bytes:
+                if self._next_seq in self._packets:
+                    self._out += self._take(self._next_seq)
+                    self._next_seq += 1
+                    continue
+                partial = bytes(self._out)
+                self._out.clear()
+                if self._packets:
+                    # Следующий пакет потерян (более поздние уже есть) - маскируем и пропускаем его
+                    self.lost += 1
+                    self._next_seq += 1
+                else:
+                    # Данные кончились: маскируем и снова набираем буфер, сделав его глубже
+                    self.underruns += 1
+                    self._playing = False
+                    self._underrun_floor = min(self.max_depth_ms, max(self._underrun_floor, self.target_ms) + self.frame_ms)
+                frame = partial + self._conceal()[len(partial):]
+                self.played += 1
+                return frame
+
+            frame = bytes(self._out[:self.frame_bytes])
+            del self._out[:self.frame_bytes]
+            self._last_frame = frame
+            self._concealed_run = 0
+            self.played += 1
+            return frame
+
+    def stats(self):
+        with self._lock:
+            return {
+                "depth_ms": round(self.depth_ms, 1), "target_ms": round(self.target_ms, 1), "jitter_ms": round(self.jitter_ms, 1),
+                "received": self.received, "played": self.played, "late": self.late, "duplicates": self.duplicates,
+                "lost": self.lost, "concealed": self.concealed, "underruns": self.underruns, "trimmed": self.trimmed,
+                "format": self.input_format,
+            }
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"формат {s['format'] or 'pcm без заголовка'}, глубина {s['depth_ms']} мс (цель {s['target_ms']}), джиттер {s['jitter_ms']} мс, принято {s['received']}, "
+                f"опоздало {s['late']}, повторов {s['duplicates']}, потеряно {s['lost']}, замаскировано {s['concealed']}, "
+                f"опустошений {s['underruns']}, сброшено {s['trimmed']}")
+
+
+class JitterBufferPlayer(Thread):
+    """Раз в кадр микшера забирает кадр из джиттер-буфера и пишет его в мост звонка."""
+
+    def __init__(self, jitter_buffer, write_samples, report=None, report_interval=30):
+        super().__init__(daemon=True, name="UDPJitterPlayer")
+        self.jitter_buffer = jitter_buffer
+        self.write_samples = write_samples
+        self.report = report
+        self.report_interval = report_interval
+        self.stopped = Event()
+
+    def run(self):
+        frame_sec = self.jitter_buffer.frame_ms / 1000.0
+        next_tick = time.monotonic()
+        last_report = next_tick
+        while not self.stopped.is_set():
+            frame = self.jitter_buffer.pop()
+            if frame is not None:
+                try:
+                    self.write_samples(frame)
+                except Exception:
+                    break
+            now = time.monotonic()
+            if self.report is not None and now - last_report >= self.report_interval:
+                last_report = now
+                self.report(f"[*] UDP джиттер-буфер: {self.jitter_buffer.format_stats()}")
+            # Расписание по абсолютным меткам, чтобы не накапливать дрейф; после долгой паузы - догоняем
+            next_tick += frame_sec
+            delay = next_tick - now
+            if delay < -5 * frame_sec:
+                next_tick = now
+            elif delay > 0:
+                self.stopped.wait(delay)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FramePacketizer:
+    """
+    Нарезает PCM микшера на кадры ровно по `frame_ms` и отправляет каждый
+    отдельной датаграммой с заголовком (seq, метка времени в отсчетах,
+    частота), чтобы получатель видел потери и держал тайминг. Формат
+    полезной нагрузки задает `encoder` (по умолчанию PCM микшера как есть).
+    """
+
+    def __init__(self, sock, address, sample_rate, frame_ms=MIXER_FRAME_MS, encoder=None):
+        self.sock = sock
+        self.address = address
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self.frame_bytes = self.frame_samples * 2
+        self.encoder = encoder or AudioEncoder(sample_rate)
+        self._pending = bytearray()
+        self._seq = 0
+        self._timestamp = 0
+        self.sent = 0
+        self.send_errors = 0
+
+    def _send(self, pcm):
+        payload, samples = self.encoder.encode(pcm)
+        header = FRAME_HEADER.pack(FRAME_MAGIC, self.encoder.payload_type, 0, self._seq, self._timestamp, self.encoder.rate)
+        self._seq = (self._seq + 1) & 0xFFFF
+        self._timestamp = (self._timestamp + samples) & 0xFFFFFFFF # Метка времени - в отсчетах выходной частоты
+        try:
+            # Заголовок и PCM уходят одной датаграммой без склейки в новый буфер
+            self.sock.sendmsg((header, payload), (), 0, self.address)
+            self.sent += 1
+        except OSError:
+            self.send_errors += 1
+
+    def feed(self, pcm):
+        """Принимает очередной блок PCM из микшера; отправляет все полные кадры."""
+        if not self._pending and len(pcm) == self.frame_bytes:
+            self._send(pcm) # Обычный случай: микшер отдает ровно кадр
+            return
+        self._pending += pcm
+        frame_bytes = self.frame_bytes
+        view = memoryview(self._pending)
+        offset = 0
+        while len(self._pending) - offset >= frame_bytes:
+            self._send(view[offset:offset + frame_bytes])
+            offset += frame_bytes
+        view.release()
+        del self._pending[:offset]
+
+    def stats(self):
+        return {"sent": self.sent, "send_errors": self.send_errors, "seq": self._seq, "frame_ms": self.frame_ms,
+                "format": format_name(self.encoder.payload_type, self.encoder.rate)}
+
+
+class TapSubscriber:
+    """
+    Подписчик AudioTap: ограниченная очередь кадров и поток доставки.
+    Наследники реализуют deliver(frame), describe() и close().
+    """
+    kind = "?"
+
+    def __init__(self, queue_frames=TAP_QUEUE_FRAMES):
+        self._queue = deque(maxlen=queue_frames)
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True, name=f"AudioTap-{self.kind}")
+        self.delivered = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        self._thread.start()
+
+    def offer(self, frame):
+        """Вызывается потоком микшера: кладет кадр в очередь и сразу возвращается."""
+        with self._cond:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1 # deque с maxlen сам вытеснит самый старый кадр
+            self._queue.append(frame)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    break
+                frame = self._queue.popleft()
+            try:
+                self.deliver(frame)
+                self.delivered += 1
+            except Exception:
+                self.errors += 1
+
+    def stop(self, timeout=1.0):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.close()
+
+    def stats(self):
+        return {"kind": self.kind, "target": self.describe(), "delivered": self.delivered, "dropped": self.dropped,
+                "errors": self.errors, "queued": len(self._queue)}
+
+
+class DatagramSubscriber(TapSubscriber):
+    """Кадры с заголовком в UDP (address = (host, port)) или в Unix datagram-сокет (address = путь)."""
+
+    def __init__(self, address, sample_rate, payload_type=PT_L16, rate=None, queue_frames=TAP_QUEUE_FRAMES):
+        self.kind = "unix" if isinstance(address, str) else "udp"
+        super().__init__(queue_frames)
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX if self.kind == "unix" else socket.AF_INET, socket.SOCK_DGRAM)
+        # Unix datagram-сокет блокирует отправителя, если получатель не читает - отказ считаем ошибкой отправки
+        self.sock.setblocking(False)
+        self.packetizer = FramePacketizer(self.sock, address, sample_rate, encoder=AudioEncoder(sample_rate, payload_type, rate))
+
+    def deliver(self, frame):
+        self.packetizer.feed(frame)
+
+    def describe(self):
+        target = self.address if self.kind == "unix" else f"{self.address[0]}:{self.address[1]}"
+        encoder = self.packetizer.encoder
+        return f"{target} {format_name(encoder.payload_type, encoder.rate)}"
+
+    def close(self):
+        self.sock.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(sent=self.packetizer.sent, send_errors=self.packetizer.send_errors)
+        return stats
+
+
+class SharedMemorySubscriber(TapSubscriber):
+    """
+    Кольцо кадров PCM микшера в разделяемой памяти (/dev/shm/<name>).
+
+    Заголовок SHM_HEADER, за ним `slots` кадров по frame_bytes. Кадр номер n
+    лежит в слоте n % slots; счетчик записанных кадров обновляется после
+    записи кадра. Читатель помнит свой счетчик, сравнивает с общим и, если
+    отстал больше чем на slots, пропускает потерянное. Запись никогда не
+    ждет читателей.
+    """
+    kind = "shm"
+
+    def __init__(self, name, sample_rate, capacity_ms=SHM_CAPACITY_MS, frame_ms=MIXER_FRAME_MS, queue_frames=TAP_QUEUE_FRAMES):
+        super().__init__(queue_frames)
+        self.name = name
+        self.sample_rate = sample_rate
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self.slots = max(2, capacity_ms // frame_ms)
+        self.written = 0
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=SHM_HEADER.size + self.slots * self.frame_bytes)
+        self._write_header()
+
+    def _write_header(self):
+        SHM_HEADER.pack_into(self.shm.buf, 0, SHM_MAGIC, self.sample_rate, self.frame_bytes, self.slots, self.written)
+
+    def deliver(self, frame):
+        offset = SHM_HEADER.size + (self.written % self.slots) * self.frame_bytes
+        self.shm.buf[offset:offset + len(frame)] = frame
+        self.written += 1
+        self._write_header()
+
+    def describe(self):
+        return f"/dev/shm/{self.name} {self.slots} кадров"
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class DetectorSubscriber(TapSubscriber):
+    """
+    Анализ звука звонка в потоке подписчика: detector.process(frame) возвращает
+    список событий, каждое передается в on_event(event). Медленный анализ не
+    задерживает микшер - при отставании теряются кадры только этого подписчика.
+    Если задан gate(), кадры, для которых он вернул False, детектору не отдаются.
+    """
+    kind = "detector"
+
+    def __init__(self, name, detector, on_event, queue_frames=TAP_QUEUE_FRAMES, gate=None):
+        super().__init__(queue_frames)
+        self.name = name
+        self.detector = detector
+        self.on_event = on_event
+        self.gate = gate
+        self.events = 0
+        self.gated = 0
+
+    def deliver(self, frame):
+        if self.gate is not None and not self.gate():
+            self.gated += 1
+            return
+        for event in self.detector.process(frame):
+            self.events += 1
+            self.on_event(event)
+
+    def describe(self):
+        return self.name
+
+    def close(self):
+        pass
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(events=self.events, gated=self.gated)
+        return stats
+
+
+class AudioTap:
+    """
+    Один отвод звука на мост звонка и динамический набор подписчиков.
+
+    feed() вызывается потоком микшера: режет PCM на кадры ровно по
+    `frame_ms` и отдает каждый кадр (один и тот же bytes) всем
+    подписчикам. Словарь подписчиков заменяется целиком при
+    добавлении/удалении, поэтому feed() читает его без замка.
+    """
+
+    def __init__(self, sample_rate, frame_ms=MIXER_FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_bytes = sample_rate * frame_ms // 1000 * 2
+        self._subscribers = {}
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+        self._pending = bytearray()
+        self.frames = 0
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def add(self, subscriber):
+        """Запускает подписчика и возвращает его номер."""
+        subscriber.start()
+        with self._lock:
+            subscriber_id = next(self._ids)
+            subscribers = dict(self._subscribers)
+            subscribers[subscriber_id] = subscriber
+            self._subscribers = subscribers
+        return subscriber_id
+
+    def remove(self, subscriber_id):
+        """Отписывает и останавливает подписчика; возвращает его или None."""
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            subscriber = subscribers.pop(subscriber_id, None)
+            self._subscribers = subscribers
+        if subscriber is not None:
+            subscriber.stop()
+        return subscriber
+
+    def get(self, subscriber_id):
+        return self._subscribers.get(subscriber_id)
+
+    def close(self):
+        for subscriber_id in list(self._subscribers):
+            self.remove(subscriber_id)
+
+    def feed(self, pcm):
+        if not self._pending and len(pcm) == self.frame_bytes:
+            frames = (bytes(pcm),)
+        else:
+            self._pending += pcm
+            count = len(self._pending) // self.frame_bytes
+            frames = [bytes(self._pending[i * self.frame_bytes:(i + 1) * self.frame_bytes]) for i in range(count)]
+            del self._pending[:count * self.frame_bytes]
+        subscribers = self._subscribers.values()
+        for frame in frames:
+            self.frames += 1
+            for subscriber in subscribers:
+                subscriber.offer(frame)
+
+    def stats(self):
+        return {subscriber_id: subscriber.stats() for subscriber_id, subscriber in self._subscribers.items()}
+
+
+def _benchmark_sender(port, count, size, done):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = bytes(size)
+    sent = 0
+    # Отправляем пачками по 8 кадров, как bursty-отправитель, с паузой на прием
+    while sent < count:
+        for _ in range(min(8, count - sent)):
+            sock.sendto(payload, ("127.0.0.1", port))
+            sent += 1
+        time.sleep(0.0005)
+    done.wait(2)
+    sock.close()
+
+
+def _benchmark(mode, count=50000, size=654):
+    """Прием count датаграмм размером size (20 мс 16 кГц + заголовок) по loopback."""
+    receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    receiver_sock.bind(("127.0.0.1", 0))
+    port = receiver_sock.getsockname()[1]
+    done = Event()
+    sink = JitterBuffer(16000)
+    sender = Thread(target=_benchmark_sender, args=(port, count, size, done), daemon=True)
+    received = wakeups = 0
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    sender.start()
+    if mode == "recvfrom":
+        receiver_sock.settimeout(0.5)
+        while received < count:
+            try:
+                data, _ = receiver_sock.recvfrom(4096)
+            except socket.timeout:
+                break
+            wakeups += 1
+            received += 1
+            sink.push(data)
+    else:
+        receiver = DatagramReceiver(receiver_sock)
+        while received < count:
+            batch = receiver.receive(timeout=0.5)
+            if not batch:
+                break
+            for datagram in batch:
+                sink.push(datagram)
+            received += len(batch)
+        wakeups = receiver.wakeups
+    elapsed = time.perf_counter() - started
+    cpu = time.thread_time() - cpu_started
+    done.set()
+    receiver_sock.close()
+    print(f"{mode:>10}: {received} датаграмм, {wakeups} пробуждений ({received / max(1, wakeups):.1f} на пробуждение), "
+          f"{elapsed:.2f} с, CPU {cpu:.2f} с ({cpu / max(1, received) * 1e6:.1f} мкс на датаграмму)")
+
+
+if __name__ == "__main__":
+    if "--benchmark" in sys.argv:
+        for mode in ("recvfrom", "batched"):
+            _benchmark(mode)
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from keyword_spotter import KeywordSpotter
+
+
+def test_keyword_at_start_of_text():
+    spotter = KeywordSpotter(["подтверждаю", "пожар"])
+    assert spotter.update("s1", "подтверждаю") == ["подтверждаю"]
+    assert spotter.update("s2", "пожар на складе") == ["пожар"]
+
+
+def test_keyword_at_start_of_growing_partial():
+    spotter = KeywordSpotter(["пожар"])
+    assert spotter.update("s", "по") == []
+    assert spotter.update("s", "пожар") == ["пожар"]
+    assert spotter.update("s", "пожар на складе") == []
+
+
+def test_keyword_is_reported_again_in_next_utterance():
+    spotter = KeywordSpotter(["пожар"])
+    assert spotter.update("s", "пожар", final=True) == ["пожар"]
+    assert spotter.update("s", "снова пожар") == ["пожар"]
+
+
+def test_keyword_only_on_word_boundaries():
+    spotter = KeywordSpotter(["пожар"])
+    assert spotter.update("s", "пожарный выход") == []
+    assert spotter.update("s", "распожар") == []